@@ -324,6 +324,9 @@ class AsyncUser:
         require_event_summary: bool = None,
         chats: list[OpenAICompatibleMessage] = None,
         event_similarity_threshold: float = None,
+        fast_event_query: bool = False,
+        profile_filter_mode: Literal["llm", "embedding", "embedding_rerank"] = None,
+        timeout_ms: int = None,
     ) -> str:
         params = f"?max_token_size={max_token_size}"
         if prefer_topics:
@@ -352,6 +355,12 @@ class AsyncUser:
             params += chats_query
         if event_similarity_threshold:
             params += f"&event_similarity_threshold={event_similarity_threshold}"
+        if fast_event_query:
+            params += "&fast_event_query=true"
+        if profile_filter_mode:
+            params += f"&profile_filter_mode={profile_filter_mode}"
+        if timeout_ms:
+            params += f"&timeout_ms={timeout_ms}"
         r = unpack_response(
             await self.project_client.client.get(
                 f"/users/context/{self.user_id}{params}"
@@ -1,20 +1,33 @@
 import memobase_server.env
 import os
+import asyncio
 
 # Done setting up env
 
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, APIRouter
+from fastapi import FastAPI, APIRouter, Depends
 from fastapi.openapi.utils import get_openapi
 from fastapi.middleware.cors import CORSMiddleware
 from memobase_server.connectors import (
     close_connection,
+    request_unit_of_work,
     init_redis_pool,
 )
 from memobase_server import api_layer
-from memobase_server.env import LOG
+from memobase_server.env import LOG, CONFIG
+from memobase_server.cache import cache_invalidation_listener
 from memobase_server.llms.embeddings import check_embedding_sanity
 from memobase_server.llms import llm_sanity_check
+from memobase_server.controllers.event_partition import (
+    event_partition_maintenance_loop,
+)
+from memobase_server.controllers.event_compaction import event_compaction_loop
+from memobase_server.controllers.project import preload_project_profile_configs
+from memobase_server.controllers.billing import (
+    token_billing_flush_loop,
+    flush_token_billing,
+)
+from memobase_server.telemetry.capture_key import int_keys_flush_loop, flush_int_keys
 from uvicorn.config import LOGGING_CONFIG
 from memobase_server.api_layer.docs import API_X_CODE_DOCS
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
@@ -25,8 +38,27 @@ async def lifespan(app: FastAPI):
     init_redis_pool()
     await check_embedding_sanity()
     await llm_sanity_check()
+    background_tasks = [
+        asyncio.create_task(cache_invalidation_listener()),
+        asyncio.create_task(preload_project_profile_configs()),
+    ]
+    if CONFIG.partition_user_events:
+        background_tasks.append(asyncio.create_task(event_partition_maintenance_loop()))
+    if CONFIG.event_compaction_after_days is not None:
+        background_tasks.append(asyncio.create_task(event_compaction_loop()))
+    if CONFIG.billing_flush_interval > 0:
+        background_tasks.append(asyncio.create_task(token_billing_flush_loop()))
+    if CONFIG.telemetry_counter_flush_interval > 0:
+        background_tasks.append(asyncio.create_task(int_keys_flush_loop()))
     LOG.info(f"Start Memobase Server {memobase_server.__version__} 🖼️")
     yield
+    for task in background_tasks:
+        task.cancel()
+    # A flush cancelled midway puts its usage back once it has stopped
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    # Write the token usage accumulated since the last flush
+    await flush_token_billing()
+    await flush_int_keys()
     await close_connection()
 
 
@@ -86,7 +118,14 @@ def custom_openapi():
 
 app.openapi = custom_openapi
 
-router = APIRouter(prefix="/api/v1")
+router = APIRouter(
+    prefix="/api/v1",
+    dependencies=(
+        [Depends(request_unit_of_work)]
+        if CONFIG.database_request_scoped_session
+        else []
+    ),
+)
 LOGGING_CONFIG["formatters"]["default"][
     "fmt"
 ] = "%(levelprefix)s %(asctime)s %(message)s"
@@ -277,4 +316,6 @@ router.post(
 app.include_router(router)
 app.add_middleware(api_layer.middleware.AuthMiddleware)
 
-FastAPIInstrumentor.instrument_app(app)
+if CONFIG.telemetry_instrument_fastapi:
+    # Adds its own middleware, AuthMiddleware already records request metrics
+    FastAPIInstrumentor.instrument_app(app)
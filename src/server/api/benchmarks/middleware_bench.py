@@ -0,0 +1,117 @@
+"""Micro-benchmark of AuthMiddleware against the BaseHTTPMiddleware version it
+replaced. Requests use the root token (ACCESS_TOKEN unset), so neither Redis
+nor the database is needed.
+
+    cd src/server/api && python -m benchmarks.middleware_bench -n 5000
+"""
+
+import os
+import time
+import asyncio
+import argparse
+import tracemalloc
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+from memobase_server.models.database import DEFAULT_PROJECT_ID
+from memobase_server.models.response import BaseResponse, CODE
+from memobase_server.telemetry import (
+    telemetry_manager,
+    CounterMetricName,
+    HistogramMetricName,
+)
+from memobase_server.api_layer.middleware import AuthMiddleware, normalize_path
+
+
+class BaseHTTPAuthMiddleware(BaseHTTPMiddleware):
+    """The previous AuthMiddleware, root token path only"""
+
+    async def dispatch(self, request, call_next):
+        auth_token = request.headers.get("Authorization")
+        if not auth_token or not auth_token.startswith("Bearer "):
+            return JSONResponse(
+                status_code=CODE.UNAUTHORIZED.value,
+                content=BaseResponse(
+                    errno=CODE.UNAUTHORIZED.value,
+                    errmsg=f"Unauthorized access to {request.url.path}.",
+                ).model_dump(),
+            )
+        request.state.is_memobase_root = True
+        request.state.memobase_project_id = DEFAULT_PROJECT_ID
+        attributes = {
+            "project_id": request.state.memobase_project_id,
+            "path": normalize_path(request.url.path),
+            "method": request.method,
+        }
+        telemetry_manager.increment_counter_metric(
+            CounterMetricName.REQUEST, 1, attributes
+        )
+        start_time = time.time()
+        response = await call_next(request)
+        telemetry_manager.record_histogram_metric(
+            HistogramMetricName.REQUEST_LATENCY_MS,
+            (time.time() - start_time) * 1000,
+            attributes,
+        )
+        return response
+
+
+def build_app(middleware) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/api/v1/users/profile/{user_id}")
+    async def get_profile(request: Request, user_id: str):
+        return {"data": {"project_id": request.state.memobase_project_id}}
+
+    app.add_middleware(middleware)
+    return app
+
+
+async def run(app: FastAPI, requests: int, concurrency: int) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    headers = {"Authorization": "Bearer root"}
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+
+        async def worker(n: int):
+            for i in range(n):
+                r = await client.get(f"/api/v1/users/profile/{i}", headers=headers)
+                assert r.status_code == 200, r.text
+
+        await worker(100)  # warm up
+        tracemalloc.start()
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[worker(requests // concurrency) for _ in range(concurrency)]
+        )
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        "req/s": requests / elapsed,
+        "us/req": elapsed / requests * 1e6,
+        "peak KiB": peak / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--requests", type=int, default=5000)
+    parser.add_argument("-c", "--concurrency", type=int, default=10)
+    args = parser.parse_args()
+    os.environ.pop("ACCESS_TOKEN", None)
+
+    for name, middleware in [
+        ("BaseHTTPMiddleware", BaseHTTPAuthMiddleware),
+        ("ASGI AuthMiddleware", AuthMiddleware),
+    ]:
+        result = asyncio.run(
+            run(build_app(middleware), args.requests, args.concurrency)
+        )
+        print(f"{name:<22}" + "  ".join(f"{k}: {v:10.1f}" for k, v in result.items()))
+
+
+if __name__ == "__main__":
+    main()
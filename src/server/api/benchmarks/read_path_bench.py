@@ -0,0 +1,159 @@
+"""Per-request CPU of the profile and event reads, with the ORM entities and
+validated models they used before, and with the Core selects and
+model_construct they use now. Needs DATABASE_URL, the test data is written to a
+new user and deleted afterwards.
+
+    cd src/server/api && python -m benchmarks.read_path_bench -p 500 -e 500
+"""
+
+import time
+import asyncio
+import argparse
+from memobase_server.connectors import Session, create_tables
+from memobase_server.models.database import (
+    DEFAULT_PROJECT_ID,
+    User,
+    UserProfile,
+    UserEvent,
+)
+from memobase_server.models.response import UserProfilesData, UserEventsData
+from memobase_server.controllers.profile import load_user_profiles
+from memobase_server.controllers.event import get_user_events
+
+
+def orm_load_user_profiles(user_id: str, project_id: str) -> UserProfilesData:
+    """load_user_profiles before the Core select"""
+    with Session() as session:
+        user_profiles = (
+            session.query(UserProfile)
+            .filter_by(user_id=user_id, project_id=project_id)
+            .order_by(UserProfile.updated_at.desc())
+            .all()
+        )
+        results = [
+            {
+                "id": up.id,
+                "content": up.content,
+                "attributes": up.attributes,
+                "token_count": up.token_count,
+                "created_at": up.created_at,
+                "updated_at": up.updated_at,
+            }
+            for up in user_profiles
+        ]
+    return UserProfilesData(profiles=results)
+
+
+def orm_get_user_events(user_id: str, project_id: str, topk: int) -> UserEventsData:
+    """get_user_events before the Core select"""
+    with Session() as session:
+        user_events = (
+            session.query(UserEvent)
+            .filter_by(user_id=user_id, project_id=project_id, digest_id=None)
+            .order_by(UserEvent.created_at.desc())
+            .limit(topk)
+            .all()
+        )
+        results = [
+            {
+                "id": ue.id,
+                "event_data": ue.event_data,
+                "created_at": ue.created_at,
+                "updated_at": ue.updated_at,
+                "token_count": ue.token_count,
+            }
+            for ue in user_events
+        ]
+    return UserEventsData(events=results)
+
+
+def seed_user(profiles: int, events: int) -> str:
+    with Session() as session:
+        user = User(project_id=DEFAULT_PROJECT_ID)
+        session.add(user)
+        session.flush()
+        session.add_all(
+            UserProfile(
+                user_id=user.id,
+                project_id=DEFAULT_PROJECT_ID,
+                content=f"profile content number {i}, a sentence of a few words",
+                attributes={"topic": f"topic_{i % 10}", "sub_topic": f"sub_{i}"},
+                token_count=16,
+            )
+            for i in range(profiles)
+        )
+        session.add_all(
+            UserEvent(
+                user_id=user.id,
+                project_id=DEFAULT_PROJECT_ID,
+                event_data={
+                    "event_tip": f"event number {i}, the user did something",
+                    "event_tags": [{"tag": "emotion", "value": "happy"}],
+                    "profile_delta": [
+                        {
+                            "content": f"profile content number {i}",
+                            "attributes": {"topic": "interest", "sub_topic": "x"},
+                        }
+                    ],
+                },
+                token_count=24,
+            )
+            for i in range(events)
+        )
+        session.commit()
+        return str(user.id)
+
+
+def delete_user(user_id: str):
+    with Session() as session:
+        session.query(User).filter_by(id=user_id).delete()
+        session.commit()
+
+
+async def measure(func, rounds: int) -> dict:
+    async def call():
+        result = func()
+        if asyncio.iscoroutine(result):
+            await result
+
+    await call()  # warm up
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for _ in range(rounds):
+        await call()
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    return {"cpu ms/req": cpu / rounds * 1000, "wall ms/req": wall / rounds * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--profiles", type=int, default=500)
+    parser.add_argument("-e", "--events", type=int, default=500)
+    parser.add_argument("-n", "--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    create_tables()
+    user_id = seed_user(args.profiles, args.events)
+    cases = [
+        ("profiles ORM", lambda: orm_load_user_profiles(user_id, DEFAULT_PROJECT_ID)),
+        ("profiles Core", lambda: load_user_profiles(user_id, DEFAULT_PROJECT_ID)),
+        (
+            "events ORM",
+            lambda: orm_get_user_events(user_id, DEFAULT_PROJECT_ID, args.events),
+        ),
+        (
+            "events Core",
+            lambda: get_user_events(user_id, DEFAULT_PROJECT_ID, topk=args.events),
+        ),
+    ]
+    try:
+        for name, func in cases:
+            result = asyncio.run(measure(func, args.rounds))
+            print(
+                f"{name:<15}" + "  ".join(f"{k}: {v:8.2f}" for k, v in result.items())
+            )
+    finally:
+        delete_user(user_id)
+
+
+if __name__ == "__main__":
+    main()
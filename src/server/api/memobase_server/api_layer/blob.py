@@ -8,7 +8,7 @@ from ..env import TelemetryKeyName, TRACE_LOG
 from ..models.response import CODE
 from ..models.utils import Promise
 from ..models import response as res
-from ..telemetry.capture_key import capture_int_key
+from ..telemetry.capture_key import buffer_int_key
 
 
 async def insert_blob(
@@ -22,10 +22,10 @@ async def insert_blob(
 ) -> res.BlobInsertResponse:
     project_id = request.state.memobase_project_id
     background_tasks.add_task(
-        capture_int_key, TelemetryKeyName.insert_blob_request, project_id=project_id
+        buffer_int_key, TelemetryKeyName.insert_blob_request, project_id=project_id
     )
 
-    p = await controllers.billing.get_project_billing(project_id)
+    p = await controllers.billing.get_project_quota(project_id)
     if not p.ok():
         return p.to_response(res.IdResponse)
     billing = p.data()
@@ -89,7 +89,7 @@ async def insert_blob(
         ).to_response(res.BaseResponse)
 
     background_tasks.add_task(
-        capture_int_key,
+        buffer_int_key,
         TelemetryKeyName.insert_blob_success_request,
         project_id=project_id,
     )
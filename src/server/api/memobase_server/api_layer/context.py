@@ -1,4 +1,5 @@
 import json
+from typing import Literal
 
 from ..controllers import full as controllers
 
@@ -48,6 +49,19 @@ async def get_user_context(
         0.2,
         description="Event similarity threshold of returned Context",
     ),
+    fast_event_query: bool = Query(
+        False,
+        description="Search events with the last chat message only, without waiting for the profiles filtered by `chats_str`. Faster, but the event search is less precise",
+    ),
+    profile_filter_mode: Literal["llm", "embedding", "embedding_rerank"] = Query(
+        "llm",
+        description="How to pick the profiles related to `chats_str`: `llm` asks the LLM, `embedding` ranks by the similarity of profile embeddings (requires `enable_profile_embedding`), `embedding_rerank` lets the LLM pick from the closest profiles",
+    ),
+    timeout_ms: int = Query(
+        None,
+        description="Latency budget in milliseconds. Profile filtering and event search that overrun it are skipped, and reported in `degraded_stages`",
+        gt=0,
+    ),
 ) -> res.UserContextDataResponse:
     project_id = request.state.memobase_project_id
     topic_limits_json = topic_limits_json or "{}"
@@ -71,5 +85,8 @@ async def get_user_context(
         require_event_summary,
         chats,
         event_similarity_threshold,
+        fast_event_query,
+        profile_filter_mode,
+        timeout_ms,
     )
     return p.to_response(res.UserContextDataResponse)
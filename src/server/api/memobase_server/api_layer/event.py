@@ -1,5 +1,9 @@
+import json
 from ..controllers import full as controllers
+from ..models.response import CODE
+from ..models.utils import Promise
 from ..models import response as res
+from typing import Literal
 from fastapi import Request
 from fastapi import Path, Query, Body
 
@@ -16,10 +20,29 @@ async def get_user_events(
         False,
         description="Whether to return events with summaries",
     ),
+    tags: list[str] = Query(
+        None,
+        description="Only return events having all these tags, for example `tags=emotion&tags=goal`",
+    ),
+    tag_values_json: str = Query(
+        None,
+        description='Only return events whose tags have these values in JSON, for example {"emotion": "happy"}',
+    ),
 ) -> res.UserEventsDataResponse:
     project_id = request.state.memobase_project_id
+    try:
+        tag_values = res.StrStrData(data=json.loads(tag_values_json or "{}")).data
+    except Exception as e:
+        return Promise.reject(CODE.BAD_REQUEST, f"Invalid JSON: {e}").to_response(
+            res.UserEventsDataResponse
+        )
     p = await controllers.event.get_user_events(
-        user_id, project_id, topk=topk, need_summary=need_summary
+        user_id,
+        project_id,
+        topk=topk,
+        need_summary=need_summary,
+        tags=tags,
+        tag_values=tag_values,
     )
     if not p.ok():
         return p.to_response(res.UserEventsDataResponse)
@@ -59,9 +82,37 @@ async def search_user_events(
         0.2, description="Similarity threshold, default is 0.2"
     ),
     time_range_in_days: int = Query(7, description="Time range in days, default is 7"),
+    search_mode: Literal["auto", "vector", "lexical", "hybrid"] = Query(
+        "auto",
+        description="Search mode. `vector` uses embeddings, `lexical` uses full-text search without an embedding call, "
+        "`hybrid` fuses both rankings (RRF score is returned as similarity). "
+        "`auto` is `vector` when event embedding is enabled, otherwise `lexical`",
+    ),
+    tags: list[str] = Query(
+        None,
+        description="Only return events having all these tags, for example `tags=emotion&tags=goal`",
+    ),
+    tag_values_json: str = Query(
+        None,
+        description='Only return events whose tags have these values in JSON, for example {"emotion": "happy"}',
+    ),
 ) -> res.UserEventsDataResponse:
     project_id = request.state.memobase_project_id
+    try:
+        tag_values = res.StrStrData(data=json.loads(tag_values_json or "{}")).data
+    except Exception as e:
+        return Promise.reject(CODE.BAD_REQUEST, f"Invalid JSON: {e}").to_response(
+            res.UserEventsDataResponse
+        )
     p = await controllers.event.search_user_events(
-        user_id, project_id, query, topk, similarity_threshold, time_range_in_days
+        user_id,
+        project_id,
+        query,
+        topk,
+        similarity_threshold,
+        time_range_in_days,
+        search_mode=search_mode,
+        tags=tags,
+        tag_values=tag_values,
     )
     return p.to_response(res.UserEventsDataResponse)
@@ -1,7 +1,8 @@
 import os
+import hmac
+import json
 import time
-from starlette.middleware.base import BaseHTTPMiddleware
-from fastapi.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from ..env import ProjectStatus
 from ..models.database import DEFAULT_PROJECT_ID
@@ -11,14 +12,13 @@ from ..telemetry import (
     CounterMetricName,
     HistogramMetricName,
 )
-from ..models.response import BaseResponse, CODE
+from ..models.response import CODE
 from ..auth.token import (
     parse_project_id,
     check_project_secret,
     get_project_status,
 )
 
-
 PATH_MAPPINGS = [
     "/api/v1/users/blobs",
     "/api/v1/users/profile",
@@ -31,86 +31,115 @@ PATH_MAPPINGS = [
 ]
 
 
-class AuthMiddleware(BaseHTTPMiddleware):
-    def normalize_path(self, path: str) -> str:
-        """Remove dynamic path parameters to get normalized path for metrics"""
-        if not path.startswith("/api"):
-            return path
+def normalize_path(path: str) -> str:
+    """Remove dynamic path parameters to get normalized path for metrics"""
+    if not path.startswith("/api"):
+        return path
+
+    for prefix in PATH_MAPPINGS:
+        if path.startswith(prefix):
+            return prefix
 
-        for prefix in PATH_MAPPINGS:
-            if path.startswith(prefix):
-                return prefix
+    return path
+
+
+def get_header(scope: Scope, name: bytes) -> str | None:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def send_error(send: Send, code: CODE, errmsg: str):
+    # Same body as BaseResponse, serialized without building the model
+    body = json.dumps({"data": None, "errno": code.value, "errmsg": errmsg}).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": code.value,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
 
-        return path
 
-    async def dispatch(self, request, call_next):
-        if not request.url.path.startswith("/api"):
-            return await call_next(request)
+class AuthMiddleware:
+    """Authenticates /api requests and records their metrics.
 
-        if request.url.path.startswith("/api/v1/healthcheck"):
+    A plain ASGI middleware: the request and response pass through untouched,
+    without the extra task and body streams of BaseHTTPMiddleware.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api"):
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+
+        if path.startswith("/api/v1/healthcheck"):
             telemetry_manager.increment_counter_metric(
                 CounterMetricName.HEALTHCHECK,
                 1,
             )
-            return await call_next(request)
+            await self.app(scope, receive, send)
+            return
 
-        auth_token = request.headers.get("Authorization")
+        auth_token = get_header(scope, b"authorization")
         if not auth_token or not auth_token.startswith("Bearer "):
-            return JSONResponse(
-                status_code=CODE.UNAUTHORIZED.value,
-                content=BaseResponse(
-                    errno=CODE.UNAUTHORIZED.value,
-                    errmsg=f"Unauthorized access to {request.url.path}. You have to provide a valid Bearer token.",
-                ).model_dump(),
+            await send_error(
+                send,
+                CODE.UNAUTHORIZED,
+                f"Unauthorized access to {path}. You have to provide a valid Bearer token.",
             )
+            return
         auth_token = (auth_token.split(" ")[1]).strip()
         is_root = self.is_valid_root(auth_token)
-        request.state.is_memobase_root = is_root
-        request.state.memobase_project_id = DEFAULT_PROJECT_ID
+        project_id = DEFAULT_PROJECT_ID
         if not is_root:
             p = await self.parse_project_token(auth_token)
             if not p.ok():
-                return JSONResponse(
-                    status_code=CODE.UNAUTHORIZED.value,
-                    content=BaseResponse(
-                        errno=CODE.UNAUTHORIZED.value,
-                        errmsg=f"Unauthorized access to {request.url.path}. {p.msg()}",
-                    ).model_dump(),
+                await send_error(
+                    send, CODE.UNAUTHORIZED, f"Unauthorized access to {path}. {p.msg()}"
                 )
-            request.state.memobase_project_id = p.data()
-        # await capture_int_key(TelemetryKeyName.has_request)
-
-        normalized_path = self.normalize_path(request.url.path)
-
+                return
+            project_id = p.data()
+        # Read back as request.state by the handlers
+        state = scope.setdefault("state", {})
+        state["is_memobase_root"] = is_root
+        state["memobase_project_id"] = project_id
+
+        attributes = {
+            "project_id": project_id,
+            "path": normalize_path(path),
+            "method": scope["method"],
+        }
         telemetry_manager.increment_counter_metric(
             CounterMetricName.REQUEST,
             1,
-            {
-                "project_id": request.state.memobase_project_id,
-                "path": normalized_path,
-                "method": request.method,
-            },
+            attributes,
         )
 
         start_time = time.time()
-        response = await call_next(request)
-
-        telemetry_manager.record_histogram_metric(
-            HistogramMetricName.REQUEST_LATENCY_MS,
-            (time.time() - start_time) * 1000,
-            {
-                "project_id": request.state.memobase_project_id,
-                "path": normalized_path,
-                "method": request.method,
-            },
-        )
-        return response
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            telemetry_manager.record_histogram_metric(
+                HistogramMetricName.REQUEST_LATENCY_MS,
+                (time.time() - start_time) * 1000,
+                attributes,
+            )
 
     def is_valid_root(self, token: str) -> bool:
         access_token = os.getenv("ACCESS_TOKEN")
         if access_token is None:
             return True
-        return token == access_token.strip()
+        return hmac.compare_digest(token.encode(), access_token.strip().encode())
 
     async def parse_project_token(self, token: str) -> Promise[str]:
         p = parse_project_id(token)
@@ -53,7 +53,18 @@ async def get_user_profile(
         return Promise.reject(
             CODE.BAD_REQUEST, f"Invalid JSON requests: {e}"
         ).to_response(res.UserProfileResponse)
-    p = await controllers.profile.get_user_profiles(user_id, project_id)
+    topic_filters = dict(only_topics=only_topics)
+    if not chats:
+        # No chat filter runs in between, the topic limits apply when loading
+        topic_filters.update(
+            prefer_topics=prefer_topics,
+            max_subtopic_size=max_subtopic_size,
+            topic_limits=topic_limits,
+            topk=topk,
+        )
+    p = await controllers.profile.get_user_profiles(
+        user_id, project_id, **topic_filters
+    )
     if not p.ok():
         return p.to_response(res.UserProfileResponse)
     total_profiles = p.data()
@@ -136,7 +147,7 @@ async def import_user_context(
     ),
 ) -> res.BaseResponse:
     project_id = request.state.memobase_project_id
-    p = await controllers.billing.get_project_billing(project_id)
+    p = await controllers.billing.get_project_quota(project_id)
     if not p.ok():
         return p.to_response(res.IdResponse)
     billing = p.data()
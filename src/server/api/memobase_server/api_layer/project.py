@@ -1,5 +1,6 @@
 from ..controllers import full as controllers
 from .. import utils
+from ..offload import run_cpu_bound
 
 from ..models.response import BaseResponse, CODE
 from ..models.utils import Promise
@@ -16,7 +17,11 @@ async def update_project_profile_config(
     ),
 ) -> res.BaseResponse:
     project_id = request.state.memobase_project_id
-    p = utils.is_valid_profile_config(profile_config.profile_config)
+    p = await run_cpu_bound(
+        len(profile_config.profile_config or ""),
+        utils.is_valid_profile_config,
+        profile_config.profile_config,
+    )
     if not p.ok():
         return p.to_response(res.BaseResponse)
     p = await controllers.project.update_project_profile_config(
@@ -1,13 +1,30 @@
+import hmac
+import time
 from hashlib import sha256
+from dataclasses import dataclass
 from datetime import datetime
 from random import random
 from typing import Tuple
 from uuid import uuid4
+from ..env import CONFIG
 from ..models.utils import Promise
 from ..models.response import CODE
 from ..connectors import get_redis_client
+from ..cache import LocalCache
 from ..controllers import project
 
+PROJECT_AUTH_LOCAL_CACHE = LocalCache(
+    "project_auth",
+    CONFIG.cache_project_auth_local_size,
+    CONFIG.cache_project_auth_local_ttl,
+)
+
+
+@dataclass(frozen=True)
+class ProjectAuth:
+    secret_hash: bytes
+    status: str
+
 
 def parse_project_id(secret_key: str) -> Promise[str]:
     if not secret_key.startswith("sk-"):
@@ -27,27 +44,57 @@ def project_status_redis_key(project_id: str) -> str:
     return f"memobase::auth::project_status::{project_id}"
 
 
-async def check_project_secret(project_id: str, secret_key: str) -> Promise[bool]:
+def hash_secret(secret: str) -> bytes:
+    # Only the digest is kept in memory, and digests compare in constant time
+    return sha256(secret.encode()).digest()
+
+
+def project_auth_version() -> int:
+    # Taken before reading, so a slower read can't replace a newer one
+    return time.time_ns() // 1000
+
+
+async def get_project_auth(project_id: str) -> Promise[ProjectAuth]:
+    """The project's secret hash and status. Secrets and statuses are changed
+    outside Memobase and nothing invalidates the in-memory copies, so a rotated
+    secret or a changed status applies within cache_project_auth_local_ttl
+    seconds after its Redis keys are updated"""
+    auth = PROJECT_AUTH_LOCAL_CACHE.get(project_id)
+    if auth is not None:
+        return Promise.resolve(auth)
+    version = project_auth_version()
     async with get_redis_client() as client:
-        secret = await client.get(token_redis_key(project_id))
+        secret, status = await client.mget(
+            token_redis_key(project_id), project_status_redis_key(project_id)
+        )
         if secret is None:
             p = await project.get_project_secret(project_id)
             if not p.ok():
                 return Promise.reject(CODE.UNAUTHORIZED, "Your project is not exists!")
             secret = p.data()
             await client.set(token_redis_key(project_id), secret, ex=None)
-    return Promise.resolve(secret == secret_key)
-
-
-async def get_project_status(project_id: str) -> Promise[str]:
-    async with get_redis_client() as client:
-        status = await client.get(project_status_redis_key(project_id))
         if status is None:
             p = await project.get_project_status(project_id)
             if not p.ok():
                 return p
-            status = p.data()
-            await client.set(
-                project_status_redis_key(project_id), status.strip(), ex=60 * 60
-            )
-    return Promise.resolve(status)
+            status = p.data().strip()
+            await client.set(project_status_redis_key(project_id), status, ex=60 * 60)
+    auth = ProjectAuth(secret_hash=hash_secret(secret), status=status)
+    PROJECT_AUTH_LOCAL_CACHE.set(project_id, auth, version)
+    return Promise.resolve(auth)
+
+
+async def check_project_secret(project_id: str, secret_key: str) -> Promise[bool]:
+    p = await get_project_auth(project_id)
+    if not p.ok():
+        return p
+    return Promise.resolve(
+        hmac.compare_digest(p.data().secret_hash, hash_secret(secret_key))
+    )
+
+
+async def get_project_status(project_id: str) -> Promise[str]:
+    p = await get_project_auth(project_id)
+    if not p.ok():
+        return p
+    return Promise.resolve(p.data().status)
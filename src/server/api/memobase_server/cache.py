@@ -0,0 +1,190 @@
+import json
+import time
+import asyncio
+import traceback
+from typing import Any, Awaitable, Callable, TypeVar
+from collections import OrderedDict
+from .env import LOG
+from .connectors import get_redis_client, PROJECT_ID
+
+CACHE_INVALIDATION_CHANNEL = f"memobase:cache_invalidation:{PROJECT_ID}"
+LOCAL_CACHES: dict[str, "LocalCache"] = {}
+LISTENER_STATE = {"subscribed": False}
+LEASE_POLL_INTERVAL = 0.02
+
+T = TypeVar("T")
+
+
+class LocalCache:
+    """In-process LRU cache with TTL, one instance per worker.
+
+    Every entry carries the version it was read at. Writers publish the new
+    version on CACHE_INVALIDATION_CHANNEL and older entries are dropped, so the
+    cache is only used while this worker is subscribed to that channel.
+    """
+
+    def __init__(self, name: str, max_size: int, ttl: int):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[int, float, Any]] = OrderedDict()
+        LOCAL_CACHES[name] = self
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and LISTENER_STATE["subscribed"]
+
+    def get(self, key: str) -> Any | None:
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        _, expire_at, value = entry
+        if value is None or expire_at < time.monotonic():
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, version: int):
+        if not self.enabled:
+            return
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > version:
+            return
+        self._put(key, version, value)
+
+    def invalidate(self, key: str, version: int):
+        # Keep a tombstone, so a slower reader can't store an older version later
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] >= version:
+            return
+        self._put(key, version, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _put(self, key: str, version: int, value: Any):
+        self._entries[key] = (version, time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class SingleFlight:
+    """Coalesce concurrent loads of the same key in this worker, the callers
+    that arrive while a load is running await its result instead of loading"""
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, loader: Callable[[], Awaitable[T]]) -> T:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(loader())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        # A cancelled caller must not cancel the load the others are waiting on
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+
+async def acquire_lease_or_wait(
+    lease_key: str, cache_key: str, lease_ms: int
+) -> tuple[bool, str | None]:
+    """Take the short lease to load cache_key, or wait until its holder in another
+    worker fills cache_key. Returns (leased, cached value filled by the holder).
+    When the holder doesn't fill it in time, load without the lease."""
+    async with get_redis_client() as redis_client:
+        if await redis_client.set(lease_key, "1", nx=True, px=lease_ms):
+            return True, None
+        deadline = time.monotonic() + lease_ms / 1000
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LEASE_POLL_INTERVAL)
+            cached = await redis_client.get(cache_key)
+            if cached is not None:
+                return False, cached
+    return False, None
+
+
+async def release_lease(lease_key: str):
+    async with get_redis_client() as redis_client:
+        await redis_client.delete(lease_key)
+
+
+async def wait_for_subscription(timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not LISTENER_STATE["subscribed"]:
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.1)
+    return True
+
+
+async def bump_version(version_key: str, ttl: int) -> int:
+    """Versions restart from the current time in ms after the key expires, so
+    they never go back to a value an older cache entry was stored under"""
+    async with get_redis_client() as redis_client:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.set(version_key, int(time.time() * 1000), nx=True, ex=ttl)
+            pipe.incr(version_key)
+            pipe.expire(version_key, ttl)
+            _, version, _ = await pipe.execute()
+    return version
+
+
+def pack_invalidation(cache_name: str, key: str, version: int) -> str:
+    return json.dumps({"cache": cache_name, "key": key, "version": version})
+
+
+async def publish_invalidation(cache_name: str, key: str, version: int):
+    async with get_redis_client() as redis_client:
+        await redis_client.publish(
+            CACHE_INVALIDATION_CHANNEL, pack_invalidation(cache_name, key, version)
+        )
+
+
+def handle_invalidation(message: str):
+    try:
+        data = json.loads(message)
+        cache = LOCAL_CACHES.get(data["cache"])
+        if cache is not None:
+            cache.invalidate(data["key"], int(data["version"]))
+    except (ValueError, KeyError, TypeError) as e:
+        LOG.warning(f"Invalid cache invalidation message {message}: {e}")
+
+
+def clear_local_caches():
+    for cache in LOCAL_CACHES.values():
+        cache.clear()
+
+
+async def cache_invalidation_listener():
+    while True:
+        try:
+            async with get_redis_client() as redis_client:
+                pubsub = redis_client.pubsub()
+                try:
+                    await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "subscribe":
+                            LISTENER_STATE["subscribed"] = True
+                            LOG.info(f"Subscribed to {CACHE_INVALIDATION_CHANNEL}")
+                        elif message["type"] == "message":
+                            handle_invalidation(message["data"])
+                finally:
+                    await pubsub.aclose()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOG.error(
+                f"Error in cache invalidation listener: {e}\n{traceback.format_exc()}"
+            )
+        finally:
+            # Invalidations may be missed while unsubscribed
+            LISTENER_STATE["subscribed"] = False
+            clear_local_caches()
+        await asyncio.sleep(1)
@@ -1,15 +1,25 @@
 import os
+import time
 import asyncio
 import redis.exceptions as redis_exceptions
 import redis.asyncio as redis
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from itertools import count
+from typing import Iterator
+from sqlalchemy import Connection, Engine, create_engine, make_url, text
+from sqlalchemy.orm import Session as OrmSession, sessionmaker
+from sqlalchemy.pool import NullPool
 from sqlalchemy.exc import OperationalError
 from uuid import uuid4
-from .env import LOG
-from .models.database import REG, Project, UserEvent
+from .env import LOG, CONFIG
+from .models.database import REG, Project, UserEvent, UserProfile
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+DATABASE_READ_URLS = [
+    url.strip() for url in os.getenv("DATABASE_READ_URLS", "").split(",") if url.strip()
+]
 REDIS_URL = os.getenv("REDIS_URL")
 PROJECT_ID = os.getenv("PROJECT_ID")
 ADMIN_URL = os.getenv("ADMIN_URL")
@@ -21,21 +31,185 @@ if PROJECT_ID is None:
 LOG.info(f"Project ID: {PROJECT_ID}")
 LOG.info(f"Database URL: {DATABASE_URL}")
 LOG.info(f"Redis URL: {REDIS_URL}")
+LOG.info(f"Database read replicas: {len(DATABASE_READ_URLS)}")
+
+
+def create_db_engine(url: str = DATABASE_URL) -> Engine:
+    if CONFIG.database_pool_mode == "pgbouncer":
+        # PgBouncer in transaction mode pools the server connections itself and
+        # may run each transaction on a different one
+        connect_args = {}
+        if make_url(url).get_driver_name() == "psycopg":
+            # No server-side prepared statements, they don't survive the switch
+            connect_args["prepare_threshold"] = None
+        if CONFIG.database_pool_size <= 0:
+            return create_engine(url, poolclass=NullPool, connect_args=connect_args)
+        return create_engine(
+            url,
+            pool_size=CONFIG.database_pool_size,
+            max_overflow=CONFIG.database_max_overflow,
+            pool_recycle=300,
+            pool_timeout=45,
+            pool_reset_on_return="commit",
+            connect_args=connect_args,
+        )
+    if CONFIG.database_pool_size <= 0:
+        return create_engine(url, poolclass=NullPool)
+    return create_engine(
+        url,
+        pool_size=CONFIG.database_pool_size,
+        max_overflow=CONFIG.database_max_overflow,
+        pool_recycle=300,  # Reduced from 600 to recycle connections more frequently
+        pool_pre_ping=True,  # Verify connections before using
+        pool_timeout=45,  # Increased from 30 seconds for better handling under load
+        pool_reset_on_return="commit",  # Ensure clean state when connections are returned
+        echo_pool=False,  # Set to True for debugging pool issues
+    )
+
 
 # Create an engine
-DB_ENGINE = create_engine(
-    DATABASE_URL,
-    pool_size=75,  # Increased from 50 to handle more concurrent operations
-    max_overflow=50,  # Increased from 30 to provide more buffer
-    pool_recycle=300,  # Reduced from 600 to recycle connections more frequently
-    pool_pre_ping=True,  # Verify connections before using
-    pool_timeout=45,  # Increased from 30 seconds for better handling under load
-    pool_reset_on_return="commit",  # Ensure clean state when connections are returned
-    echo_pool=False,  # Set to True for debugging pool issues
-)
+DB_ENGINE = create_db_engine()
 REDIS_POOL = None
 
-Session = sessionmaker(bind=DB_ENGINE)
+SessionFactory = sessionmaker(bind=DB_ENGINE)
+
+
+class RequestUnitOfWork:
+    """The database connection shared by the controllers of one request. It is
+    checked out on first use and returned when the request ends, the sessions
+    still commit their own transactions on it."""
+
+    def __init__(self):
+        self.connection: Connection | None = None
+        self.closed = False
+
+    def session(self) -> OrmSession:
+        if self.connection is None:
+            self.connection = DB_ENGINE.connect()
+        return SessionFactory(bind=self.connection)
+
+    def close(self):
+        self.closed = True
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+REQUEST_UNIT_OF_WORK: ContextVar[RequestUnitOfWork | None] = ContextVar(
+    "request_unit_of_work", default=None
+)
+
+
+def Session() -> OrmSession:
+    """A new session, on the connection of the current request if there is one"""
+    unit = REQUEST_UNIT_OF_WORK.get()
+    # Tasks spawned by a request can outlive it, they get their own connection
+    if unit is None or unit.closed:
+        return SessionFactory()
+    return unit.session()
+
+
+async def request_unit_of_work():
+    """FastAPI dependency that makes the controllers of a request share one
+    connection, only used with database_pool_mode pgbouncer"""
+    unit = RequestUnitOfWork()
+    # Not reset on exit, the context may differ there, closing is enough
+    REQUEST_UNIT_OF_WORK.set(unit)
+    try:
+        yield unit
+    finally:
+        unit.close()
+
+
+@dataclass
+class ReadReplica:
+    engine: Engine
+    # time.monotonic() until which the replica gets no reads
+    ejected_until: float = 0.0
+
+
+READ_REPLICAS = [ReadReplica(create_db_engine(url)) for url in DATABASE_READ_URLS]
+READ_REPLICA_TURNS = count()
+
+
+def recent_write_key(user_id: str, project_id: str) -> str:
+    return f"recent_write::{project_id}::{user_id}"
+
+
+async def mark_recent_write(user_id: str, project_id: str):
+    """Keep the user's reads on the primary for a while, until the replicas
+    caught up with this write"""
+    if not READ_REPLICAS:
+        return
+    async with get_redis_client() as redis_client:
+        await redis_client.set(
+            recent_write_key(user_id, project_id),
+            1,
+            px=CONFIG.database_read_your_writes_ms,
+        )
+
+
+async def use_read_replica(user_id: str = None, project_id: str = None) -> bool:
+    """Whether the reads of a user can go to a read replica, False if the user
+    wrote recently"""
+    if not READ_REPLICAS:
+        return False
+    if user_id is None:
+        return True
+    try:
+        async with get_redis_client() as redis_client:
+            recent_write = await redis_client.exists(
+                recent_write_key(user_id, project_id)
+            )
+    except redis_exceptions.RedisError as e:
+        LOG.warning(f"Failed to check recent writes, reading from primary: {e}")
+        return False
+    return not recent_write
+
+
+def eject_read_replica(replica: ReadReplica, error: Exception):
+    replica.ejected_until = time.monotonic() + CONFIG.database_replica_eject_seconds
+    LOG.warning(
+        f"Read replica {replica.engine.url!r} ejected for "
+        f"{CONFIG.database_replica_eject_seconds}s: {error}"
+    )
+
+
+def connect_read_replica() -> tuple[ReadReplica, Connection] | None:
+    """A connection to the next healthy replica in turn, None if all are down"""
+    now = time.monotonic()
+    start = next(READ_REPLICA_TURNS)
+    for i in range(len(READ_REPLICAS)):
+        replica = READ_REPLICAS[(start + i) % len(READ_REPLICAS)]
+        if replica.ejected_until > now:
+            continue
+        try:
+            return replica, replica.engine.connect()
+        except OperationalError as e:
+            eject_read_replica(replica, e)
+    return None
+
+
+@contextmanager
+def ReadSession(replica: bool = True) -> Iterator[OrmSession]:
+    """A session for reads, on a read replica when replica is True and one is
+    healthy, otherwise a Session() on the primary. Decide replica with
+    use_read_replica, replicas may lag behind the user's own writes"""
+    connected = connect_read_replica() if replica and READ_REPLICAS else None
+    if connected is None:
+        with Session() as session:
+            yield session
+        return
+    read_replica, connection = connected
+    try:
+        with SessionFactory(bind=connection) as session:
+            yield session
+    except OperationalError as e:
+        if e.connection_invalidated:
+            eject_read_replica(read_replica, e)
+        raise
+    finally:
+        connection.close()
 
 
 def create_pgvector_extension():
@@ -48,13 +222,45 @@ def create_pgvector_extension():
         LOG.error(f"Failed to create pgvector extension: {e}")
 
 
+def migrate_schema(dry_run: bool = False) -> list[str]:
+    """Add the columns and indexes introduced after the tables were created,
+    returns the missing ones. Adding a column may rewrite a large table, so this
+    only runs at startup with database_auto_migrate, otherwise run
+    migrate_schema.py once after upgrading"""
+    with DB_ENGINE.connect().execution_options(
+        isolation_level="AUTOCOMMIT"
+    ) as connection:
+        return UserEvent.ensure_schema(connection, dry_run) + UserProfile.ensure_schema(
+            connection, dry_run
+        )
+
+
 def create_tables():
     create_pgvector_extension()
 
     REG.metadata.create_all(DB_ENGINE)
+    if CONFIG.database_auto_migrate:
+        migrate_schema()
+    else:
+        missing = migrate_schema(dry_run=True)
+        if missing:
+            LOG.warning(
+                f"Database schema is outdated, missing {', '.join(missing)}. "
+                "Run migrate_schema.py or enable database_auto_migrate"
+            )
     with Session() as session:
         Project.initialize_root_project(session)
         UserEvent.check_legal_embedding_dim(session)
+        if CONFIG.partition_user_events:
+            if UserEvent.is_partitioned(session):
+                UserEvent.create_monthly_partitions(
+                    session, CONFIG.event_partition_premake_months
+                )
+            else:
+                LOG.warning(
+                    "partition_user_events is enabled but the existing user_events table "
+                    "is not partitioned, migrate it manually to use partitioning"
+                )
     LOG.info("Database tables created successfully")
 
 
@@ -85,6 +291,8 @@ async def redis_health_check() -> bool:
 
 async def close_connection():
     DB_ENGINE.dispose()
+    for replica in READ_REPLICAS:
+        replica.engine.dispose()
     if REDIS_POOL is not None:
         await REDIS_POOL.aclose()
     LOG.info("Connections closed")
@@ -105,6 +313,8 @@ def get_redis_client() -> redis.Redis:
 def get_pool_status() -> dict:
     """Get current connection pool status for monitoring."""
     pool = DB_ENGINE.pool
+    if isinstance(pool, NullPool):
+        return {"pool": "none"}
     return {
         "size": pool.size(),
         "checked_in": pool.checkedin(),
@@ -122,7 +332,7 @@ def get_pool_status() -> dict:
 def log_pool_status(operation: str = "unknown"):
     """Log current pool status for debugging."""
     status = get_pool_status()
-    if status["utilization_percent"] > 80:  # Log warning if utilization is high
+    if status.get("utilization_percent", 0) > 80:  # Log warning if utilization is high
         LOG.warning(
             f"High DB pool utilization after {operation}: "
             f"{status['checked_out']}/{status['total_capacity']} "
@@ -1,4 +1,9 @@
+import time
+import asyncio
+import traceback
+from dataclasses import dataclass
 from pydantic import ValidationError
+from sqlalchemy import Integer, VARCHAR, column, func, select, update, values
 from ..models.utils import Promise
 from ..models.database import (
     ProjectBilling,
@@ -7,8 +12,11 @@ from ..models.database import (
 )
 from ..models.response import CODE, IdData, IdsData, UserProfilesData, BillingData
 from ..connectors import Session, ADMIN_URL
-from ..telemetry.capture_key import get_int_key, capture_int_key
+from ..cache import SingleFlight
+from ..telemetry.capture_key import get_int_keys, int_key, capture_int_keys
 from ..env import (
+    CONFIG,
+    LOG,
     TelemetryKeyName,
     USAGE_TOKEN_LIMIT_MAP,
     BILLING_REFILL_AMOUNT_MAP,
@@ -18,44 +26,52 @@ from datetime import datetime, date
 from ..auth import admin_api
 
 
+async def get_month_token_costs(project_id: str) -> list[int]:
+    return await get_int_keys(
+        [
+            int_key(TelemetryKeyName.llm_input_tokens, project_id, in_month=True),
+            int_key(TelemetryKeyName.llm_output_tokens, project_id, in_month=True),
+        ]
+    )
+
+
 async def get_project_billing(project_id: str) -> Promise[BillingData]:
     if ADMIN_URL is not None:
         return await admin_api.get_project_usage(project_id)
 
+    # Read before the session, no other task may use its connection meanwhile
+    this_month_token_costs_in, this_month_token_costs_out = await get_month_token_costs(
+        project_id
+    )
     with Session() as session:
-        billing = (
+        project_billing = (
             session.query(ProjectBilling)
             .filter(ProjectBilling.project_id == project_id)
             .first()
         )
-        if billing is None:
-            return await fallback_billing_data(project_id)
-            # return Promise.reject(CODE.NOT_FOUND, "Billing not found").to_response(
-            #     BillingData
-            # )
-        billing = billing.billing
-
-        this_month_token_costs_in = await get_int_key(
-            TelemetryKeyName.llm_input_tokens, project_id, in_month=True
-        )
-        this_month_token_costs_out = await get_int_key(
-            TelemetryKeyName.llm_output_tokens, project_id, in_month=True
-        )
-        usage_left_this_billing = billing.usage_left
-
-        next_refill_date = billing.next_refill_at
-        today = datetime.now(next_refill_date.tzinfo)
-        if (
-            today > next_refill_date
-            and usage_left_this_billing is not None
-            and BILLING_REFILL_AMOUNT_MAP[BillingStatus.free] is not None
-            and usage_left_this_billing < BILLING_REFILL_AMOUNT_MAP[BillingStatus.free]
-        ):
-            usage_left_this_billing = BILLING_REFILL_AMOUNT_MAP[BillingStatus.free]
-
-            billing.next_refill_at = next_month_first_day()
-            billing.usage_left = usage_left_this_billing
-            session.commit()
+        if project_billing is not None:
+            billing = project_billing.billing
+            usage_left_this_billing = billing.usage_left
+
+            next_refill_date = billing.next_refill_at
+            today = datetime.now(next_refill_date.tzinfo)
+            if (
+                today > next_refill_date
+                and usage_left_this_billing is not None
+                and BILLING_REFILL_AMOUNT_MAP[BillingStatus.free] is not None
+                and usage_left_this_billing
+                < BILLING_REFILL_AMOUNT_MAP[BillingStatus.free]
+            ):
+                usage_left_this_billing = BILLING_REFILL_AMOUNT_MAP[BillingStatus.free]
+
+                billing.next_refill_at = next_month_first_day()
+                billing.usage_left = usage_left_this_billing
+                session.commit()
+    if project_billing is None:
+        return await fallback_billing_data(project_id)
+        # return Promise.reject(CODE.NOT_FOUND, "Billing not found").to_response(
+        #     BillingData
+        # )
     billing_data = BillingData(
         token_left=usage_left_this_billing,
         next_refill_at=next_refill_date,
@@ -67,11 +83,8 @@ async def get_project_billing(project_id: str) -> Promise[BillingData]:
 async def fallback_billing_data(project_id: str) -> Promise[BillingData]:
     from .project import get_project_status
 
-    this_month_token_costs_in = await get_int_key(
-        TelemetryKeyName.llm_input_tokens, project_id, in_month=True
-    )
-    this_month_token_costs_out = await get_int_key(
-        TelemetryKeyName.llm_output_tokens, project_id, in_month=True
+    this_month_token_costs_in, this_month_token_costs_out = await get_month_token_costs(
+        project_id
     )
 
     this_month_token_costs = this_month_token_costs_in + this_month_token_costs_out
@@ -105,30 +118,223 @@ async def fallback_billing_data(project_id: str) -> Promise[BillingData]:
     )
 
 
+@dataclass
+class ProjectQuota:
+    billing: BillingData
+    loaded_at: float
+
+
+# project_id -> the billing last loaded by this worker, charged with the usage of
+# this worker since, so the insert path doesn't read the billing every time
+PROJECT_QUOTAS: dict[str, ProjectQuota] = {}
+PROJECT_QUOTA_SINGLE_FLIGHT = SingleFlight()
+
+
+def charge_project_quota(project_id: str, tokens: int):
+    quota = PROJECT_QUOTAS.get(project_id)
+    if quota is None:
+        return
+    quota.billing.project_token_cost_month += tokens
+    if quota.billing.token_left is not None:
+        quota.billing.token_left -= tokens
+
+
+def near_quota_limit(billing: BillingData) -> bool:
+    return (
+        billing.token_left is not None
+        and billing.token_left < CONFIG.billing_quota_near_limit_tokens
+    )
+
+
+async def load_project_quota(project_id: str) -> Promise[BillingData]:
+    # Not during a flush of this worker, the billing read may or may not see the
+    # usage being flushed, so adding the pending usage could count it twice
+    async with billing_flush_lock():
+        p = await get_project_billing(project_id)
+        if not p.ok():
+            return p
+        billing = p.data()
+        # The usage this worker hasn't flushed yet is not in the loaded billing
+        billing.project_token_cost_month += sum(
+            PENDING_USAGE_COUNTERS.get(project_id, ())
+        )
+        if billing.token_left is not None:
+            billing.token_left -= sum(PENDING_BILLING.get(project_id, ()))
+        PROJECT_QUOTAS[project_id] = ProjectQuota(
+            billing=billing, loaded_at=time.monotonic()
+        )
+    return Promise.resolve(billing)
+
+
+async def refresh_project_quota(project_id: str):
+    try:
+        p = await PROJECT_QUOTA_SINGLE_FLIGHT.do(
+            project_id, lambda: load_project_quota(project_id)
+        )
+        if not p.ok():
+            LOG.warning(f"Failed to refresh quota of {project_id}: {p.msg()}")
+    except Exception as e:
+        LOG.error(f"Error refreshing quota of {project_id}: {e}")
+
+
+async def get_project_quota(project_id: str) -> Promise[BillingData]:
+    """The project's billing for quota checks. Served from memory, a stale state
+    is refreshed in the background, unless the project is near its limit"""
+    if CONFIG.billing_quota_ttl <= 0:
+        return await get_project_billing(project_id)
+    quota = PROJECT_QUOTAS.get(project_id)
+    stale = (
+        quota is None or time.monotonic() - quota.loaded_at > CONFIG.billing_quota_ttl
+    )
+    if quota is None or (stale and near_quota_limit(quota.billing)):
+        return await PROJECT_QUOTA_SINGLE_FLIGHT.do(
+            project_id, lambda: load_project_quota(project_id)
+        )
+    if stale:
+        asyncio.create_task(refresh_project_quota(project_id))
+    return Promise.resolve(quota.billing)
+
+
+# project_id -> [input_tokens, output_tokens] not written yet, per worker. The
+# Redis counters and the billing are flushed separately, so one failing doesn't
+# write the other twice
+PENDING_USAGE_COUNTERS: dict[str, list[int]] = {}
+PENDING_BILLING: dict[str, list[int]] = {}
+# An asyncio.Lock is bound to the event loop it first waits on, so keep one per loop
+BILLING_FLUSH_LOCK_STATE: dict = {"loop": None, "lock": None}
+
+
+def billing_flush_lock() -> asyncio.Lock:
+    """Held while this worker flushes its pending usage"""
+    loop = asyncio.get_running_loop()
+    if BILLING_FLUSH_LOCK_STATE["loop"] is not loop:
+        BILLING_FLUSH_LOCK_STATE["loop"] = loop
+        BILLING_FLUSH_LOCK_STATE["lock"] = asyncio.Lock()
+    return BILLING_FLUSH_LOCK_STATE["lock"]
+
+
+def add_pending_usage(
+    pending: dict[str, list[int]],
+    project_id: str,
+    input_tokens: int,
+    output_tokens: int,
+):
+    usage = pending.setdefault(project_id, [0, 0])
+    usage[0] += input_tokens
+    usage[1] += output_tokens
+
+
+def take_pending_usage(pending: dict[str, list[int]]) -> dict[str, list[int]]:
+    taken = dict(pending)
+    pending.clear()
+    return taken
+
+
 async def project_cost_token_billing(
     project_id: str, input_tokens: int, output_tokens: int
 ) -> Promise[None]:
-    await capture_int_key(
-        TelemetryKeyName.llm_input_tokens, input_tokens, project_id=project_id
-    )
-    await capture_int_key(
-        TelemetryKeyName.llm_output_tokens, output_tokens, project_id=project_id
+    add_pending_usage(PENDING_USAGE_COUNTERS, project_id, input_tokens, output_tokens)
+    add_pending_usage(PENDING_BILLING, project_id, input_tokens, output_tokens)
+    charge_project_quota(project_id, input_tokens + output_tokens)
+    if CONFIG.billing_flush_interval <= 0:
+        return await flush_token_billing()
+    return Promise.resolve(None)
+
+
+def cost_billings(usages: dict[str, int]):
+    """Subtract the usage of many projects from their billings in one statement.
+    Projects sharing a billing are summed first, an UPDATE ... FROM only applies
+    one joined row per target row"""
+    usage = values(
+        column("project_id", VARCHAR), column("cost", Integer), name="usage"
+    ).data(list(usages.items()))
+    billing_costs = (
+        select(ProjectBilling.billing_id, func.sum(usage.c.cost).label("cost"))
+        .join(usage, ProjectBilling.project_id == usage.c.project_id)
+        .group_by(ProjectBilling.billing_id)
+        .subquery()
     )
-    if ADMIN_URL is not None:
-        return await admin_api.cost_project_usage(
-            project_id, input_tokens, output_tokens
-        )
     with Session() as session:
-        _billing = (
-            session.query(ProjectBilling)
-            .filter(ProjectBilling.project_id == project_id)
-            .one_or_none()
+        session.execute(
+            update(Billing)
+            .where(
+                Billing.id == billing_costs.c.billing_id,
+                Billing.usage_left.is_not(None),
+            )
+            .values(usage_left=Billing.usage_left - billing_costs.c.cost)
+            .execution_options(synchronize_session=False)
         )
-        if _billing is None:
-            return Promise.reject(CODE.NOT_FOUND, "Billing not found")
-        billing = _billing.billing
+        session.commit()
+
+
+async def flush_token_billing() -> Promise[None]:
+    async with billing_flush_lock():
+        return await flush_pending_usage()
+
+
+async def flush_pending_usage() -> Promise[None]:
+    counters = take_pending_usage(PENDING_USAGE_COUNTERS)
+    if counters:
+        counts = []
+        for project_id, (input_tokens, output_tokens) in counters.items():
+            counts.append((TelemetryKeyName.llm_input_tokens, project_id, input_tokens))
+            counts.append(
+                (TelemetryKeyName.llm_output_tokens, project_id, output_tokens)
+            )
+        try:
+            await capture_int_keys(counts)
+        except BaseException as e:
+            for project_id, usage in counters.items():
+                add_pending_usage(PENDING_USAGE_COUNTERS, project_id, *usage)
+            if not isinstance(e, Exception):
+                # Cancelled, the usage is left for the next flush
+                raise
+            LOG.error(f"Failed to flush token usage counters: {e}")
+            return Promise.reject(
+                CODE.SERVICE_UNAVAILABLE, f"Failed to flush token usage counters: {e}"
+            )
 
-        if billing.usage_left is not None:
-            billing.usage_left -= input_tokens + output_tokens
-            session.commit()
+    billings = take_pending_usage(PENDING_BILLING)
+    if not billings:
+        return Promise.resolve(None)
+    if ADMIN_URL is not None:
+        failed = None
+        remaining = dict(billings)
+        try:
+            for project_id, usage in billings.items():
+                p = await admin_api.cost_project_usage(project_id, *usage)
+                del remaining[project_id]
+                if not p.ok():
+                    add_pending_usage(PENDING_BILLING, project_id, *usage)
+                    failed = p
+        except BaseException:
+            for project_id, usage in remaining.items():
+                add_pending_usage(PENDING_BILLING, project_id, *usage)
+            raise
+        if failed is not None:
+            LOG.error(f"Failed to flush project billing: {failed.msg()}")
+            return failed
+        return Promise.resolve(None)
+    try:
+        cost_billings(
+            {project_id: sum(usage) for project_id, usage in billings.items()}
+        )
+    except BaseException as e:
+        for project_id, usage in billings.items():
+            add_pending_usage(PENDING_BILLING, project_id, *usage)
+        if not isinstance(e, Exception):
+            raise
+        LOG.error(f"Failed to flush project billing: {e}")
+        return Promise.reject(
+            CODE.SERVICE_UNAVAILABLE, f"Failed to flush project billing: {e}"
+        )
     return Promise.resolve(None)
+
+
+async def token_billing_flush_loop():
+    while True:
+        await asyncio.sleep(CONFIG.billing_flush_interval)
+        try:
+            await flush_token_billing()
+        except Exception as e:
+            LOG.error(f"Error in token billing flush: {e}\n{traceback.format_exc()}")
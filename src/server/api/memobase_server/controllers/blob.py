@@ -1,9 +1,10 @@
 import pydantic
+from sqlalchemy import select
 from ..models.utils import Promise
 from ..models.database import GeneralBlob, DEFAULT_PROJECT_ID
 from ..models.response import CODE, BlobData, IdData
 from ..models.blob import ChatBlob, DocBlob, BlobType
-from ..connectors import Session
+from ..connectors import Session, ReadSession, mark_recent_write, use_read_replica
 
 
 async def insert_blob(user_id: str, project_id: str, blob: BlobData) -> Promise[IdData]:
@@ -22,28 +23,38 @@ async def insert_blob(user_id: str, project_id: str, blob: BlobData) -> Promise[
         session.add(blob_db)
         session.commit()
         b_id = blob_db.id
+    await mark_recent_write(user_id, project_id)
     return Promise.resolve(IdData(id=b_id))
 
 
 async def get_blob(user_id: str, project_id: str, blob_id: str) -> Promise[BlobData]:
-    with Session() as session:
-        blob_db = (
-            session.query(GeneralBlob)
-            .filter_by(id=blob_id, user_id=user_id, project_id=project_id)
-            .one_or_none()
-        )
-        if not blob_db:
-            return Promise.reject(
-                CODE.NOT_FOUND, f"Blob with id {blob_id} of user {user_id} not found"
+    with ReadSession(await use_read_replica(user_id, project_id)) as session:
+        row = session.execute(
+            select(
+                GeneralBlob.blob_type,
+                GeneralBlob.blob_data,
+                GeneralBlob.additional_fields,
+                GeneralBlob.created_at,
+                GeneralBlob.updated_at,
+            ).where(
+                GeneralBlob.id == blob_id,
+                GeneralBlob.user_id == user_id,
+                GeneralBlob.project_id == project_id,
             )
-        rt_blob = BlobData(
-            blob_type=BlobType(blob_db.blob_type),
-            blob_data=blob_db.blob_data,
-            fields=blob_db.additional_fields,
-            created_at=blob_db.created_at,
-            updated_at=blob_db.updated_at,
+        ).one_or_none()
+    if row is None:
+        return Promise.reject(
+            CODE.NOT_FOUND, f"Blob with id {blob_id} of user {user_id} not found"
         )
-        return Promise.resolve(rt_blob)
+    # Trusted row of the database, built without validation
+    rt_blob = BlobData.model_construct(
+        blob_type=BlobType(row.blob_type),
+        blob_data=row.blob_data,
+        fields=row.additional_fields,
+        created_at=row.created_at,
+        updated_at=row.updated_at,
+    )
+    return Promise.resolve(rt_blob)
 
 
 async def remove_blob(user_id: str, project_id: str, blob_id: str) -> Promise[None]:
@@ -58,4 +69,5 @@ async def remove_blob(user_id: str, project_id: str, blob_id: str) -> Promise[No
         else:
             session.delete(blob_db)
             session.commit()
+    await mark_recent_write(user_id, project_id)
     return Promise.resolve(None)
@@ -1,3 +1,4 @@
+import asyncio
 from sqlalchemy import func
 from pydantic import BaseModel
 from ..env import CONFIG, BufferStatus, TRACE_LOG
@@ -11,6 +12,7 @@ from ..models.database import BufferZone, GeneralBlob
 from ..models.blob import BlobType, Blob
 from ..connectors import Session, log_pool_status
 from .modal import BLOBS_PROCESS
+from .context import prewarm_user_context
 
 
 async def get_buffer_capacity(
@@ -33,12 +35,13 @@ async def get_buffer_capacity(
 async def insert_blob_to_buffer(
     user_id: str, project_id: str, blob_id: str, blob_data: Blob
 ) -> Promise[None]:
+    token_size = await get_blob_token_size(blob_data)
     with Session() as session:
         buffer = BufferZone(
             user_id=user_id,
             blob_id=blob_id,
             blob_type=blob_data.type,
-            token_size=get_blob_token_size(blob_data),
+            token_size=token_size,
             project_id=project_id,
             status=BufferStatus.idle,
         )
@@ -219,6 +222,8 @@ async def flush_buffer_by_ids(
                     user_id,
                     f"Flushed {blob_type} buffer(size: {len(buffer_blob_data)})",
                 )
+                if CONFIG.cache_user_context_prewarm:
+                    asyncio.create_task(prewarm_user_context(user_id, project_id))
             except Exception as e:
                 session.rollback()
                 TRACE_LOG.error(
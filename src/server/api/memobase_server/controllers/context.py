@@ -1,12 +1,71 @@
+import json
+import asyncio
+from typing import Awaitable
+import hashlib
 from ..models.utils import Promise
-from ..models.response import ContextData, OpenAICompatibleMessage
+from ..models.response import ContextData, OpenAICompatibleMessage, UserEventsData
 from ..prompts.chat_context_pack import CONTEXT_PROMPT_PACK
-from ..utils import get_encoded_tokens, event_str_repr
+from ..utils import event_str_repr, profile_str_repr
 from ..env import CONFIG, TRACE_LOG
-from .project import get_project_profile_config
-from .profile import get_user_profiles, truncate_profiles
-from .post_process.profile import filter_profiles_with_chats
-from .event import get_user_events, search_user_events, truncate_events
+from ..telemetry import telemetry_manager, CounterMetricName
+from ..connectors import get_redis_client
+from .project import get_project_profile_config, project_context_version_key
+from .profile import (
+    get_user_profiles,
+    truncate_profiles,
+    profile_token_count,
+    user_profiles_version_key,
+)
+from .post_process.profile import (
+    ProfileFilterMode,
+    filter_profiles_with_chats,
+    rank_profiles_with_chats,
+)
+from .event import (
+    get_user_events,
+    search_user_events,
+    truncate_events,
+    event_token_count,
+    user_events_version_key,
+)
+
+DEFAULT_CONTEXT_PARAMS = {
+    "max_token_size": 1000,
+    "prefer_topics": None,
+    "only_topics": None,
+    "max_subtopic_size": None,
+    "topic_limits": {},
+    "profile_event_ratio": 0.6,
+    "require_event_summary": False,
+    "chats": [],
+    "event_similarity_threshold": 0.2,
+    "fast_event_query": False,
+    "profile_filter_mode": "llm",
+}
+# The separator before each line of a section, "- " or a newline
+SECTION_LINE_SEPARATOR_TOKENS = 1
+
+
+def user_context_cache_key(
+    user_id: str,
+    project_id: str,
+    profiles_version: str | None,
+    events_version: str | None,
+    config_version: str | None,
+    params_hash: str,
+) -> str:
+    return (
+        f"user_context::{project_id}::{user_id}::"
+        f"{profiles_version or 0}::{events_version or 0}::{config_version or 0}::"
+        f"{params_hash}"
+    )
+
+
+def context_params_hash(chats: list[OpenAICompatibleMessage], **params) -> str:
+    params["chats"] = [c.model_dump(mode="json") for c in chats]
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
 
 
 async def get_user_context(
@@ -21,107 +80,298 @@ async def get_user_context(
     require_event_summary: bool,
     chats: list[OpenAICompatibleMessage],
     event_similarity_threshold: float,
+    fast_event_query: bool = False,
+    profile_filter_mode: ProfileFilterMode = "llm",
+    timeout_ms: int | None = None,
 ) -> Promise[ContextData]:
-    assert 0 < profile_event_ratio <= 1, "profile_event_ratio must be between 0 and 1"
-    max_profile_token_size = int(max_token_size * profile_event_ratio)
-    add_query_context = None
-    # max_event_token_size = max_token_size - max_profile_token_size
+    params = dict(
+        max_token_size=max_token_size,
+        prefer_topics=prefer_topics,
+        only_topics=only_topics,
+        max_subtopic_size=max_subtopic_size,
+        topic_limits=topic_limits,
+        profile_event_ratio=profile_event_ratio,
+        require_event_summary=require_event_summary,
+        event_similarity_threshold=event_similarity_threshold,
+        fast_event_query=fast_event_query,
+        profile_filter_mode=profile_filter_mode,
+    )
+    if CONFIG.cache_user_context_ttl <= 0:
+        return await build_user_context(
+            user_id, project_id, chats=chats, timeout_ms=timeout_ms, **params
+        )
 
-    p = await get_project_profile_config(project_id)
-    if not p.ok():
-        return p
-    profile_config = p.data()
-    use_language = profile_config.language or CONFIG.language
-    context_prompt_func = CONTEXT_PROMPT_PACK[use_language]
+    # Any profile, event or project profile config update bumps a version, so a
+    # cached context is never served after the data it was built from changed
+    async with get_redis_client() as redis_client:
+        profiles_version, events_version, config_version = await redis_client.mget(
+            user_profiles_version_key(user_id, project_id),
+            user_events_version_key(user_id, project_id),
+            project_context_version_key(project_id),
+        )
+        cache_key = user_context_cache_key(
+            user_id,
+            project_id,
+            profiles_version,
+            events_version,
+            config_version,
+            context_params_hash(chats, **params),
+        )
+        context = await redis_client.get(cache_key)
+    if context is not None:
+        return Promise.resolve(ContextData(context=context))
 
-    p = await get_user_profiles(user_id, project_id)
-    if not p.ok():
-        return p
-    total_profiles = p.data()
-    if max_profile_token_size > 0:
-        if chats:
-            p = await filter_profiles_with_chats(
-                user_id,
-                project_id,
-                total_profiles,
-                chats,
-                only_topics=only_topics,
-                # max_filter_num=topk,
+    # Built from the primary: a lagging replica would cache a stale context
+    # under the current versions
+    p = await build_user_context(
+        user_id,
+        project_id,
+        chats=chats,
+        timeout_ms=timeout_ms,
+        replica=False,
+        **params,
+    )
+    # A degraded context is only good enough for this deadline, don't cache it
+    if p.ok() and not p.data().degraded_stages:
+        async with get_redis_client() as redis_client:
+            await redis_client.set(
+                cache_key, p.data().context, ex=CONFIG.cache_user_context_ttl
             )
-            if p.ok():
-                total_profiles.profiles = p.data()["profiles"]
-                add_query_context = p.data()
-        user_profiles = total_profiles
-        use_profiles = await truncate_profiles(
-            user_profiles,
-            prefer_topics=prefer_topics,
-            only_topics=only_topics,
-            max_token_size=max_profile_token_size,
-            max_subtopic_size=max_subtopic_size,
-            topic_limits=topic_limits,
+    return p
+
+
+async def prewarm_user_context(user_id: str, project_id: str) -> Promise[None]:
+    """Build the context for the default parameters of /users/context, so the
+    common call after a flush is a single cache read"""
+    p = await get_user_context(user_id, project_id, **DEFAULT_CONTEXT_PARAMS)
+    if not p.ok():
+        TRACE_LOG.warning(
+            project_id, user_id, f"Failed to prewarm user context: {p.msg()}"
         )
-        if not use_profiles.ok():
-            return use_profiles
-        use_profiles = use_profiles.data().profiles
+        return p
+    return Promise.resolve(None)
+
 
-        profile_section = "- " + "\n- ".join(
+def event_search_query(
+    chats: list[OpenAICompatibleMessage], filtered_profiles: list | None = None
+) -> str:
+    search_query = chats[-1].content
+    if filtered_profiles:
+        profoile_q = "\n".join(
             [
-                f"{p.attributes.get('topic')}::{p.attributes.get('sub_topic')}: {p.content}"
-                for p in use_profiles
+                f"- {fp.attributes['topic']}::{fp.attributes['sub_topic']}"
+                for fp in filtered_profiles
             ]
         )
-    else:
-        profile_section = ""
+        search_query = f"{profoile_q}\n---\n{search_query}"
+    return search_query
 
-    profile_section_tokens = len(get_encoded_tokens(profile_section))
-    max_event_token_size = min(
-        max_token_size - profile_section_tokens, max_token_size - max_profile_token_size
-    )
-    if max_event_token_size <= 0:
-        return Promise.resolve(
-            ContextData(context=context_prompt_func(profile_section, ""))
-        )
 
-    # max 40 events, then truncate to max_event_token_size
-    if chats and CONFIG.enable_event_embedding:
-        search_query = chats[-1].content
-        if add_query_context:
-            filter_profiles = add_query_context["profiles"]
-            profoile_q = "\n".join(
-                [
-                    f"- {fp.attributes['topic']}::{fp.attributes['sub_topic']}"
-                    for fp in filter_profiles
-                ]
+async def build_user_context(
+    user_id: str,
+    project_id: str,
+    max_token_size: int,
+    prefer_topics: list[str],
+    only_topics: list[str],
+    max_subtopic_size: int,
+    topic_limits: dict[str, int],
+    profile_event_ratio: float,
+    require_event_summary: bool,
+    chats: list[OpenAICompatibleMessage],
+    event_similarity_threshold: float,
+    fast_event_query: bool = False,
+    profile_filter_mode: ProfileFilterMode = "llm",
+    timeout_ms: int | None = None,
+    replica: bool = True,
+) -> Promise[ContextData]:
+    assert 0 < profile_event_ratio <= 1, "profile_event_ratio must be between 0 and 1"
+    max_profile_token_size = int(max_token_size * profile_event_ratio)
+    # max_event_token_size = max_token_size - max_profile_token_size
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_ms / 1000 if timeout_ms else None
+    degraded_stages: list[str] = []
+
+    async def within_deadline(stage: str, aw: Awaitable[Promise]) -> Promise | None:
+        """Await a stage that can be skipped, None when it overran the deadline"""
+        if deadline is None:
+            return await aw
+        try:
+            return await asyncio.wait_for(aw, timeout=deadline - loop.time())
+        except asyncio.TimeoutError:
+            degraded_stages.append(stage)
+            telemetry_manager.increment_counter_metric(
+                CounterMetricName.CONTEXT_DEGRADED,
+                1,
+                {"project_id": project_id, "stage": stage},
             )
-            search_query = f"{profoile_q}\n---\n{search_query}"
-        p = await search_user_events(
+            TRACE_LOG.warning(
+                project_id,
+                user_id,
+                f"Context stage {stage} overran the {timeout_ms}ms deadline",
+            )
+            return None
+
+    def recent_events() -> Awaitable[Promise[UserEventsData]]:
+        return get_user_events(
             user_id,
             project_id,
-            query=search_query,
             topk=20,
-            similarity_threshold=event_similarity_threshold,
+            need_summary=require_event_summary,
+            replica=replica,
         )
+
+    def search_events(search_query: str) -> asyncio.Task:
+        # max 40 events, then truncate to max_event_token_size
+        return asyncio.create_task(
+            search_user_events(
+                user_id,
+                project_id,
+                query=search_query,
+                topk=20,
+                similarity_threshold=event_similarity_threshold,
+                replica=replica,
+            )
+        )
+
+    # Start every stage that doesn't depend on another one at once, so the
+    # latency is the slowest stage instead of the sum of them
+    config_task = asyncio.create_task(get_project_profile_config(project_id))
+    topic_filters = dict(only_topics=only_topics)
+    if not chats:
+        # No chat filter runs in between, the topic limits apply when loading
+        topic_filters.update(
+            max_subtopic_size=max_subtopic_size, topic_limits=topic_limits
+        )
+    profiles_task = asyncio.create_task(
+        get_user_profiles(user_id, project_id, **topic_filters, replica=replica)
+    )
+    use_event_search = bool(chats) and CONFIG.enable_event_embedding
+    if not use_event_search:
+        events_task = asyncio.create_task(recent_events())
+    elif fast_event_query or max_profile_token_size <= 0:
+        # Don't wait for the profile filter, search with the last message only
+        events_task = search_events(event_search_query(chats))
     else:
-        p = await get_user_events(
-            user_id,
+        events_task = None
+
+    try:
+        p = await config_task
+        if not p.ok():
+            return p
+        profile_config = p.data()
+        use_language = profile_config.language or CONFIG.language
+        context_prompt_func = CONTEXT_PROMPT_PACK[use_language]
+
+        p = await profiles_task
+        if not p.ok():
+            return p
+        total_profiles = p.data()
+        use_profiles = []
+        if max_profile_token_size > 0:
+            if chats:
+                # On timeout, keep all the profiles in the order of truncate_profiles
+                if profile_filter_mode == "llm":
+                    pick_profiles = filter_profiles_with_chats(
+                        user_id,
+                        project_id,
+                        total_profiles,
+                        chats,
+                        only_topics=only_topics,
+                        # max_filter_num=topk,
+                    )
+                else:
+                    pick_profiles = rank_profiles_with_chats(
+                        user_id,
+                        project_id,
+                        total_profiles,
+                        chats,
+                        only_topics=only_topics,
+                        rerank=profile_filter_mode == "embedding_rerank",
+                    )
+                p = await within_deadline("profile_filter", pick_profiles)
+                filtered_profiles = None
+                if p is not None and p.ok():
+                    total_profiles.profiles = p.data()["profiles"]
+                    filtered_profiles = p.data()["profiles"]
+                elif p is not None and total_profiles.profiles:
+                    TRACE_LOG.warning(
+                        project_id,
+                        user_id,
+                        f"Profile filter {profile_filter_mode} failed, "
+                        f"keeping all profiles: {p.msg()}",
+                    )
+                if events_task is None:
+                    # Falls back to the last message when the filter failed or timed out
+                    events_task = search_events(
+                        event_search_query(chats, filtered_profiles)
+                    )
+            user_profiles = total_profiles
+            use_profiles = await truncate_profiles(
+                user_profiles,
+                prefer_topics=prefer_topics,
+                only_topics=only_topics,
+                max_token_size=max_profile_token_size,
+                max_subtopic_size=max_subtopic_size,
+                topic_limits=topic_limits,
+            )
+            if not use_profiles.ok():
+                return use_profiles
+            use_profiles = use_profiles.data().profiles
+
+            profile_section = "- " + "\n- ".join(
+                [profile_str_repr(p.content, p.attributes) for p in use_profiles]
+            )
+        else:
+            profile_section = ""
+
+        # Summed from the counts stored on write, no tokenizer on the read path
+        profile_section_tokens = sum(
+            profile_token_count(p) + SECTION_LINE_SEPARATOR_TOKENS for p in use_profiles
+        )
+        max_event_token_size = min(
+            max_token_size - profile_section_tokens,
+            max_token_size - max_profile_token_size,
+        )
+        if max_event_token_size <= 0:
+            return Promise.resolve(
+                ContextData(
+                    context=context_prompt_func(profile_section, ""),
+                    degraded_stages=degraded_stages or None,
+                )
+            )
+
+        if use_event_search:
+            p = await within_deadline("event_search", events_task)
+            if p is None:
+                # Fall back to the latest events, no embedding call needed
+                p = await recent_events()
+        else:
+            p = await events_task
+        if not p.ok():
+            return p
+        user_events = p.data()
+        p = await truncate_events(user_events, max_event_token_size)
+        if not p.ok():
+            return p
+        user_events = p.data()
+        event_section = "\n".join([event_str_repr(ed) for ed in user_events.events])
+        event_section_tokens = sum(
+            event_token_count(e) + SECTION_LINE_SEPARATOR_TOKENS
+            for e in user_events.events
+        )
+        TRACE_LOG.info(
             project_id,
-            topk=20,
-            need_summary=require_event_summary,
+            user_id,
+            f"Retrived {len(use_profiles)} profiles({profile_section_tokens} tokens), {len(user_events.events)} events({event_section_tokens} tokens)",
         )
-    if not p.ok():
-        return p
-    user_events = p.data()
-    p = await truncate_events(user_events, max_event_token_size)
-    if not p.ok():
-        return p
-    user_events = p.data()
-    event_section = "\n".join([event_str_repr(ed) for ed in user_events.events])
-    event_section_tokens = len(get_encoded_tokens(event_section))
-    TRACE_LOG.info(
-        project_id,
-        user_id,
-        f"Retrived {len(use_profiles)} profiles({profile_section_tokens} tokens), {len(user_events.events)} events({event_section_tokens} tokens)",
-    )
-    return Promise.resolve(
-        ContextData(context=context_prompt_func(profile_section, event_section))
-    )
+        return Promise.resolve(
+            ContextData(
+                context=context_prompt_func(profile_section, event_section),
+                degraded_stages=degraded_stages or None,
+            )
+        )
+    finally:
+        # Stages that are no longer needed after an early return
+        for task in (config_task, profiles_task, events_task):
+            if task is not None and not task.done():
+                task.cancel()
@@ -1,15 +1,56 @@
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Literal
 from pydantic import ValidationError
-from ..models.database import UserEvent
+from ..models.database import UserEvent, EVENT_SEARCH_TS_CONFIG
 from ..models.response import UserEventData, UserEventsData, EventData
 from ..models.utils import Promise, CODE
-from ..connectors import Session
-from ..utils import get_encoded_tokens, event_str_repr, event_embedding_str
+from ..connectors import Session, ReadSession, mark_recent_write, use_read_replica
+from ..cache import bump_version
+from ..utils import (
+    count_tokens,
+    event_str_repr,
+    event_data_str_repr,
+    event_embedding_str,
+)
 
 from ..llms.embeddings import get_embedding
 from datetime import timedelta
-from sqlalchemy import desc, select
+from sqlalchemy import desc, select, cast, TEXT
 from sqlalchemy.sql import func
 from ..env import TRACE_LOG, CONFIG
+from ..types import attribute_unify
+
+USER_EVENTS_VERSION_TTL = 60 * 60 * 24
+EventSearchMode = Literal["auto", "vector", "lexical", "hybrid"]
+# Reciprocal Rank Fusion constant, 60 is the value from the original RRF paper
+RRF_K = 60
+HYBRID_CANDIDATE_FACTOR = 4
+
+
+def event_tag_filters(
+    tags: list[str] | None = None, tag_values: dict[str, str] | None = None
+) -> tuple:
+    """Containment predicate on event_data, served by the jsonb_path_ops GIN index"""
+    required_tags = [{"tag": attribute_unify(t)} for t in tags or []]
+    required_tags.extend(
+        {"tag": attribute_unify(t), "value": v} for t, v in (tag_values or {}).items()
+    )
+    if not required_tags:
+        return ()
+    return (UserEvent.event_data.contains({"event_tags": required_tags}),)
+
+
+def user_events_version_key(user_id: str, project_id: str) -> str:
+    return f"user_events_version::{project_id}::{user_id}"
+
+
+async def bump_user_events_version(user_id: str, project_id: str) -> int:
+    await mark_recent_write(user_id, project_id)
+    # Part of the cached context keys, see controllers/context.py
+    return await bump_version(
+        user_events_version_key(user_id, project_id), USER_EVENTS_VERSION_TTL
+    )
 
 
 async def get_user_events(
@@ -17,48 +58,92 @@ async def get_user_events(
     project_id: str,
     topk: int = 10,
     need_summary: bool = False,
+    tags: list[str] | None = None,
+    tag_values: dict[str, str] | None = None,
+    replica: bool = True,
 ) -> Promise[UserEventsData]:
-    with Session() as session:
-        query = session.query(UserEvent).filter_by(
-            user_id=user_id, project_id=project_id
-        )
-        if need_summary:
-            query = query.filter(
-                UserEvent.event_data.contains({"event_tip": None}).is_(False)
-            ).filter(UserEvent.event_data.has_key("event_tip"))
-        user_events = query.order_by(UserEvent.created_at.desc()).limit(topk).all()
-        if user_events is None:
-            return Promise.resolve(UserEventsData(events=[]))
-        results = [
-            {
-                "id": ue.id,
-                "event_data": ue.event_data,
-                "created_at": ue.created_at,
-                "updated_at": ue.updated_at,
-            }
-            for ue in user_events
+    stmt = select(
+        UserEvent.id,
+        UserEvent.event_data,
+        UserEvent.created_at,
+        UserEvent.updated_at,
+        UserEvent.token_count,
+    ).where(
+        UserEvent.user_id == user_id,
+        UserEvent.project_id == project_id,
+        UserEvent.digest_id.is_(None),
+        *event_tag_filters(tags, tag_values),
+    )
+    if need_summary:
+        # served by the partial (user_id, project_id, created_at DESC) index
+        stmt = stmt.where(UserEvent.has_event_tip)
+    stmt = stmt.order_by(UserEvent.created_at.desc()).limit(topk)
+    replica = replica and await use_read_replica(user_id, project_id)
+    with ReadSession(replica) as session:
+        rows = session.execute(stmt).all()
+    # Trusted rows of the database, built without validation. event_data is
+    # still parsed, its nested models are read by event_str_repr
+    events = UserEventsData.model_construct(
+        events=[
+            UserEventData.model_construct(
+                id=row.id,
+                event_data=EventData.model_validate(row.event_data),
+                created_at=row.created_at,
+                updated_at=row.updated_at,
+                token_count=row.token_count,
+            )
+            for row in rows
         ]
-    events = UserEventsData(events=results)
+    )
     return Promise.resolve(events)
 
 
+def event_token_count(event: UserEventData) -> int:
+    if event.token_count is not None:
+        return event.token_count
+    # Events written before token counts were stored
+    return count_tokens(event_str_repr(event))
+
+
 async def truncate_events(
     events: UserEventsData,
     max_token_size: int | None,
 ) -> Promise[UserEventsData]:
     if max_token_size is None:
         return Promise.resolve(events)
-    c_tokens = 0
-    truncated_results = []
-    for r in events.events:
-        c_tokens += len(get_encoded_tokens(event_str_repr(r)))
-        if c_tokens > max_token_size:
-            break
-        truncated_results.append(r)
-    events.events = truncated_results
+    token_sums = list(accumulate(event_token_count(e) for e in events.events))
+    events.events = events.events[: bisect_right(token_sums, max_token_size)]
     return Promise.resolve(events)
 
 
+async def get_event_embedding(user_id: str, project_id: str, event_data: EventData):
+    if not CONFIG.enable_event_embedding:
+        return None
+    embedding = await get_embedding(
+        project_id,
+        [event_embedding_str(event_data)],
+        phase="document",
+        model=CONFIG.embedding_model,
+    )
+    if not embedding.ok():
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"Failed to get embeddings: {embedding.msg()}",
+        )
+        return None
+    embedding = embedding.data()
+    embedding_dim_current = embedding.shape[-1]
+    if embedding_dim_current != CONFIG.embedding_dim:
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"Embedding dimension mismatch! Expected {CONFIG.embedding_dim}, got {embedding_dim_current}.",
+        )
+        return None
+    return embedding[0]
+
+
 async def append_user_event(
     user_id: str, project_id: str, event_data: dict
 ) -> Promise[str]:
@@ -75,44 +160,20 @@ async def append_user_event(
             f"Invalid event data: {str(e)}",
         )
 
-    if CONFIG.enable_event_embedding:
-        event_data_str = event_embedding_str(validated_event)
-        embedding = await get_embedding(
-            project_id,
-            [event_data_str],
-            phase="document",
-            model=CONFIG.embedding_model,
-        )
-        if not embedding.ok():
-            TRACE_LOG.error(
-                project_id,
-                user_id,
-                f"Failed to get embeddings: {embedding.msg()}",
-            )
-            embedding = [None]
-        else:
-            embedding = embedding.data()
-            embedding_dim_current = embedding.shape[-1]
-            if embedding_dim_current != CONFIG.embedding_dim:
-                TRACE_LOG.error(
-                    project_id,
-                    user_id,
-                    f"Embedding dimension mismatch! Expected {CONFIG.embedding_dim}, got {embedding_dim_current}.",
-                )
-                embedding = [None]
-    else:
-        embedding = [None]
+    embedding = await get_event_embedding(user_id, project_id, validated_event)
 
     with Session() as session:
         user_event = UserEvent(
             user_id=user_id,
             project_id=project_id,
             event_data=validated_event.model_dump(),
-            embedding=embedding[0],
+            embedding=embedding,
+            token_count=count_tokens(event_data_str_repr(validated_event)),
         )
         session.add(user_event)
         session.commit()
         eid = user_event.id
+    await bump_user_events_version(user_id, project_id)
     return Promise.resolve(eid)
 
 
@@ -132,6 +193,7 @@ async def delete_user_event(
             )
         session.delete(user_event)
         session.commit()
+    await bump_user_events_version(user_id, project_id)
     return Promise.resolve(None)
 
 
@@ -161,10 +223,143 @@ async def update_user_event(
         new_events.update(need_to_update)
 
         user_event.event_data = new_events
+        user_event.token_count = count_tokens(
+            event_data_str_repr(EventData(**new_events))
+        )
         session.commit()
+    await bump_user_events_version(user_id, project_id)
     return Promise.resolve(None)
 
 
+def event_window_filters(user_id: str, project_id: str, time_range_in_days: int):
+    return (
+        UserEvent.user_id == user_id,
+        UserEvent.project_id == project_id,
+        UserEvent.created_at > func.now() - timedelta(days=time_range_in_days),
+        UserEvent.digest_id.is_(None),
+    )
+
+
+def lexical_tsquery(query: str):
+    # plainto_tsquery ANDs every term, which almost never matches a chat message.
+    # OR the terms instead and let ts_rank_cd reward events matching more of them.
+    return func.to_tsquery(
+        EVENT_SEARCH_TS_CONFIG,
+        func.replace(
+            cast(func.plainto_tsquery(EVENT_SEARCH_TS_CONFIG, query), TEXT),
+            " & ",
+            " | ",
+        ),
+    )
+
+
+def vector_search_stmt(
+    filters: tuple, query_embedding, topk: int, similarity_threshold: float
+):
+    similarity = 1 - UserEvent.embedding.cosine_distance(query_embedding)
+    return (
+        select(
+            UserEvent.id,
+            UserEvent.event_data,
+            UserEvent.created_at,
+            UserEvent.updated_at,
+            UserEvent.token_count,
+            similarity.label("similarity"),
+        )
+        .where(*filters)
+        .where(similarity > similarity_threshold)
+        .order_by(desc("similarity"))
+        .limit(topk)
+    )
+
+
+def lexical_search_stmt(filters: tuple, query: str, topk: int):
+    tsquery = lexical_tsquery(query)
+    # normalization 32 scales the rank into [0, 1)
+    rank = func.ts_rank_cd(UserEvent.event_tsv, tsquery, 32)
+    return (
+        select(
+            UserEvent.id,
+            UserEvent.event_data,
+            UserEvent.created_at,
+            UserEvent.updated_at,
+            UserEvent.token_count,
+            rank.label("similarity"),
+        )
+        .where(*filters)
+        .where(UserEvent.event_tsv.op("@@")(tsquery))
+        .order_by(desc("similarity"))
+        .limit(topk)
+    )
+
+
+def hybrid_search_stmt(
+    filters: tuple,
+    query: str,
+    query_embedding,
+    topk: int,
+    similarity_threshold: float,
+):
+    """Fuse vector and lexical ranks with Reciprocal Rank Fusion in one statement"""
+    candidates = topk * HYBRID_CANDIDATE_FACTOR
+    distance = UserEvent.embedding.cosine_distance(query_embedding)
+    vector_ranked = (
+        select(
+            UserEvent.id.label("id"),
+            func.row_number().over(order_by=distance).label("rank"),
+        )
+        .where(*filters)
+        .where(1 - distance > similarity_threshold)
+        .order_by(distance)
+        .limit(candidates)
+        .cte("vector_ranked")
+    )
+    tsquery = lexical_tsquery(query)
+    lexical_rank = func.ts_rank_cd(UserEvent.event_tsv, tsquery, 32)
+    lexical_ranked = (
+        select(
+            UserEvent.id.label("id"),
+            func.row_number().over(order_by=lexical_rank.desc()).label("rank"),
+        )
+        .where(*filters)
+        .where(UserEvent.event_tsv.op("@@")(tsquery))
+        .order_by(lexical_rank.desc())
+        .limit(candidates)
+        .cte("lexical_ranked")
+    )
+    fused = (
+        select(
+            func.coalesce(vector_ranked.c.id, lexical_ranked.c.id).label("id"),
+            (
+                func.coalesce(1.0 / (RRF_K + vector_ranked.c.rank), 0.0)
+                + func.coalesce(1.0 / (RRF_K + lexical_ranked.c.rank), 0.0)
+            ).label("score"),
+        )
+        .select_from(
+            vector_ranked.join(
+                lexical_ranked,
+                vector_ranked.c.id == lexical_ranked.c.id,
+                full=True,
+            )
+        )
+        .cte("fused")
+    )
+    return (
+        select(
+            UserEvent.id,
+            UserEvent.event_data,
+            UserEvent.created_at,
+            UserEvent.updated_at,
+            UserEvent.token_count,
+            fused.c.score.label("similarity"),
+        )
+        .join(fused, UserEvent.id == fused.c.id)
+        .where(*filters)
+        .order_by(desc("similarity"))
+        .limit(topk)
+    )
+
+
 async def search_user_events(
     user_id: str,
     project_id: str,
@@ -172,65 +367,64 @@ async def search_user_events(
     topk: int = 10,
     similarity_threshold: float = 0.2,
     time_range_in_days: int = 21,
+    search_mode: EventSearchMode = "auto",
+    tags: list[str] | None = None,
+    tag_values: dict[str, str] | None = None,
+    replica: bool = True,
 ) -> Promise[UserEventsData]:
-    if not CONFIG.enable_event_embedding:
+    if search_mode == "auto":
+        search_mode = "vector" if CONFIG.enable_event_embedding else "lexical"
+    if search_mode in ("vector", "hybrid") and not CONFIG.enable_event_embedding:
         return Promise.reject(
             CODE.NOT_IMPLEMENTED,
-            "Event embedding is not enabled",
+            f"Event embedding is not enabled, {search_mode} search is unavailable",
         )
 
-    query_embeddings = await get_embedding(
-        project_id, [query], phase="query", model=CONFIG.embedding_model
-    )
-    if not query_embeddings.ok():
-        TRACE_LOG.error(
-            project_id,
-            user_id,
-            f"Failed to get embeddings: {query_embeddings.msg()}",
-        )
-        return query_embeddings
-    query_embedding = query_embeddings.data()[0]
-
-    stmt = (
-        select(
-            UserEvent,
-            (1 - UserEvent.embedding.cosine_distance(query_embedding)).label(
-                "similarity"
-            ),
-        )
-        .where(UserEvent.user_id == user_id, UserEvent.project_id == project_id)
-        .where(UserEvent.created_at > func.now() - timedelta(days=time_range_in_days))
-        .where(
-            (1 - UserEvent.embedding.cosine_distance(query_embedding))
-            > similarity_threshold
+    filters = event_window_filters(
+        user_id, project_id, time_range_in_days
+    ) + event_tag_filters(tags, tag_values)
+    if search_mode == "lexical":
+        stmt = lexical_search_stmt(filters, query, topk)
+    else:
+        query_embeddings = await get_embedding(
+            project_id, [query], phase="query", model=CONFIG.embedding_model
         )
-        .order_by(desc("similarity"))
-        .limit(topk)
-    )
+        if not query_embeddings.ok():
+            TRACE_LOG.error(
+                project_id,
+                user_id,
+                f"Failed to get embeddings: {query_embeddings.msg()}",
+            )
+            return query_embeddings
+        query_embedding = query_embeddings.data()[0]
+        if search_mode == "hybrid":
+            stmt = hybrid_search_stmt(
+                filters, query, query_embedding, topk, similarity_threshold
+            )
+        else:
+            stmt = vector_search_stmt(
+                filters, query_embedding, topk, similarity_threshold
+            )
 
-    with Session() as session:
-        # Use .all() instead of .scalars().all() to get both columns
+    replica = replica and await use_read_replica(user_id, project_id)
+    with ReadSession(replica) as session:
         result = session.execute(stmt).all()
-        user_events: list[UserEventData] = []
-        for row in result:
-            user_event: UserEvent = row[0]  # UserEvent object
-            similarity: float = row[1]  # similarity value
-            user_events.append(
-                UserEventData(
-                    id=user_event.id,
-                    event_data=user_event.event_data,
-                    created_at=user_event.created_at,
-                    updated_at=user_event.updated_at,
-                    similarity=similarity,
-                )
+        user_events: list[UserEventData] = [
+            UserEventData(
+                id=row.id,
+                event_data=row.event_data,
+                created_at=row.created_at,
+                updated_at=row.updated_at,
+                similarity=row.similarity,
+                token_count=row.token_count,
             )
+            for row in result
+        ]
 
-        # Create UserEventsData with the events
-        user_events_data = UserEventsData(events=user_events)
-        TRACE_LOG.info(
-            project_id,
-            user_id,
-            f"Event Query: {query}",
-        )
-
+    user_events_data = UserEventsData(events=user_events)
+    TRACE_LOG.info(
+        project_id,
+        user_id,
+        f"Event Query({search_mode}): {query}",
+    )
     return Promise.resolve(user_events_data)
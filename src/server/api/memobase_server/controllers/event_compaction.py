@@ -0,0 +1,241 @@
+import asyncio
+import traceback
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, update, delete
+from ..env import CONFIG, LOG, TRACE_LOG
+from ..models.utils import Promise
+from ..models.response import EventData, EventDigest, UserEventData
+from ..models.database import UserEvent, shift_month_first_day
+from ..connectors import Session, PROJECT_ID, get_redis_client
+from ..llms import llm_complete
+from ..prompts import summary_events
+from ..utils import count_tokens, event_str_repr, event_data_str_repr, truncate_string
+from .event import get_event_embedding, bump_user_events_version
+
+MAX_COMPACTION_EVENTS_PER_USER = 1000
+MAX_DIGEST_INPUT_TOKENS = 8192
+
+
+def get_compaction_lock_key() -> str:
+    return f"memobase:event_compaction:{PROJECT_ID}"
+
+
+def period_bounds(dt: datetime, period: str) -> tuple[datetime, datetime]:
+    """[start, end) of the week or month containing dt, in the configured timezone"""
+    day = dt.astimezone(CONFIG.timezone).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    if period == "week":
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+    start = day.replace(day=1)
+    return start, shift_month_first_day(start, 1)
+
+
+def compaction_cutoff() -> datetime:
+    """Only whole periods ending before the compaction window are compacted"""
+    window_start = datetime.now(timezone.utc) - timedelta(
+        days=CONFIG.event_compaction_after_days
+    )
+    return period_bounds(window_start, CONFIG.event_compaction_period)[0]
+
+
+def compactable_filters(cutoff: datetime) -> tuple:
+    return (
+        UserEvent.created_at < cutoff,
+        UserEvent.digest_id.is_(None),
+        UserEvent.event_data["event_digest"].astext.is_(None),
+    )
+
+
+def merge_event_tags(events: list[UserEventData]) -> list[dict] | None:
+    # One entry per distinct value, so the tag_values filters still match digests
+    merged: dict[tuple[str, str], dict] = {}
+    for e in events:
+        for tag in e.event_data.event_tags or []:
+            merged.setdefault(
+                (tag.tag, tag.value), {"tag": tag.tag, "value": tag.value}
+            )
+    return list(merged.values()) or None
+
+
+def pack_events_for_digest(events: list[UserEventData]) -> str:
+    events_str = "\n\n".join(
+        f"[{e.created_at.astimezone(CONFIG.timezone).strftime('%Y/%m/%d')}] "
+        f"{event_str_repr(e)}"
+        for e in events
+    )
+    return truncate_string(events_str, MAX_DIGEST_INPUT_TOKENS)
+
+
+async def compact_period(
+    user_id: str,
+    project_id: str,
+    events: list[UserEventData],
+    period_start: datetime,
+    period_end: datetime,
+) -> Promise[None]:
+    period = CONFIG.event_compaction_period
+    event_digest = EventDigest(
+        period=period,
+        period_start=period_start.date().isoformat(),
+        period_end=period_end.date().isoformat(),
+        source_event_count=len(events),
+    )
+    source_ids = [e.id for e in events]
+    if len(events) == 1:
+        # Nothing to merge, only mark the event so it is not scanned again
+        event_data = events[0].event_data.model_copy(
+            update={"event_digest": event_digest}
+        )
+        with Session() as session:
+            session.execute(
+                update(UserEvent)
+                .where(
+                    UserEvent.user_id == user_id,
+                    UserEvent.project_id == project_id,
+                    UserEvent.id == source_ids[0],
+                    UserEvent.event_data["event_digest"].astext.is_(None),
+                )
+                .values(event_data=event_data.model_dump())
+            )
+            session.commit()
+        return Promise.resolve(None)
+
+    r = await llm_complete(
+        project_id,
+        pack_events_for_digest(events),
+        system_prompt=summary_events.get_prompt(period),
+        temperature=0.2,
+        model=CONFIG.summary_llm_model,
+        **summary_events.get_kwargs(),
+    )
+    if not r.ok():
+        return r
+    digest_data = EventData(
+        event_tip=r.data().strip(),
+        event_tags=merge_event_tags(events),
+        event_digest=event_digest,
+    )
+    embedding = await get_event_embedding(user_id, project_id, digest_data)
+
+    with Session() as session:
+        digest = UserEvent(
+            user_id=user_id,
+            project_id=project_id,
+            event_data=digest_data.model_dump(),
+            embedding=embedding,
+            token_count=count_tokens(event_data_str_repr(digest_data)),
+        )
+        # Keep the digest in the same time range as its events
+        digest.created_at = max(e.created_at for e in events)
+        session.add(digest)
+        # Claim the events in the transaction of the digest, only if no other
+        # pass digested any of them since they were read
+        source_filters = (
+            UserEvent.user_id == user_id,
+            UserEvent.project_id == project_id,
+            UserEvent.id.in_(source_ids),
+            UserEvent.digest_id.is_(None),
+        )
+        if CONFIG.event_compaction_prune_originals:
+            claimed = session.execute(delete(UserEvent).where(*source_filters))
+        else:
+            claimed = session.execute(
+                update(UserEvent).where(*source_filters).values(digest_id=digest.id)
+            )
+        if claimed.rowcount != len(source_ids):
+            session.rollback()
+            TRACE_LOG.warning(
+                project_id,
+                user_id,
+                f"Skip the {period} digest from {event_digest.period_start}, "
+                "its events were compacted by another pass",
+            )
+            return Promise.resolve(None)
+        session.commit()
+    await bump_user_events_version(user_id, project_id)
+    return Promise.resolve(None)
+
+
+async def compact_user_events(
+    user_id: str, project_id: str, cutoff: datetime
+) -> Promise[int]:
+    """Merge the user's events before cutoff into one digest event per period"""
+    with Session() as session:
+        rows = session.execute(
+            select(UserEvent.id, UserEvent.event_data, UserEvent.created_at)
+            .where(
+                UserEvent.user_id == user_id,
+                UserEvent.project_id == project_id,
+                *compactable_filters(cutoff),
+            )
+            .order_by(UserEvent.created_at)
+            .limit(MAX_COMPACTION_EVENTS_PER_USER)
+        ).all()
+    events = [
+        UserEventData(id=row.id, event_data=row.event_data, created_at=row.created_at)
+        for row in rows
+    ]
+
+    groups: dict[datetime, list[UserEventData]] = {}
+    for e in events:
+        groups.setdefault(
+            period_bounds(e.created_at, CONFIG.event_compaction_period)[0], []
+        ).append(e)
+    if len(rows) == MAX_COMPACTION_EVENTS_PER_USER and len(groups) > 1:
+        # The last period may be cut by the limit, leave it for the next run
+        groups.pop(max(groups))
+
+    compacted = 0
+    for period_start, period_events in groups.items():
+        period_end = period_bounds(period_start, CONFIG.event_compaction_period)[1]
+        p = await compact_period(
+            user_id, project_id, period_events, period_start, period_end
+        )
+        if not p.ok():
+            return p
+        compacted += 1
+    TRACE_LOG.info(
+        project_id,
+        user_id,
+        f"Compacted {len(events)} events into {compacted} digests",
+    )
+    return Promise.resolve(compacted)
+
+
+async def compact_events() -> Promise[dict]:
+    cutoff = compaction_cutoff()
+    with Session() as session:
+        users = session.execute(
+            select(UserEvent.user_id, UserEvent.project_id)
+            .where(*compactable_filters(cutoff))
+            .distinct()
+            .limit(CONFIG.event_compaction_max_users_per_run)
+        ).all()
+    digests = 0
+    for user_id, project_id in users:
+        p = await compact_user_events(user_id, project_id, cutoff)
+        if not p.ok():
+            TRACE_LOG.error(project_id, user_id, f"Failed to compact events: {p.msg()}")
+            continue
+        digests += p.data()
+    return Promise.resolve({"users": len(users), "digests": digests})
+
+
+async def event_compaction_loop():
+    interval = CONFIG.event_compaction_interval
+    while True:
+        try:
+            # Only one worker compacts per interval
+            async with get_redis_client() as redis_client:
+                acquired = await redis_client.set(
+                    get_compaction_lock_key(), "1", nx=True, ex=interval
+                )
+            if acquired:
+                p = await compact_events()
+                if p.data()["users"]:
+                    LOG.info(f"Event compaction: {p.data()}")
+        except Exception as e:
+            LOG.error(f"Error in event compaction: {e}\n{traceback.format_exc()}")
+        await asyncio.sleep(interval)
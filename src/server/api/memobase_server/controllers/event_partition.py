@@ -0,0 +1,55 @@
+import asyncio
+import traceback
+from ..env import CONFIG, LOG
+from ..models.utils import Promise
+from ..models.response import CODE
+from ..models.database import UserEvent
+from ..connectors import Session, PROJECT_ID, get_redis_client
+
+
+def get_partition_maintenance_lock_key() -> str:
+    return f"memobase:event_partition_maintenance:{PROJECT_ID}"
+
+
+async def maintain_event_partitions() -> Promise[dict]:
+    with Session() as session:
+        if not UserEvent.is_partitioned(session):
+            return Promise.reject(
+                CODE.BAD_REQUEST, "user_events table is not partitioned"
+            )
+        created = UserEvent.create_monthly_partitions(
+            session, CONFIG.event_partition_premake_months
+        )
+        expired = []
+        if CONFIG.event_partition_retention_months is not None:
+            expired = UserEvent.expire_monthly_partitions(
+                session,
+                CONFIG.event_partition_retention_months,
+                drop=CONFIG.event_partition_drop_expired,
+            )
+    if created or expired:
+        LOG.info(
+            f"Event partitions maintained, created: {created}, "
+            f"{'dropped' if CONFIG.event_partition_drop_expired else 'detached'}: {expired}"
+        )
+    return Promise.resolve({"created": created, "expired": expired})
+
+
+async def event_partition_maintenance_loop():
+    interval = CONFIG.event_partition_maintenance_interval
+    while True:
+        try:
+            # Only one worker runs the DDL per interval
+            async with get_redis_client() as redis_client:
+                acquired = await redis_client.set(
+                    get_partition_maintenance_lock_key(), "1", nx=True, ex=interval
+                )
+            if acquired:
+                p = await maintain_event_partitions()
+                if not p.ok():
+                    LOG.error(f"Failed to maintain event partitions: {p.msg()}")
+        except Exception as e:
+            LOG.error(
+                f"Error in event partition maintenance: {e}\n{traceback.format_exc()}"
+            )
+        await asyncio.sleep(interval)
@@ -7,3 +7,5 @@ from . import project
 from . import event
 from . import context
 from . import billing
+from . import event_partition
+from . import event_compaction
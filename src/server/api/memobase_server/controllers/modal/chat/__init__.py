@@ -114,7 +114,7 @@ async def process_profile_res(
         fact_attributes=extracted_data["fact_attributes"],
         profiles=extracted_data["profiles"],
         config=project_profiles,
-        total_profiles=extracted_data["total_profiles"],
+        compiled=extracted_data["compiled"],
     )
     if not p.ok():
         return p
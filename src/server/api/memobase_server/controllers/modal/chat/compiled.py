@@ -0,0 +1,115 @@
+from dataclasses import dataclass, field
+from functools import cached_property
+from collections import OrderedDict
+from ....env import CONFIG, ProfileConfig
+from ....types import SubTopic, EventTag, attribute_unify
+from ....prompts.profile_init_utils import (
+    read_out_profile_config,
+    read_out_event_tags,
+    get_specific_subtopics,
+    UserProfileTopic,
+)
+from ....prompts import event_tagging as event_tagging_prompt
+from .types import PROMPTS
+
+MAX_COMPILED_PROFILE_CONFIGS = 128
+
+
+@dataclass
+class CompiledProfileConfig:
+    """Everything the flush pipeline derives from a project's ProfileConfig alone,
+    built once per (config content hash, language) and shared by all users of the
+    project"""
+
+    language: str
+    strict_mode: bool
+    validate_mode: bool
+    profile_slots: list[UserProfileTopic]
+    allowed_topic_subtopics: set[tuple[str, str]]
+    subtopic_definitions: dict[tuple[str, str], SubTopic]
+    event_tags: list[EventTag]
+    event_tag_names: set[str]
+    profile_topics_prompt: str
+    event_tags_prompt: str
+    event_theme_requirement: str | None
+    extract_system_prompt: str
+    merge_system_prompt: str
+    event_tagging_system_prompt: str | None
+    organize_suggest_subtopics: dict[str, list[str] | str] = field(default_factory=dict)
+
+    @cached_property
+    def entry_summary_system_prompt(self) -> str:
+        return PROMPTS[self.language]["entry_summary"].get_prompt(
+            self.profile_topics_prompt,
+            self.event_tags_prompt,
+            additional_requirements=self.event_theme_requirement,
+        )
+
+    def suggest_subtopics(self, topic: str) -> list[str] | str:
+        if topic not in self.organize_suggest_subtopics:
+            self.organize_suggest_subtopics[topic] = get_specific_subtopics(
+                topic, PROMPTS[self.language]["profile"].CANDIDATE_PROFILE_TOPICS
+            )
+        return self.organize_suggest_subtopics[topic]
+
+
+COMPILED_PROFILE_CONFIGS: OrderedDict[tuple[str, str], CompiledProfileConfig] = (
+    OrderedDict()
+)
+
+
+def compile_profile_config(config: ProfileConfig) -> CompiledProfileConfig:
+    language = config.language or CONFIG.language
+    prompts = PROMPTS[language]
+    profile_slots = read_out_profile_config(
+        config, prompts["profile"].CANDIDATE_PROFILE_TOPICS
+    )
+    profile_topics_prompt = prompts["profile"].get_prompt(profile_slots)
+    event_tags = read_out_event_tags(config)
+    event_tags_str = "\n".join([f"- {et.name}({et.description})" for et in event_tags])
+    return CompiledProfileConfig(
+        language=language,
+        strict_mode=(
+            config.profile_strict_mode
+            if config.profile_strict_mode is not None
+            else CONFIG.profile_strict_mode
+        ),
+        validate_mode=(
+            config.profile_validate_mode
+            if config.profile_validate_mode is not None
+            else CONFIG.profile_validate_mode
+        ),
+        profile_slots=profile_slots,
+        allowed_topic_subtopics={
+            (attribute_unify(p.topic), attribute_unify(st["name"]))
+            for p in profile_slots
+            for st in p.sub_topics
+        },
+        subtopic_definitions={
+            (p.topic, sp.name): sp for p in profile_slots for sp in p.sub_topics
+        },
+        event_tags=event_tags,
+        event_tag_names={et.name for et in event_tags},
+        profile_topics_prompt=profile_topics_prompt,
+        event_tags_prompt=event_tags_str,
+        event_theme_requirement=(
+            config.event_theme_requirement or CONFIG.event_theme_requirement
+        ),
+        extract_system_prompt=prompts["extract"].get_prompt(profile_topics_prompt),
+        merge_system_prompt=prompts["merge"].get_prompt(),
+        event_tagging_system_prompt=(
+            event_tagging_prompt.get_prompt(event_tags_str) if event_tags else None
+        ),
+    )
+
+
+def get_compiled_profile_config(config: ProfileConfig) -> CompiledProfileConfig:
+    key = (config.content_hash, config.language or CONFIG.language)
+    compiled = COMPILED_PROFILE_CONFIGS.get(key)
+    if compiled is None:
+        compiled = compile_profile_config(config)
+        COMPILED_PROFILE_CONFIGS[key] = compiled
+        while len(COMPILED_PROFILE_CONFIGS) > MAX_COMPILED_PROFILE_CONFIGS:
+            COMPILED_PROFILE_CONFIGS.popitem(last=False)
+    COMPILED_PROFILE_CONFIGS.move_to_end(key)
+    return compiled
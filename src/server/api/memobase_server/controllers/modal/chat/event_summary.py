@@ -5,8 +5,8 @@ from ....prompts.utils import (
     parse_string_into_subtopics,
     attribute_unify,
 )
-from ....prompts.profile_init_utils import read_out_event_tags
 from ....llms import llm_complete
+from .compiled import get_compiled_profile_config
 
 from ....prompts import event_tagging as event_tagging_prompt
 
@@ -14,15 +14,14 @@ from ....prompts import event_tagging as event_tagging_prompt
 async def tag_event(
     project_id: str, config: ProfileConfig, event_summary: str
 ) -> Promise[Optional[list]]:
-    event_tags = read_out_event_tags(config)
-    available_event_tags = set([et.name for et in event_tags])
-    if len(event_tags) == 0:
+    compiled = get_compiled_profile_config(config)
+    available_event_tags = compiled.event_tag_names
+    if len(compiled.event_tags) == 0:
         return Promise.resolve(None)
-    event_tags_str = "\n".join([f"- {et.name}({et.description})" for et in event_tags])
     r = await llm_complete(
         project_id,
         event_summary,
-        system_prompt=event_tagging_prompt.get_prompt(event_tags_str),
+        system_prompt=compiled.event_tagging_system_prompt,
         temperature=0.2,
         model=CONFIG.best_llm_model,
         **event_tagging_prompt.get_kwargs(),
@@ -10,12 +10,13 @@ from ....prompts.utils import (
     parse_string_into_profiles,
     parse_string_into_merge_action,
 )
-from ....prompts.profile_init_utils import read_out_profile_config, UserProfileTopic
+from ....prompts.profile_init_utils import UserProfileTopic
 from ...profile import get_user_profiles
 from ...project import ProfileConfig
 
 # from ...project impor
 from .types import FactResponse, PROMPTS
+from .compiled import get_compiled_profile_config
 
 
 def merge_by_topic_sub_topics(new_facts: list[FactResponse]):
@@ -36,23 +37,10 @@ async def extract_topics(
     if not p.ok():
         return p
     profiles = p.data().profiles
-    USE_LANGUAGE = project_profiles.language or CONFIG.language
-    STRICT_MODE = (
-        project_profiles.profile_strict_mode
-        if project_profiles.profile_strict_mode is not None
-        else CONFIG.profile_strict_mode
-    )
-
-    project_profiles_slots = read_out_profile_config(
-        project_profiles, PROMPTS[USE_LANGUAGE]["profile"].CANDIDATE_PROFILE_TOPICS
-    )
-    if STRICT_MODE:
-        allowed_topic_subtopics = set()
-        for p in project_profiles_slots:
-            for st in p.sub_topics:
-                allowed_topic_subtopics.add(
-                    (attribute_unify(p.topic), attribute_unify(st["name"]))
-                )
+    compiled = get_compiled_profile_config(project_profiles)
+    USE_LANGUAGE = compiled.language
+    STRICT_MODE = compiled.strict_mode
+    allowed_topic_subtopics = compiled.allowed_topic_subtopics
 
     if len(profiles):
         already_topics_subtopics = set(
@@ -90,9 +78,7 @@ async def extract_topics(
             user_memo,
             strict_mode=STRICT_MODE,
         ),
-        system_prompt=PROMPTS[USE_LANGUAGE]["extract"].get_prompt(
-            PROMPTS[USE_LANGUAGE]["profile"].get_prompt(project_profiles_slots)
-        ),
+        system_prompt=compiled.extract_system_prompt,
         temperature=0.2,  # precise
         **PROMPTS[USE_LANGUAGE]["extract"].get_kwargs(),
     )
@@ -115,7 +101,7 @@ async def extract_topics(
                 "fact_contents": [],
                 "fact_attributes": [],
                 "profiles": profiles,
-                "total_profiles": project_profiles_slots,
+                "compiled": compiled,
             }
         )
 
@@ -146,6 +132,6 @@ async def extract_topics(
             "fact_contents": fact_contents,
             "fact_attributes": fact_attributes,
             "profiles": profiles,
-            "total_profiles": project_profiles_slots,
+            "compiled": compiled,
         }
     )
@@ -7,9 +7,9 @@ from ....llms import llm_complete
 from ....prompts.utils import (
     parse_string_into_merge_action,
 )
-from ....prompts.profile_init_utils import UserProfileTopic
 from ....types import SubTopic
 from .types import UpdateResponse, PROMPTS, AddProfile, UpdateProfile, MergeAddResult
+from .compiled import CompiledProfileConfig, get_compiled_profile_config
 
 
 async def merge_or_valid_new_memos(
@@ -19,14 +19,12 @@ async def merge_or_valid_new_memos(
     fact_attributes: list[dict],
     profiles: list[ProfileData],
     config: ProfileConfig,
-    total_profiles: list[UserProfileTopic],
+    compiled: CompiledProfileConfig,
 ) -> Promise[MergeAddResult]:
     assert len(fact_contents) == len(
         fact_attributes
     ), "Length of fact_contents and fact_attributes must be equal"
-    DEFINE_MAPS = {
-        (p.topic, sp.name): sp for p in total_profiles for sp in p.sub_topics
-    }
+    DEFINE_MAPS = compiled.subtopic_definitions
     RUNTIME_MAPS = {
         (p.attributes[ContanstTable.topic], p.attributes[ContanstTable.sub_topic]): p
         for p in profiles
@@ -70,12 +68,9 @@ async def handle_profile_merge_or_valid(
         profile_attributes[ContanstTable.topic],
         profile_attributes[ContanstTable.sub_topic],
     )
-    USE_LANGUAGE = config.language or CONFIG.language
-    PROFILE_VALIDATE_MODE = (
-        config.profile_validate_mode
-        if config.profile_validate_mode is not None
-        else CONFIG.profile_validate_mode
-    )
+    compiled = get_compiled_profile_config(config)
+    USE_LANGUAGE = compiled.language
+    PROFILE_VALIDATE_MODE = compiled.validate_mode
     runtime_profile = profile_runtime_maps.get(KEY, None)
     define_sub_topic = profile_define_maps.get(KEY, SubTopic(name=""))
 
@@ -106,7 +101,7 @@ async def handle_profile_merge_or_valid(
             update_instruction=define_sub_topic.update_description,  # maybe none
             topic_description=define_sub_topic.description,  # maybe none
         ),
-        system_prompt=PROMPTS[USE_LANGUAGE]["merge"].get_prompt(),
+        system_prompt=compiled.merge_system_prompt,
         temperature=0.2,  # precise
         **PROMPTS[USE_LANGUAGE]["merge"].get_kwargs(),
     )
@@ -138,15 +133,16 @@ async def handle_profile_merge_or_valid(
                 }
             )
         else:
-            if ContanstTable.update_hits not in runtime_profile.attributes:
-                runtime_profile.attributes[ContanstTable.update_hits] = 1
-            else:
-                runtime_profile.attributes[ContanstTable.update_hits] += 1
+            # A copy, the profile is not updated until the flush writes it
+            attributes = dict(runtime_profile.attributes)
+            attributes[ContanstTable.update_hits] = (
+                attributes.get(ContanstTable.update_hits, 0) + 1
+            )
             session_merge_validate_results["update"].append(
                 {
                     "profile_id": runtime_profile.id,
                     "content": update_response["memo"],
-                    "attributes": runtime_profile.attributes,
+                    "attributes": attributes,
                 }
             )
             session_merge_validate_results["update_delta"].append(
@@ -1,7 +1,7 @@
 import asyncio
 from collections import defaultdict
 from .types import MergeAddResult, PROMPTS, AddProfile
-from ....prompts.profile_init_utils import get_specific_subtopics
+from .compiled import CompiledProfileConfig, get_compiled_profile_config
 from ....prompts.utils import parse_string_into_subtopics, attribute_unify
 from ....models.utils import Promise
 from ....models.response import ProfileData
@@ -16,12 +16,7 @@ async def organize_profiles(
     config: ProfileConfig,
 ) -> Promise[None]:
     profiles = profile_options["before_profiles"]
-    USE_LANGUAGE = config.language or CONFIG.language
-    STRICT_MODE = (
-        config.profile_strict_mode
-        if config.profile_strict_mode is not None
-        else CONFIG.profile_strict_mode
-    )
+    compiled = get_compiled_profile_config(config)
     topic_groups = defaultdict(list)
     for p in profiles:
         topic_groups[p.attributes[ContanstTable.topic]].append(p)
@@ -35,7 +30,7 @@ async def organize_profiles(
         return Promise.resolve(None)
     ps = await asyncio.gather(
         *[
-            organize_profiles_by_topic(user_id, project_id, group, USE_LANGUAGE)
+            organize_profiles_by_topic(user_id, project_id, group, compiled)
             for group in need_to_organize_topics.values()
         ]
     )
@@ -60,7 +55,7 @@ async def organize_profiles_by_topic(
     user_id: str,
     project_id: str,
     profiles: list[ProfileData],
-    USE_LANGUAGE: str,  # profiles in the same topics
+    compiled: CompiledProfileConfig,  # profiles in the same topics
 ) -> Promise[list[AddProfile]]:
     assert (
         len(profiles) > CONFIG.max_profile_subtopics
@@ -75,9 +70,7 @@ async def organize_profiles_by_topic(
         f"Organizing profiles for topic: {profiles[0].attributes['topic']} with sub_topics {len(profiles)}",
     )
     topic = attribute_unify(profiles[0].attributes[ContanstTable.topic])
-    suggest_subtopics = get_specific_subtopics(
-        topic, PROMPTS[USE_LANGUAGE]["profile"].CANDIDATE_PROFILE_TOPICS
-    )
+    suggest_subtopics = compiled.suggest_subtopics(topic)
 
     llm_inputs = "\n".join(
         [
@@ -91,11 +84,11 @@ async def organize_profiles_by_topic(
     p = await llm_complete(
         project_id,
         llm_prompt,
-        PROMPTS[USE_LANGUAGE]["organize"].get_prompt(
+        PROMPTS[compiled.language]["organize"].get_prompt(
             CONFIG.max_profile_subtopics // 2 + 1, suggest_subtopics
         ),
         temperature=0.2,  # precise
-        **PROMPTS[USE_LANGUAGE]["organize"].get_kwargs(),
+        **PROMPTS[compiled.language]["organize"].get_kwargs(),
     )
     if not p.ok():
         return p
@@ -63,7 +63,15 @@ async def process_messages(
         return latests_statuses
     latests_statuses_data = latests_statuses.data()
 
-    p = await get_user_profiles(user_id, project_id)
+    p = await get_user_profiles(
+        user_id,
+        project_id,
+        only_topics=only_topics,
+        prefer_topics=prefer_topics,
+        max_subtopic_size=max_subtopic_size,
+        topic_limits=topic_limits,
+        topk=topk,
+    )
     if not p.ok():
         return p
     p = await truncate_profiles(
@@ -1,15 +1,22 @@
 import json
 import re
 from pydantic import ValidationError
-from typing import TypedDict
+from typing import Literal, TypedDict
+from sqlalchemy import desc, select
 from ...models.utils import Promise
 from ...models.database import GeneralBlob, UserProfile
 from ...models.blob import OpenAICompatibleMessage
 from ...models.response import CODE, IdData, IdsData, UserProfilesData
 from ...utils import truncate_string, find_list_int_or_none
 from ...env import TRACE_LOG, CONFIG
+from ...connectors import Session
 from ...prompts import pick_related_profiles as pick_prompt
 from ...llms import llm_complete
+from ...llms.embeddings import get_embedding
+
+ProfileFilterMode = Literal["llm", "embedding", "embedding_rerank"]
+# The LLM reranks this many times max_filter_num of the closest profiles
+RERANK_CANDIDATE_FACTOR = 3
 
 
 class FilterProfilesResult(TypedDict):
@@ -93,3 +100,93 @@ async def filter_profiles_with_chats(
         f"Filter profiles with chats: {reason}, {found_ids}",
     )
     return Promise.resolve({"reason": reason, "profiles": profiles})
+
+
+async def rank_profiles_with_chats(
+    user_id: str,
+    project_id: str,
+    profiles: UserProfilesData,
+    chats: list[OpenAICompatibleMessage],
+    only_topics: list[str] | None = None,
+    max_previous_chats: int = 4,
+    max_filter_num: int = 10,
+    similarity_threshold: float = 0.2,
+    rerank: bool = False,
+) -> Promise[FilterProfilesResult]:
+    """Rank profiles by the cosine similarity of their stored embeddings to the
+    recent chats, optionally reranked by the LLM picker. Profiles without an
+    embedding yet follow the ranked ones, in their given order"""
+    if not CONFIG.enable_profile_embedding:
+        return Promise.reject(CODE.NOT_IMPLEMENTED, "Profile embedding is not enabled")
+    if not len(chats) or not len(profiles.profiles):
+        return Promise.reject(CODE.BAD_REQUEST, "No chats or profiles to filter")
+    chats = chats[-(max_previous_chats + 1) :]
+    if only_topics:
+        only_topics = {t.strip() for t in only_topics}
+    candidates = {
+        p.id: p
+        for p in profiles.profiles
+        if not only_topics or p.attributes["topic"].strip() in only_topics
+    }
+    query = truncate_string(
+        "\n".join(f"{c.role}: {c.content}" for c in chats),
+        CONFIG.embedding_max_token_size,
+    )
+    query_embeddings = await get_embedding(
+        project_id, [query], phase="query", model=CONFIG.embedding_model
+    )
+    if not query_embeddings.ok():
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"Failed to get embeddings: {query_embeddings.msg()}",
+        )
+        return query_embeddings
+
+    topk = max_filter_num * RERANK_CANDIDATE_FACTOR if rerank else max_filter_num
+    similarity = 1 - UserProfile.embedding.cosine_distance(query_embeddings.data()[0])
+    in_candidates = (
+        UserProfile.user_id == user_id,
+        UserProfile.project_id == project_id,
+        UserProfile.id.in_(list(candidates)),
+    )
+    with Session() as session:
+        rows = session.execute(
+            select(UserProfile.id, similarity.label("similarity"))
+            .where(
+                *in_candidates,
+                UserProfile.embedding.is_not(None),
+                similarity > similarity_threshold,
+            )
+            .order_by(desc("similarity"))
+            .limit(topk)
+        ).all()
+        unembedded = set(
+            session.scalars(
+                select(UserProfile.id).where(
+                    *in_candidates, UserProfile.embedding.is_(None)
+                )
+            ).all()
+        )
+    ranked = [candidates[row.id] for row in rows]
+    # Not embedded yet, not dropped: backfilled by the user's next profile write
+    ranked.extend(p for p_id, p in candidates.items() if p_id in unembedded)
+    ranked = ranked[:topk]
+    TRACE_LOG.info(
+        project_id,
+        user_id,
+        f"Rank profiles with chats: {len(ranked)} of {len(candidates)} profiles",
+    )
+    if rerank and len(ranked) > max_filter_num:
+        p = await filter_profiles_with_chats(
+            user_id,
+            project_id,
+            UserProfilesData(profiles=ranked),
+            chats,
+            max_previous_chats=max_previous_chats,
+            max_filter_num=max_filter_num,
+        )
+        if p.ok():
+            return p
+        # Keep the embedding ranking when the LLM picker fails
+    return Promise.resolve({"reason": None, "profiles": ranked[:max_filter_num]})
@@ -1,11 +1,278 @@
-from pydantic import ValidationError
+from bisect import bisect_right
+from itertools import accumulate
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import (
+    Integer,
+    TEXT,
+    case,
+    cast,
+    column,
+    func,
+    or_,
+    select,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+from pgvector.sqlalchemy import Vector
 from ..models.utils import Promise
 from ..models.database import GeneralBlob, UserProfile
-from ..models.response import CODE, IdData, IdsData, UserProfilesData, ProfileAttributes
-from ..connectors import Session, get_redis_client
-from ..utils import get_encoded_tokens
+from ..models.response import (
+    CODE,
+    IdData,
+    IdsData,
+    UserProfilesData,
+    ProfileAttributes,
+    ProfileData,
+)
+from ..connectors import (
+    Session,
+    ReadSession,
+    get_redis_client,
+    mark_recent_write,
+    use_read_replica,
+)
+from ..llms.embeddings import get_embedding
+from ..cache import (
+    LocalCache,
+    SingleFlight,
+    publish_invalidation,
+    bump_version,
+    acquire_lease_or_wait,
+    release_lease,
+)
+from ..utils import count_tokens, count_tokens_batch, profile_str_repr
 from ..env import CONFIG, TRACE_LOG
 
+USER_PROFILES_VERSION_TTL = 60 * 60 * 24
+USER_PROFILES_LOCAL_CACHE = LocalCache(
+    "user_profiles",
+    CONFIG.cache_user_profiles_local_size,
+    CONFIG.cache_user_profiles_local_ttl,
+)
+USER_PROFILES_SINGLE_FLIGHT = SingleFlight()
+# Profiles without an embedding embedded along with each write of the user
+PROFILE_EMBEDDING_BACKFILL_LIMIT = 100
+PROFILE_FIELDS = (
+    "id",
+    "content",
+    "attributes",
+    "token_count",
+    "created_at",
+    "updated_at",
+)
+# Only write the cache if no update bumped the version since it was read
+REDIS_LUA_SET_IF_VERSION = """
+if (redis.call("get", KEYS[1]) or "0") ~= ARGV[1] then
+    return 0
+end
+redis.call("set", KEYS[2], ARGV[2], "EX", ARGV[3])
+return 1
+"""
+
+
+class CachedUserProfiles(BaseModel):
+    version: int
+    profiles: UserProfilesData
+
+
+def user_profiles_cache_key(user_id: str, project_id: str) -> str:
+    return f"user_profiles::{project_id}::{user_id}"
+
+
+def user_profiles_version_key(user_id: str, project_id: str) -> str:
+    return f"user_profiles_version::{project_id}::{user_id}"
+
+
+def copy_user_profiles(user_profiles: UserProfilesData) -> UserProfilesData:
+    # The cached profiles are shared by every caller of the worker, and callers
+    # sort the list and update the attributes in place
+    return UserProfilesData.model_construct(
+        profiles=[p.model_copy(deep=True) for p in user_profiles.profiles]
+    )
+
+
+def normalize_topic(topic: str | None) -> str | None:
+    """Topics compare without surrounding spaces, like the topic column"""
+    return topic.strip() if topic is not None else None
+
+
+def normalize_topic_filters(
+    only_topics: list[str] | None,
+    prefer_topics: list[str] | None,
+    topic_limits: dict[str, int] | None,
+) -> tuple[list[str] | None, list[str] | None, dict[str, int] | None]:
+    """The topic filters with normalized names, the same for load_user_profiles
+    and truncate_profiles whichever of them applies the filters"""
+    if only_topics:
+        only_topics = [normalize_topic(t) for t in only_topics]
+    if prefer_topics:
+        prefer_topics = [normalize_topic(t) for t in prefer_topics]
+    if topic_limits:
+        topic_limits = {normalize_topic(t): limit for t, limit in topic_limits.items()}
+    return only_topics, prefer_topics, topic_limits
+
+
+def load_user_profiles(
+    user_id: str,
+    project_id: str,
+    only_topics: list[str] = None,
+    prefer_topics: list[str] = None,
+    max_subtopic_size: int = None,
+    topic_limits: dict[str, int] = None,
+    topk: int = None,
+    replica: bool = False,
+) -> UserProfilesData:
+    """The user's profiles, most recently updated first. The topic filters and
+    limits behave like truncate_profiles, but run in SQL on the topic column.
+    With replica, read from a read replica if there is one"""
+    only_topics, prefer_topics, topic_limits = normalize_topic_filters(
+        only_topics, prefer_topics, topic_limits
+    )
+    filters = [UserProfile.user_id == user_id, UserProfile.project_id == project_id]
+    if only_topics:
+        filters.append(UserProfile.topic.in_(only_topics))
+    columns = [getattr(UserProfile, name) for name in PROFILE_FIELDS]
+    limit_topics = bool(topic_limits) or bool(
+        max_subtopic_size and max_subtopic_size > 0
+    )
+    if limit_topics:
+        columns.append(
+            func.row_number()
+            .over(
+                partition_by=UserProfile.topic,
+                order_by=(UserProfile.updated_at.desc(), UserProfile.id),
+            )
+            .label("topic_rank")
+        )
+    profiles = select(*columns, UserProfile.topic).where(*filters).subquery()
+
+    stmt = select(*[profiles.c[name] for name in PROFILE_FIELDS])
+    if topic_limits:
+        topic_limit = case(
+            topic_limits,
+            value=profiles.c.topic,
+            else_=max_subtopic_size or -1,
+        )
+        stmt = stmt.where(or_(topic_limit < 0, profiles.c.topic_rank <= topic_limit))
+    elif limit_topics:
+        stmt = stmt.where(profiles.c.topic_rank <= max_subtopic_size)
+    # id breaks the ties of profiles written together, so the order is stable
+    order_by = [profiles.c.updated_at.desc(), profiles.c.id]
+    if prefer_topics:
+        priority = case(
+            {t: i for i, t in enumerate(prefer_topics)},
+            value=profiles.c.topic,
+            else_=len(prefer_topics),
+        )
+        order_by.insert(0, priority)
+    stmt = stmt.order_by(*order_by)
+    if topk:
+        stmt = stmt.limit(topk)
+    with ReadSession(replica) as session:
+        rows = session.execute(stmt).all()
+    # Trusted rows of the database, built without validation
+    return UserProfilesData.model_construct(
+        profiles=[ProfileData.model_construct(**row._asdict()) for row in rows]
+    )
+
+
+async def set_user_profiles_cache(
+    user_id: str, project_id: str, user_profiles: UserProfilesData, version: int
+) -> bool:
+    async with get_redis_client() as redis_client:
+        result = await redis_client.eval(
+            REDIS_LUA_SET_IF_VERSION,
+            2,
+            user_profiles_version_key(user_id, project_id),
+            user_profiles_cache_key(user_id, project_id),
+            str(version),
+            CachedUserProfiles(
+                version=version, profiles=user_profiles
+            ).model_dump_json(),
+            CONFIG.cache_user_profiles_ttl,
+        )
+    return result == 1
+
+
+async def embed_user_profiles(
+    user_id: str, project_id: str, profiles: list[tuple[str, str, dict]]
+):
+    """Store the embeddings of (profile_id, content, attributes) with one batched
+    call, along with the user's other profiles that have none yet. On failure
+    the embeddings stay empty, and the embedding ranking of /users/context puts
+    those profiles after the ranked ones"""
+    if not CONFIG.enable_profile_embedding or not profiles:
+        return
+    profiles = [
+        (str(profile_id), content, attr) for profile_id, content, attr in profiles
+    ]
+    with Session() as session:
+        # Written before profile embedding was enabled, or their embedding failed
+        missing = session.execute(
+            select(UserProfile.id, UserProfile.content, UserProfile.attributes)
+            .where(
+                UserProfile.user_id == user_id,
+                UserProfile.project_id == project_id,
+                UserProfile.embedding.is_(None),
+                UserProfile.id.not_in([profile_id for profile_id, _, _ in profiles]),
+            )
+            .limit(PROFILE_EMBEDDING_BACKFILL_LIMIT)
+        ).all()
+    profiles.extend((str(row.id), row.content, row.attributes) for row in missing)
+    embeddings = await get_embedding(
+        project_id,
+        [profile_str_repr(content, attr) for _, content, attr in profiles],
+        phase="document",
+        model=CONFIG.embedding_model,
+    )
+    if not embeddings.ok():
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"Failed to get profile embeddings: {embeddings.msg()}",
+        )
+        return
+    embeddings = embeddings.data()
+    if embeddings.shape[-1] != CONFIG.embedding_dim:
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"Embedding dimension mismatch! Expected {CONFIG.embedding_dim}, got {embeddings.shape[-1]}.",
+        )
+        return
+    embedded = values(
+        column("id", TEXT),
+        column("content", TEXT),
+        column("embedding", Vector(CONFIG.embedding_dim)),
+        name="embedded",
+    ).data(
+        [
+            (profile_id, content, embedding)
+            for (profile_id, content, _), embedding in zip(profiles, embeddings)
+        ]
+    )
+    with Session() as session:
+        session.execute(
+            update(UserProfile)
+            .where(
+                UserProfile.id == cast(embedded.c.id, UUID(as_uuid=True)),
+                UserProfile.project_id == project_id,
+                # Skip it if a later update changed the content meanwhile
+                UserProfile.content == embedded.c.content,
+            )
+            .values(embedding=cast(embedded.c.embedding, Vector(CONFIG.embedding_dim)))
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+
+
+def profile_token_count(profile: ProfileData) -> int:
+    if profile.token_count is not None:
+        return profile.token_count
+    # Profiles written before token counts were stored
+    return count_tokens(profile_str_repr(profile.content, profile.attributes))
+
 
 async def truncate_profiles(
     profiles: UserProfilesData,
@@ -18,28 +285,29 @@ async def truncate_profiles(
 ) -> Promise[UserProfilesData]:
     if not len(profiles.profiles):
         return Promise.resolve(profiles)
+    only_topics, prefer_topics, topic_limits = normalize_topic_filters(
+        only_topics, prefer_topics, topic_limits
+    )
     profiles.profiles.sort(key=lambda p: p.updated_at, reverse=True)
     if prefer_topics:
-        prefer_topics = [t.strip() for t in prefer_topics]
         priority_weights = {t: i for i, t in enumerate(prefer_topics)}
         priority_profiles = []
         non_priority_profiles = []
         for p in profiles.profiles:
-            if p.attributes.get("topic") in priority_weights:
+            if normalize_topic(p.attributes.get("topic")) in priority_weights:
                 priority_profiles.append(p)
             else:
                 non_priority_profiles.append(p)
         priority_profiles.sort(
-            key=lambda p: priority_weights[p.attributes.get("topic")]
+            key=lambda p: priority_weights[normalize_topic(p.attributes.get("topic"))]
         )
         profiles.profiles = priority_profiles + non_priority_profiles
     if only_topics:
-        only_topics = [t.strip() for t in only_topics]
         s_only_topics = set(only_topics)
         profiles.profiles = [
             p
             for p in profiles.profiles
-            if p.attributes.get("topic").strip() in s_only_topics
+            if normalize_topic(p.attributes.get("topic")) in s_only_topics
         ]
     if max_subtopic_size or topic_limits:
         use_topic_limits = topic_limits or {}
@@ -47,7 +315,7 @@ async def truncate_profiles(
         _count_subtopics = {}
         filtered_profiles = []
         for p in profiles.profiles:
-            name_key = p.attributes.get("topic")
+            name_key = normalize_topic(p.attributes.get("topic"))
             this_topic_limit = use_topic_limits.get(name_key, max_subtopic_size)
             if name_key not in _count_subtopics:
                 _count_subtopics[name_key] = 0
@@ -60,61 +328,111 @@ async def truncate_profiles(
     if topk:
         profiles.profiles = profiles.profiles[:topk]
     if max_token_size:
-        current_length = 0
-        use_index = 0
-        for max_i, p in enumerate(profiles.profiles):
-            single_p = f"{p.attributes.get('topic')}::{p.attributes.get('sub_topic')}: {p.content}"
-            current_length += len(get_encoded_tokens(single_p))
-            if current_length > max_token_size:
-                break
-            use_index = max_i
-        profiles.profiles = profiles.profiles[: use_index + 1]
+        token_sums = list(accumulate(profile_token_count(p) for p in profiles.profiles))
+        # The first profile is kept even if it alone exceeds max_token_size
+        use_size = max(bisect_right(token_sums, max_token_size), 1)
+        profiles.profiles = profiles.profiles[:use_size]
     return Promise.resolve(profiles)
 
 
-async def get_user_profiles(user_id: str, project_id: str) -> Promise[UserProfilesData]:
-    async with get_redis_client() as redis_client:
-        user_profiles = await redis_client.get(
-            f"user_profiles::{project_id}::{user_id}"
-        )
-        if user_profiles:
-            try:
-                return Promise.resolve(
-                    UserProfilesData.model_validate_json(user_profiles)
-                )
-            except ValidationError as e:
-                TRACE_LOG.error(
-                    project_id,
-                    user_id,
-                    f"Invalid user profiles: {e}",
-                )
-                await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
-    with Session() as session:
-        user_profiles = (
-            session.query(UserProfile)
-            .filter_by(user_id=user_id, project_id=project_id)
-            .order_by(UserProfile.updated_at.desc())
-            .all()
+async def get_user_profiles(
+    user_id: str,
+    project_id: str,
+    only_topics: list[str] = None,
+    prefer_topics: list[str] = None,
+    max_subtopic_size: int = None,
+    topic_limits: dict[str, int] = None,
+    topk: int = None,
+    replica: bool = True,
+) -> Promise[UserProfilesData]:
+    """All the user's profiles, through the cache. With topic filters or a topk,
+    only the matching profiles are returned, in the order of truncate_profiles.
+    Those are filtered from the cached profiles if any, otherwise only they are
+    read, from a read replica if replica is True and the user didn't write
+    recently. A filtered read doesn't fill the cache"""
+    cache_key = user_profiles_cache_key(user_id, project_id)
+    user_profiles = USER_PROFILES_LOCAL_CACHE.get(cache_key)
+    if only_topics or max_subtopic_size or topic_limits or topk:
+        topic_filters = dict(
+            only_topics=only_topics,
+            prefer_topics=prefer_topics,
+            max_subtopic_size=max_subtopic_size,
+            topic_limits=topic_limits,
+            topk=topk,
         )
-        results = []
-        for up in user_profiles:
-            results.append(
-                {
-                    "id": up.id,
-                    "content": up.content,
-                    "attributes": up.attributes,
-                    "created_at": up.created_at,
-                    "updated_at": up.updated_at,
-                }
+        if user_profiles is None:
+            async with get_redis_client() as redis_client:
+                cached = await redis_client.get(cache_key)
+            user_profiles = parse_cached_user_profiles(user_id, project_id, cached)
+        if user_profiles is not None:
+            # Already cached, filtering it is cheaper than a query
+            return await truncate_profiles(
+                copy_user_profiles(user_profiles), **topic_filters
             )
-    return_profiles = UserProfilesData(profiles=results)
+        replica = replica and await use_read_replica(user_id, project_id)
+        return Promise.resolve(
+            load_user_profiles(user_id, project_id, **topic_filters, replica=replica)
+        )
+    if user_profiles is None:
+        user_profiles = await USER_PROFILES_SINGLE_FLIGHT.do(
+            cache_key, lambda: fetch_user_profiles(user_id, project_id)
+        )
+    return Promise.resolve(copy_user_profiles(user_profiles))
+
+
+async def fetch_user_profiles(user_id: str, project_id: str) -> UserProfilesData:
+    cache_key = user_profiles_cache_key(user_id, project_id)
+    version_key = user_profiles_version_key(user_id, project_id)
     async with get_redis_client() as redis_client:
-        await redis_client.set(
-            f"user_profiles::{project_id}::{user_id}",
-            return_profiles.model_dump_json(),
-            ex=CONFIG.cache_user_profiles_ttl,
+        cached, version = await redis_client.mget(cache_key, version_key)
+    user_profiles = parse_cached_user_profiles(user_id, project_id, cached)
+    if user_profiles is not None:
+        return user_profiles
+
+    leased = False
+    if CONFIG.cache_user_profiles_lease_ms > 0:
+        leased, cached = await acquire_lease_or_wait(
+            f"{cache_key}::lease", cache_key, CONFIG.cache_user_profiles_lease_ms
         )
-    return Promise.resolve(return_profiles)
+        user_profiles = parse_cached_user_profiles(user_id, project_id, cached)
+        if user_profiles is not None:
+            return user_profiles
+    try:
+        version = int(version or 0)
+        # From the primary: a lagging replica would cache stale profiles
+        # under the current version, for every worker
+        user_profiles = load_user_profiles(user_id, project_id)
+        # Skipped if the profiles were updated while we were reading them
+        written = await set_user_profiles_cache(
+            user_id, project_id, user_profiles, version
+        )
+        if written:
+            USER_PROFILES_LOCAL_CACHE.set(cache_key, user_profiles, version)
+    finally:
+        if leased:
+            await release_lease(f"{cache_key}::lease")
+    return user_profiles
+
+
+def parse_cached_user_profiles(
+    user_id: str, project_id: str, cached: str | None
+) -> UserProfilesData | None:
+    if not cached:
+        return None
+    try:
+        cached = CachedUserProfiles.model_validate_json(cached)
+    except ValidationError as e:
+        # Overwritten by the next load
+        TRACE_LOG.error(
+            project_id,
+            user_id,
+            f"Invalid user profiles: {e}",
+        )
+        return None
+    USER_PROFILES_LOCAL_CACHE.set(
+        user_profiles_cache_key(user_id, project_id), cached.profiles, cached.version
+    )
+    return cached.profiles
 
 
 async def add_user_profiles(
@@ -136,17 +454,128 @@ async def add_user_profiles(
     with Session() as session:
         db_profiles = [
             UserProfile(
-                user_id=user_id, project_id=project_id, content=content, attributes=attr
+                user_id=user_id,
+                project_id=project_id,
+                content=content,
+                attributes=attr,
+                token_count=count_tokens(profile_str_repr(content, attr)),
             )
             for content, attr in zip(profiles, attributes)
         ]
         session.add_all(db_profiles)
         session.commit()
         profile_ids = [profile.id for profile in db_profiles]
+    await embed_user_profiles(
+        user_id, project_id, list(zip(profile_ids, profiles, attributes))
+    )
     await refresh_user_profile_cache(user_id, project_id)
     return Promise.resolve(IdsData(ids=profile_ids))
 
 
+def bulk_update_user_profiles(
+    session,
+    user_id: str,
+    project_id: str,
+    profile_ids: list[str],
+    contents: list[str],
+    attributes: list[dict | None],
+) -> list[tuple[str, str, dict]]:
+    """Update the profiles with one UPDATE ... FROM (VALUES ...), a None attribute
+    keeps the stored one. Returns (profile_id, content, attributes) of the
+    updated profiles, in the given order"""
+    # A profile updated twice keeps its last update, like sequential updates
+    changes = {
+        str(profile_id): (content, attr)
+        for profile_id, content, attr in zip(profile_ids, contents, attributes)
+    }
+    if not changes:
+        return []
+    known = [(content, attr) for content, attr in changes.values() if attr is not None]
+    known_counts = iter(
+        count_tokens_batch([profile_str_repr(content, attr) for content, attr in known])
+    )
+    changed = values(
+        column("id", TEXT),
+        column("content", TEXT),
+        column("attributes", JSONB(none_as_null=True)),
+        column("token_count", Integer),
+        name="changed",
+    ).data(
+        [
+            (
+                profile_id,
+                content,
+                attr,
+                next(known_counts) if attr is not None else None,
+            )
+            for profile_id, (content, attr) in changes.items()
+        ]
+    )
+    rows = session.execute(
+        update(UserProfile)
+        .where(
+            UserProfile.id == cast(changed.c.id, UUID(as_uuid=True)),
+            UserProfile.user_id == user_id,
+            UserProfile.project_id == project_id,
+        )
+        .values(
+            content=changed.c.content,
+            attributes=func.coalesce(
+                cast(changed.c.attributes, JSONB), UserProfile.attributes
+            ),
+            token_count=cast(changed.c.token_count, Integer),
+        )
+        .returning(UserProfile.id, UserProfile.attributes, UserProfile.token_count)
+        .execution_options(synchronize_session=False)
+    ).all()
+    updated_attributes = {str(row.id): row.attributes for row in rows}
+
+    # Only the profiles updated without attributes need the stored ones to be
+    # counted, a second statement for those alone
+    uncounted = [
+        (str(row.id), changes[str(row.id)][0], row.attributes)
+        for row in rows
+        if row.token_count is None
+    ]
+    if uncounted:
+        counted = values(
+            column("id", TEXT), column("token_count", Integer), name="counted"
+        ).data(
+            list(
+                zip(
+                    [profile_id for profile_id, _, _ in uncounted],
+                    count_tokens_batch(
+                        [
+                            profile_str_repr(content, attr)
+                            for _, content, attr in uncounted
+                        ]
+                    ),
+                )
+            )
+        )
+        session.execute(
+            update(UserProfile)
+            .where(
+                UserProfile.id == cast(counted.c.id, UUID(as_uuid=True)),
+                UserProfile.project_id == project_id,
+            )
+            .values(token_count=cast(counted.c.token_count, Integer))
+            .execution_options(synchronize_session=False)
+        )
+
+    updated = []
+    for profile_id, (content, _) in changes.items():
+        if profile_id not in updated_attributes:
+            TRACE_LOG.error(
+                project_id,
+                user_id,
+                f"Profile {profile_id} not found",
+            )
+            continue
+        updated.append((profile_id, content, updated_attributes[profile_id]))
+    return updated
+
+
 async def update_user_profiles(
     user_id: str,
     project_id: str,
@@ -161,25 +590,12 @@ async def update_user_profiles(
         attributes
     ), "Length of profile_ids, attributes must be equal"
     with Session() as session:
-        db_profiles = []
-        for profile_id, content, attribute in zip(profile_ids, contents, attributes):
-            db_profile = (
-                session.query(UserProfile)
-                .filter_by(id=profile_id, user_id=user_id, project_id=project_id)
-                .one_or_none()
-            )
-            if db_profile is None:
-                TRACE_LOG.error(
-                    project_id,
-                    user_id,
-                    f"Profile {profile_id} not found",
-                )
-                continue
-            db_profile.content = content
-            if attribute is not None:
-                db_profile.attributes = attribute
-            db_profiles.append(profile_id)
+        embed_profiles = bulk_update_user_profiles(
+            session, user_id, project_id, profile_ids, contents, attributes
+        )
         session.commit()
+    db_profiles = [profile_id for profile_id, _, _ in embed_profiles]
+    await embed_user_profiles(user_id, project_id, embed_profiles)
     await refresh_user_profile_cache(user_id, project_id)
     return Promise.resolve(IdsData(ids=db_profiles))
 
@@ -218,8 +634,19 @@ async def delete_user_profiles(
 
 
 async def refresh_user_profile_cache(user_id: str, project_id: str) -> Promise[None]:
-    async with get_redis_client() as redis_client:
-        await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
+    """Write the fresh profiles through both cache tiers after an update,
+    instead of leaving the next read a cold miss"""
+    cache_key = user_profiles_cache_key(user_id, project_id)
+    version_key = user_profiles_version_key(user_id, project_id)
+    await mark_recent_write(user_id, project_id)
+    version = await bump_version(version_key, USER_PROFILES_VERSION_TTL)
+    # Read from the primary after bumping the version, so a concurrent update
+    # with an older version can't overwrite what we write here
+    user_profiles = load_user_profiles(user_id, project_id)
+    written = await set_user_profiles_cache(user_id, project_id, user_profiles, version)
+    if written:
+        USER_PROFILES_LOCAL_CACHE.set(cache_key, user_profiles, version)
+        await publish_invalidation(USER_PROFILES_LOCAL_CACHE.name, cache_key, version)
     return Promise.resolve(None)
 
 
@@ -264,6 +691,7 @@ async def add_update_delete_user_profiles(
                         project_id=project_id,
                         content=content,
                         attributes=attr,
+                        token_count=count_tokens(profile_str_repr(content, attr)),
                     )
                     for content, attr in zip(add_profiles, add_attributes)
                 ]
@@ -271,34 +699,26 @@ async def add_update_delete_user_profiles(
                 add_profile_ids = [p.id for p in add_db_profiles]
             else:
                 add_profile_ids = []
+            embed_profiles = list(zip(add_profile_ids, add_profiles, add_attributes))
             # 2. update existing profiles
-            update_db_profiles = []
-            for profile_id, content, attribute in zip(
-                update_profile_ids, update_contents, update_attributes
-            ):
-                db_profile = (
-                    session.query(UserProfile)
-                    .filter_by(id=profile_id, user_id=user_id, project_id=project_id)
-                    .one_or_none()
+            embed_profiles.extend(
+                bulk_update_user_profiles(
+                    session,
+                    user_id,
+                    project_id,
+                    update_profile_ids,
+                    update_contents,
+                    update_attributes,
                 )
-                if db_profile is None:
-                    TRACE_LOG.error(
-                        project_id,
-                        user_id,
-                        f"Profile {profile_id} not found",
-                    )
-                    continue
-                db_profile.content = content
-                if attribute is not None:
-                    db_profile.attributes = attribute
-                update_db_profiles.append(profile_id)
+            )
 
             # 3. delete profiles
-            session.query(UserProfile).filter(
-                UserProfile.id.in_(delete_profile_ids),
-                UserProfile.user_id == user_id,
-                UserProfile.project_id == project_id,
-            ).delete(synchronize_session=False)
+            if delete_profile_ids:
+                session.query(UserProfile).filter(
+                    UserProfile.id.in_(delete_profile_ids),
+                    UserProfile.user_id == user_id,
+                    UserProfile.project_id == project_id,
+                ).delete(synchronize_session=False)
 
             session.commit()
         except Exception as e:
@@ -312,5 +732,7 @@ async def add_update_delete_user_profiles(
                 CODE.SERVER_PARSE_ERROR, f"Error merging user profiles: {e}"
             )
 
+    # All the new and updated profiles in one embedding call
+    await embed_user_profiles(user_id, project_id, embed_profiles)
     await refresh_user_profile_cache(user_id, project_id)
     return Promise.resolve(IdsData(ids=add_profile_ids))
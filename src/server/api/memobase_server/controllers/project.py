@@ -1,10 +1,43 @@
+from datetime import datetime
+from functools import lru_cache
 from sqlalchemy import cast, String, func, desc
 from ..models.database import Project, User, UserProfile, UserEvent
 from ..models.utils import Promise, CODE
 from ..models.response import IdData, ProfileConfigData, ProjectUsersData, DailyUsage
-from ..connectors import Session
-from ..env import ProfileConfig, TelemetryKeyName
-from ..telemetry.capture_key import get_int_key, date_past_key
+from ..connectors import Session, ReadSession, use_read_replica
+from ..cache import (
+    LocalCache,
+    bump_version,
+    publish_invalidation,
+    wait_for_subscription,
+)
+from ..offload import run_cpu_bound
+from ..env import CONFIG, ProfileConfig, ProjectStatus, TelemetryKeyName
+from ..telemetry.capture_key import get_int_keys, int_key, date_past_key
+
+PROFILE_CONFIGS_LOCAL_CACHE = LocalCache(
+    "project_profile_configs",
+    CONFIG.cache_profile_configs_local_size,
+    CONFIG.cache_profile_configs_local_ttl,
+)
+PROJECT_CONTEXT_VERSION_TTL = 60 * 60 * 24
+
+
+def profile_config_version(updated_at: datetime) -> int:
+    return int(updated_at.timestamp() * 1_000_000)
+
+
+def project_context_version_key(project_id: str) -> str:
+    # Part of the cached context keys, see controllers/context.py
+    return f"project_context_version::{project_id}"
+
+
+@lru_cache(maxsize=256)
+def parse_profile_config(profile_config: str | None) -> ProfileConfig:
+    # Keyed by the config content, projects sharing a config share one instance
+    if not profile_config:
+        return ProfileConfig()
+    return ProfileConfig.load_config_string(profile_config)
 
 
 async def get_project_secret(project_id: str) -> Promise[str]:
@@ -32,17 +65,23 @@ async def get_project_status(project_id: str) -> Promise[str]:
 
 
 async def get_project_profile_config(project_id: str) -> Promise[ProfileConfig]:
+    profile_config = PROFILE_CONFIGS_LOCAL_CACHE.get(project_id)
+    if profile_config is not None:
+        return Promise.resolve(profile_config)
     with Session() as session:
         p = (
-            session.query(Project.profile_config)
+            session.query(Project.profile_config, Project.updated_at)
             .filter(Project.project_id == project_id)
             .one_or_none()
         )
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
-        if not p.profile_config:
-            return Promise.resolve(ProfileConfig())
-        p_parse = ProfileConfig.load_config_string(p.profile_config)
+    p_parse = await run_cpu_bound(
+        len(p.profile_config or ""), parse_profile_config, p.profile_config
+    )
+    PROFILE_CONFIGS_LOCAL_CACHE.set(
+        project_id, p_parse, profile_config_version(p.updated_at)
+    )
     return Promise.resolve(p_parse)
 
 
@@ -59,9 +98,41 @@ async def update_project_profile_config(
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         p.profile_config = profile_config
         session.commit()
+        version = profile_config_version(p.updated_at)
+    PROFILE_CONFIGS_LOCAL_CACHE.invalidate(project_id, version)
+    await publish_invalidation(PROFILE_CONFIGS_LOCAL_CACHE.name, project_id, version)
+    # The context language follows the config, the cached contexts are stale
+    await bump_version(
+        project_context_version_key(project_id), PROJECT_CONTEXT_VERSION_TTL
+    )
     return Promise.resolve(None)
 
 
+async def preload_project_profile_configs() -> Promise[int]:
+    """Warm the profile config cache with the most recently updated active projects"""
+    if not await wait_for_subscription(timeout=30):
+        return Promise.reject(
+            CODE.SERVICE_UNAVAILABLE, "Cache invalidation listener is not subscribed"
+        )
+    with Session() as session:
+        projects = (
+            session.query(
+                Project.project_id, Project.profile_config, Project.updated_at
+            )
+            .filter(Project.status == ProjectStatus.active)
+            .order_by(Project.updated_at.desc())
+            .limit(CONFIG.cache_profile_configs_local_size)
+            .all()
+        )
+    for p in projects:
+        PROFILE_CONFIGS_LOCAL_CACHE.set(
+            p.project_id,
+            parse_profile_config(p.profile_config),
+            profile_config_version(p.updated_at),
+        )
+    return Promise.resolve(len(projects))
+
+
 async def get_project_profile_config_string(
     project_id: str,
 ) -> Promise[ProfileConfigData]:
@@ -84,7 +155,8 @@ async def get_project_users(
     order_by: str = "updated_at",
     order_desc: bool = True,
 ) -> Promise[ProjectUsersData]:
-    with Session() as session:
+    # A listing across users, it can lag behind their latest writes
+    with ReadSession(await use_read_replica()) as session:
         profile_subq = (
             session.query(
                 UserProfile.user_id.label("user_id"),
@@ -152,20 +224,23 @@ async def get_project_usage(
     project_id: str, last_days: int = 7
 ) -> Promise[list[DailyUsage]]:
     query_dates = [date_past_key(i) for i in range(last_days)]
+    names = [
+        TelemetryKeyName.insert_blob_request,
+        TelemetryKeyName.insert_blob_success_request,
+        TelemetryKeyName.llm_input_tokens,
+        TelemetryKeyName.llm_output_tokens,
+    ]
+    values = await get_int_keys(
+        [int_key(name, project_id, use_date=qd) for qd in query_dates for name in names]
+    )
     results = []
-    for qd in query_dates:
-        total_insert = await get_int_key(
-            TelemetryKeyName.insert_blob_request, project_id, use_date=qd
-        )
-        total_success_insert = await get_int_key(
-            TelemetryKeyName.insert_blob_success_request, project_id, use_date=qd
-        )
-        total_input_token = await get_int_key(
-            TelemetryKeyName.llm_input_tokens, project_id, use_date=qd
-        )
-        total_output_token = await get_int_key(
-            TelemetryKeyName.llm_output_tokens, project_id, use_date=qd
-        )
+    for i, qd in enumerate(query_dates):
+        (
+            total_insert,
+            total_success_insert,
+            total_input_token,
+            total_output_token,
+        ) = values[i * len(names) : (i + 1) * len(names)]
         results.append(
             DailyUsage(
                 date=qd,
@@ -1,4 +1,5 @@
 from pydantic import ValidationError
+from sqlalchemy import select
 from ..models.utils import Promise
 from ..models.database import UserStatus
 from ..models.response import CODE, UserStatusesData, UserStatusData, IdData
@@ -8,28 +9,31 @@ from ..connectors import Session
 async def get_user_statuses(
     user_id: str, project_id: str, type: str, page: int = 1, page_size: int = 10
 ) -> Promise[UserStatusesData]:
+    stmt = (
+        select(
+            UserStatus.id,
+            UserStatus.type,
+            UserStatus.attributes,
+            UserStatus.created_at,
+            UserStatus.updated_at,
+        )
+        .where(
+            UserStatus.user_id == user_id,
+            UserStatus.project_id == project_id,
+            UserStatus.type == type,
+        )
+        .order_by(UserStatus.created_at.desc())
+        .offset((page - 1) * page_size)
+        .limit(page_size)
+    )
     with Session() as session:
-        status = (
-            session.query(UserStatus)
-            .filter_by(user_id=user_id, project_id=project_id, type=type)
-            .order_by(UserStatus.created_at.desc())
-            .offset((page - 1) * page_size)
-            .limit(page_size)
-            .all()
+        rows = session.execute(stmt).all()
+    # Trusted rows of the database, built without validation
+    return Promise.resolve(
+        UserStatusesData.model_construct(
+            statuses=[UserStatusData.model_construct(**row._asdict()) for row in rows]
         )
-        if status is None:
-            return Promise.resolve(UserStatusesData(statuses=[]))
-        data = [
-            {
-                "id": s.id,
-                "type": s.type,
-                "attributes": s.attributes,
-                "created_at": s.created_at,
-                "updated_at": s.updated_at,
-            }
-            for s in status
-        ]
-        return Promise.resolve(UserStatusesData(statuses=data))
+    )
 
 
 async def append_user_status(
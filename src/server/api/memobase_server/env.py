@@ -5,11 +5,13 @@ Initialize logger, encoder, and config.
 import os
 import datetime
 import json
+import hashlib
 import yaml
 import logging
 import tiktoken
 import dataclasses
 from dataclasses import dataclass, field
+from functools import cached_property
 from typing import Optional, Literal, Union
 from dotenv import load_dotenv
 from zoneinfo import ZoneInfo
@@ -86,6 +88,41 @@ class Config:
     max_pre_profile_token_size: int = 128
     llm_tab_separator: str = "::"
     cache_user_profiles_ttl: int = 60 * 20  # 20 minutes
+    cache_user_profiles_local_size: int = 4096  # per worker, 0 disables
+    cache_user_profiles_local_ttl: int = 60
+    cache_user_profiles_lease_ms: int = 0  # 0 disables the cross-worker lease
+    cache_profile_configs_local_size: int = 1024  # per worker, 0 disables
+    cache_profile_configs_local_ttl: int = 60 * 10  # 10 minutes
+    cache_user_context_ttl: int = 60 * 10  # 10 minutes, 0 disables
+    cache_user_context_prewarm: bool = False
+    cache_project_auth_local_size: int = 4096  # per worker, 0 disables
+    cache_project_auth_local_ttl: int = 60  # bounds secret and status staleness
+    cpu_offload_workers: int = 4
+    cpu_offload_min_size: int = 16384  # characters, smaller inputs run inline
+    billing_flush_interval: int = 5  # seconds, 0 writes every LLM call through
+    billing_quota_ttl: int = 30  # seconds, 0 reads the billing on every insert
+    billing_quota_near_limit_tokens: int = 100000
+
+    # Database connections
+    database_pool_mode: Literal["pool", "pgbouncer"] = "pool"
+    database_pool_size: int = 75  # per worker, 0 opens a connection per checkout
+    database_max_overflow: int = 50
+    database_request_scoped_session: bool = False
+    database_read_your_writes_ms: int = 5000
+    database_replica_eject_seconds: int = 30
+    database_auto_migrate: bool = False
+
+    # Event storage
+    partition_user_events: bool = False
+    event_partition_premake_months: int = 3
+    event_partition_retention_months: Optional[int] = None  # None keeps all
+    event_partition_drop_expired: bool = False  # only detach by default
+    event_partition_maintenance_interval: int = 60 * 60 * 6  # 6 hours
+    event_compaction_after_days: Optional[int] = None  # None disables compaction
+    event_compaction_period: Literal["week", "month"] = "week"
+    event_compaction_prune_originals: bool = False
+    event_compaction_interval: int = 60 * 60  # 1 hour
+    event_compaction_max_users_per_run: int = 100
 
     # LLM
     language: Literal["en", "zh"] = "en"
@@ -99,6 +136,7 @@ class Config:
     summary_llm_model: str = None
 
     enable_event_embedding: bool = True
+    enable_profile_embedding: bool = False
     embedding_provider: Literal["openai", "jina"] = "openai"
     embedding_api_key: str = None
     embedding_base_url: str = None
@@ -119,6 +157,8 @@ class Config:
     event_tags: list[dict] = field(default_factory=list)
     # Telemetry
     telemetry_deployment_environment: str = "local"
+    telemetry_instrument_fastapi: bool = True
+    telemetry_counter_flush_interval: int = 1  # seconds, 0 writes every request through
 
     @classmethod
     def _process_env_vars(cls, config_dict):
@@ -190,7 +230,7 @@ class Config:
 
     def __post_init__(self):
         assert self.llm_api_key is not None, "llm_api_key is required"
-        if self.enable_event_embedding:
+        if self.enable_event_embedding or self.enable_profile_embedding:
             if self.embedding_api_key is None and (
                 self.llm_style == self.embedding_provider == "openai"
             ):
@@ -199,7 +239,7 @@ class Config:
                 self.embedding_base_url = self.llm_base_url
             assert (
                 self.embedding_api_key is not None
-            ), "embedding_api_key is required for event embedding"
+            ), "embedding_api_key is required for event or profile embedding"
 
             if self.embedding_provider == "jina":
                 self.embedding_base_url = (
@@ -213,6 +253,16 @@ class Config:
             [UserProfileTopic(**up) for up in self.additional_user_profiles]
         if self.overwrite_user_profiles:
             [UserProfileTopic(**up) for up in self.overwrite_user_profiles]
+        # The request holds its connection across LLM calls, only cheap when it
+        # is a PgBouncer client connection and not a slot of our own pool
+        assert (
+            not self.database_request_scoped_session
+            or self.database_pool_mode == "pgbouncer"
+        ), "database_request_scoped_session requires database_pool_mode: pgbouncer"
+        assert (
+            self.event_partition_retention_months is None
+            or self.event_partition_retention_months >= 0
+        ), "event_partition_retention_months must be >= 0"
 
     @property
     def timezone(self) -> timezone:
@@ -243,6 +293,13 @@ class ProfileConfig:
         if self.overwrite_user_profiles:
             [UserProfileTopic(**up) for up in self.overwrite_user_profiles]
 
+    @cached_property
+    def content_hash(self) -> str:
+        # Hashed once per instance, the parsed configs are shared and never changed
+        return hashlib.sha256(
+            json.dumps(dataclasses.asdict(self), sort_keys=True, default=str).encode()
+        ).hexdigest()
+
     @classmethod
     def load_config_string(cls, config_string: str) -> "Config":
         overwrite_config = yaml.safe_load(config_string)
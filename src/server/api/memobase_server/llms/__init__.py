@@ -1,7 +1,8 @@
 import asyncio
 import time
 from ..prompts.utils import convert_response_to_json
-from ..utils import get_encoded_tokens
+from ..utils import count_tokens_batch
+from ..offload import run_cpu_bound
 from ..env import CONFIG, LOG
 from ..controllers.billing import project_cost_token_billing
 from ..models.utils import Promise
@@ -45,14 +46,14 @@ async def llm_complete(
         LOG.error(f"Error in llm_complete: {e}")
         return Promise.reject(CODE.SERVICE_UNAVAILABLE, f"Error in llm_complete: {e}")
 
-    in_tokens = len(
-        get_encoded_tokens(
-            prompt
-            + (system_prompt or "")
-            + "\n".join([m["content"] for m in history_messages])
-        )
+    prompt_str = (
+        prompt
+        + (system_prompt or "")
+        + "\n".join([m["content"] for m in history_messages])
+    )
+    in_tokens, out_tokens = await run_cpu_bound(
+        len(prompt_str) + len(results), count_tokens_batch, [prompt_str, results]
     )
-    out_tokens = len(get_encoded_tokens(results))
 
     # await project_cost_token_billing(project_id, in_tokens, out_tokens)
     asyncio.create_task(project_cost_token_billing(project_id, in_tokens, out_tokens))
@@ -80,7 +81,7 @@ async def llm_complete(
 
     if not json_mode:
         return Promise.resolve(results)
-    parse_dict = convert_response_to_json(results)
+    parse_dict = await run_cpu_bound(len(results), convert_response_to_json, results)
     if parse_dict is not None:
         return Promise.resolve(parse_dict)
     else:
@@ -9,7 +9,8 @@ from ...models.database import DEFAULT_PROJECT_ID
 from .jina_embedding import jina_embedding
 from .openai_embedding import openai_embedding
 from ...telemetry import telemetry_manager, HistogramMetricName, CounterMetricName
-from ...utils import get_encoded_tokens
+from ...utils import count_tokens_batch
+from ...offload import run_cpu_bound
 
 FACTORIES = {"openai": openai_embedding, "jina": jina_embedding}
 assert (
@@ -49,7 +50,10 @@ async def get_embedding(
     except Exception as e:
         LOG.error(f"Error in get_embedding: {e} {format_exc()}")
         return Promise.reject(CODE.SERVICE_UNAVAILABLE, f"Error in get_embedding: {e}")
-    embedding_tokens = len(get_encoded_tokens("\n".join(texts)))
+    token_counts = await run_cpu_bound(
+        sum(len(t) for t in texts), count_tokens_batch, texts
+    )
+    embedding_tokens = sum(token_counts)
     telemetry_manager.increment_counter_metric(
         CounterMetricName.EMBEDDING_TOKENS,
         embedding_tokens,
@@ -1,7 +1,8 @@
 import os
+import re
 import uuid
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, timezone
 from sqlalchemy import (
     text,
     VARCHAR,
@@ -15,9 +16,11 @@ from sqlalchemy import (
     Boolean,
     PrimaryKeyConstraint,
     ForeignKeyConstraint,
+    Computed,
+    inspect,
 )
 from dataclasses import dataclass
-from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID, TSVECTOR
 from sqlalchemy.orm import (
     relationship,
     Mapped,
@@ -26,6 +29,7 @@ from sqlalchemy.orm import (
     object_session,
 )
 from sqlalchemy.sql import func
+from sqlalchemy.schema import CreateColumn, CreateIndex
 from sqlalchemy import event
 from .blob import BlobType
 from ..env import (
@@ -43,6 +47,14 @@ REG = registry()
 DEFAULT_PROJECT_ID = "__root__"
 DEFAULT_PROJECT_SECRET = "__root__"
 
+# 'simple' keeps the lexical index language-agnostic (en/zh projects share it)
+EVENT_SEARCH_TS_CONFIG = "simple"
+EVENT_TSV_EXPRESSION = (
+    f"to_tsvector('{EVENT_SEARCH_TS_CONFIG}', coalesce(event_data->>'event_tip', '')) || "
+    f"jsonb_to_tsvector('{EVENT_SEARCH_TS_CONFIG}', "
+    f"coalesce(event_data->'event_tags', '[]'::jsonb), '[\"string\"]')"
+)
+
 
 def next_month_first_day() -> datetime:
     today = datetime.now()
@@ -53,6 +65,11 @@ def next_month_first_day() -> datetime:
     return datetime(today.year, today.month + 1, 1)
 
 
+def shift_month_first_day(dt: datetime, months: int) -> datetime:
+    month_index = dt.year * 12 + (dt.month - 1) + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1, tzinfo=dt.tzinfo)
+
+
 @dataclass
 class Base:
     __abstract__ = True
@@ -77,6 +94,44 @@ class Base:
 SHORT_ENUM_SIZE = 16
 
 
+def ensure_table_schema(
+    connection,
+    table: Table,
+    new_columns: list[str],
+    concurrently: bool = True,
+    dry_run: bool = False,
+) -> list[str]:
+    """create_all() never alters existing tables, so add the columns and indexes
+    introduced after a table was first created, and return the missing ones.
+
+    Adding a stored generated column rewrites the table once. Indexes are built
+    with CREATE INDEX CONCURRENTLY when `concurrently`, which needs an autocommit
+    connection; a failed concurrent build leaves an invalid index that has to be
+    dropped by hand."""
+    inspector = inspect(connection)
+    columns = {c["name"] for c in inspector.get_columns(table.name)}
+    indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+    missing_columns = [name for name in new_columns if name not in columns]
+    missing_indexes = [index for index in table.indexes if index.name not in indexes]
+    if dry_run:
+        return missing_columns + [index.name for index in missing_indexes]
+    for name in missing_columns:
+        column_ddl = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+        connection.execute(
+            text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {column_ddl}")
+        )
+    for index in missing_indexes:
+        index_ddl = str(
+            CreateIndex(index, if_not_exists=True).compile(dialect=connection.dialect)
+        )
+        if concurrently:
+            index_ddl = re.sub(
+                r"^CREATE (UNIQUE )?INDEX", r"CREATE \1INDEX CONCURRENTLY", index_ddl
+            )
+        connection.execute(text(index_ddl))
+    return missing_columns + [index.name for index in missing_indexes]
+
+
 @REG.mapped_as_dataclass
 class Billing(Base):
     __tablename__ = "billings"
@@ -393,10 +448,39 @@ class UserProfile(Base):
         foreign_keys=[user_id, project_id],
     )
 
+    # Only read by the embedding ranking of /users/context, not loaded by default
+    embedding: Mapped[Optional[Vector]] = mapped_column(
+        Vector(dim=CONFIG.embedding_dim), nullable=True, default=None, deferred=True
+    )
+    # Tokens of the profile line in the context, counted on write
+    token_count: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, default=None
+    )
+    # Generated from attributes, so topic filters and limits run in SQL
+    topic: Mapped[Optional[str]] = mapped_column(
+        TEXT,
+        Computed("btrim(attributes->>'topic')", persisted=True),
+        nullable=True,
+        init=False,
+    )
+    sub_topic: Mapped[Optional[str]] = mapped_column(
+        TEXT,
+        Computed("btrim(attributes->>'sub_topic')", persisted=True),
+        nullable=True,
+        init=False,
+    )
+
     __table_args__ = (
         PrimaryKeyConstraint("id", "project_id"),
         Index("idx_user_profiles_user_id_project_id", "user_id", "project_id"),
         Index("idx_user_profiles_user_id_id_project_id", "user_id", "project_id", "id"),
+        Index(
+            "idx_user_profiles_user_id_project_id_topic",
+            "user_id",
+            "project_id",
+            "topic",
+            "sub_topic",
+        ),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
@@ -405,6 +489,15 @@ class UserProfile(Base):
         ),
     )
 
+    @classmethod
+    def ensure_schema(cls, connection, dry_run: bool = False) -> list[str]:
+        return ensure_table_schema(
+            connection,
+            cls.__table__,
+            ["embedding", "token_count", "topic", "sub_topic"],
+            dry_run=dry_run,
+        )
+
 
 @REG.mapped_as_dataclass
 class UserEvent(Base):
@@ -436,16 +529,69 @@ class UserEvent(Base):
         Vector(dim=CONFIG.embedding_dim), nullable=True, default=None
     )
 
+    # Generated by Postgres from event_tip and event tags, used by lexical search
+    event_tsv: Mapped[Optional[str]] = mapped_column(
+        TSVECTOR,
+        Computed(EVENT_TSV_EXPRESSION, persisted=True),
+        nullable=True,
+        init=False,
+        deferred=True,
+    )
+    has_event_tip: Mapped[Optional[bool]] = mapped_column(
+        Boolean,
+        Computed("(event_data->>'event_tip') IS NOT NULL", persisted=True),
+        nullable=True,
+        init=False,
+    )
+    # Set on events that were compacted into a digest and kept
+    digest_id: Mapped[Optional[uuid.UUID]] = mapped_column(
+        UUID(as_uuid=True), nullable=True, default=None, init=False
+    )
+    # Tokens of the event in the context, counted on write
+    token_count: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, default=None
+    )
+
+    # A partitioned table needs the partition key in its primary key
     __table_args__ = (
-        PrimaryKeyConstraint("id", "project_id"),
+        (
+            PrimaryKeyConstraint("id", "project_id", "created_at")
+            if CONFIG.partition_user_events
+            else PrimaryKeyConstraint("id", "project_id")
+        ),
         Index("idx_user_events_user_id_project_id", "user_id", "project_id"),
         Index("idx_user_events_user_id_id_project_id", "user_id", "project_id", "id"),
+        Index(
+            "idx_user_events_user_id_project_id_created_at",
+            "user_id",
+            "project_id",
+            text("created_at DESC"),
+        ),
+        Index(
+            "idx_user_events_user_id_project_id_created_at_event_tip",
+            "user_id",
+            "project_id",
+            text("created_at DESC"),
+            postgresql_where=text("has_event_tip"),
+        ),
+        Index("idx_user_events_event_tsv", "event_tsv", postgresql_using="gin"),
+        Index(
+            "idx_user_events_event_data",
+            "event_data",
+            postgresql_using="gin",
+            postgresql_ops={"event_data": "jsonb_path_ops"},
+        ),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
             ondelete="CASCADE",
             onupdate="CASCADE",
         ),
+        (
+            {"postgresql_partition_by": "RANGE (created_at)"}
+            if CONFIG.partition_user_events
+            else {}
+        ),
     )
 
     @classmethod
@@ -494,6 +640,117 @@ class UserEvent(Base):
             LOG.warning(f"Failed to check embedding dimension: {str(e)}")
             raise e
 
+    @classmethod
+    def ensure_schema(cls, connection, dry_run: bool = False) -> list[str]:
+        # Postgres can't build an index on a partitioned table concurrently
+        return ensure_table_schema(
+            connection,
+            cls.__table__,
+            ["event_tsv", "has_event_tip", "digest_id", "token_count"],
+            concurrently=not cls.is_partitioned(connection),
+            dry_run=dry_run,
+        )
+
+    @classmethod
+    def is_partitioned(cls, session) -> bool:
+        sql = text(
+            """
+        SELECT EXISTS (
+            SELECT 1
+            FROM pg_partitioned_table
+            JOIN pg_class ON pg_partitioned_table.partrelid = pg_class.oid
+            JOIN pg_namespace ON pg_class.relnamespace = pg_namespace.oid
+            WHERE pg_class.relname = :table_name
+            AND pg_namespace.nspname = current_schema()
+        );
+        """
+        )
+        return bool(session.execute(sql, {"table_name": cls.__tablename__}).scalar())
+
+    @classmethod
+    def list_monthly_partitions(cls, session) -> dict[str, datetime]:
+        """Map each monthly partition name to the first day of its month (UTC)"""
+        sql = text(
+            """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        JOIN pg_namespace ON parent.relnamespace = pg_namespace.oid
+        WHERE parent.relname = :table_name
+        AND pg_namespace.nspname = current_schema();
+        """
+        )
+        names = session.execute(sql, {"table_name": cls.__tablename__}).scalars()
+        pattern = re.compile(rf"^{cls.__tablename__}_p(\d{{4}})(\d{{2}})$")
+        partitions = {}
+        for name in names:
+            m = pattern.match(name)
+            if m is None:
+                continue
+            partitions[name] = datetime(
+                int(m.group(1)), int(m.group(2)), 1, tzinfo=timezone.utc
+            )
+        return partitions
+
+    @classmethod
+    def create_monthly_partitions(cls, session, months_ahead: int) -> list[str]:
+        """Create the partitions of this month and the next `months_ahead` months"""
+        table_name = cls.__tablename__
+        session.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {table_name}_default "
+                f"PARTITION OF {table_name} DEFAULT"
+            )
+        )
+        session.commit()
+        existing = cls.list_monthly_partitions(session)
+        this_month = shift_month_first_day(datetime.now(timezone.utc), 0)
+        created = []
+        for i in range(months_ahead + 1):
+            start = shift_month_first_day(this_month, i)
+            end = shift_month_first_day(start, 1)
+            partition_name = f"{table_name}_p{start:%Y%m}"
+            if partition_name in existing:
+                continue
+            try:
+                session.execute(
+                    text(
+                        f"CREATE TABLE IF NOT EXISTS {partition_name} "
+                        f"PARTITION OF {table_name} "
+                        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                    )
+                )
+                session.commit()
+                created.append(partition_name)
+            except Exception as e:
+                # rows of this month already landed in the default partition
+                session.rollback()
+                LOG.warning(f"Failed to create partition {partition_name}: {e}")
+        return created
+
+    @classmethod
+    def expire_monthly_partitions(
+        cls, session, retention_months: int, drop: bool = False
+    ) -> list[str]:
+        """Detach (and optionally drop) partitions older than `retention_months`"""
+        table_name = cls.__tablename__
+        cutoff = shift_month_first_day(datetime.now(timezone.utc), -retention_months)
+        expired = []
+        for partition_name, start in sorted(
+            cls.list_monthly_partitions(session).items(), key=lambda x: x[1]
+        ):
+            if shift_month_first_day(start, 1) > cutoff:
+                continue
+            session.execute(
+                text(f"ALTER TABLE {table_name} DETACH PARTITION {partition_name}")
+            )
+            if drop:
+                session.execute(text(f"DROP TABLE {partition_name}"))
+            session.commit()
+            expired.append(partition_name)
+        return expired
+
 
 @REG.mapped_as_dataclass
 class UserStatus(Base):
@@ -81,6 +81,9 @@ class ProfileData(BaseModel):
         None,
         description="User profile attributes in JSON, containing 'topic', 'sub_topic'",
     )
+    token_count: Optional[int] = Field(
+        None, description="Tokens of the profile line in the context"
+    )
 
 
 class ProfileDelta(BaseModel):
@@ -96,12 +99,24 @@ class EventTag(BaseModel):
     value: str = Field(..., description="The event tag value")
 
 
+class EventDigest(BaseModel):
+    period: Literal["week", "month"] = Field(..., description="The digest period")
+    period_start: str = Field(..., description="First day of the period, ISO date")
+    period_end: str = Field(..., description="First day after the period, ISO date")
+    source_event_count: int = Field(
+        ..., description="Number of events compacted into this digest"
+    )
+
+
 class EventData(BaseModel):
     profile_delta: Optional[list[ProfileDelta]] = Field(
         None, description="List of profile data"
     )
     event_tip: Optional[str] = Field(None, description="Event tip")
     event_tags: Optional[list[EventTag]] = Field(None, description="List of event tags")
+    event_digest: Optional[EventDigest] = Field(
+        None, description="Set when this event is a digest of older events"
+    )
 
 
 class UserEventData(BaseModel):
@@ -114,10 +129,17 @@ class UserEventData(BaseModel):
         None, description="Timestamp when the event was last updated"
     )
     similarity: Optional[float] = Field(None, description="Similarity score")
+    token_count: Optional[int] = Field(
+        None, description="Tokens of the event in the context"
+    )
 
 
 class ContextData(BaseModel):
     context: str = Field(..., description="Context string")
+    degraded_stages: Optional[list[str]] = Field(
+        None,
+        description="Stages skipped to meet `timeout_ms`: `profile_filter` falls back to the profiles ranked by `prefer_topics` and updated time, `event_search` falls back to the latest events",
+    )
 
 
 class UserData(BaseModel):
@@ -143,6 +165,10 @@ class StrIntData(BaseModel):
     data: dict[str, int] = Field(..., description="String to int mapping")
 
 
+class StrStrData(BaseModel):
+    data: dict[str, str] = Field(..., description="String to string mapping")
+
+
 class MessageData(BaseModel):
     data: list[OpenAICompatibleMessage] = Field(..., description="List of messages")
 
@@ -0,0 +1,26 @@
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+from .env import CONFIG
+
+T = TypeVar("T")
+
+# Threads, not processes: tiktoken releases the GIL while encoding, and the
+# YAML and JSON inputs are too small to pay for pickling them to a process
+CPU_OFFLOAD_EXECUTOR = ThreadPoolExecutor(
+    max_workers=CONFIG.cpu_offload_workers, thread_name_prefix="memobase-cpu"
+)
+
+
+async def run_cpu_bound(
+    size: int, func: Callable[..., T], *args: Any, **kwargs: Any
+) -> T:
+    """Run func inline when its input size (in characters) is small, otherwise in
+    the shared executor, so one large input doesn't stall the event loop"""
+    if size < CONFIG.cpu_offload_min_size:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        CPU_OFFLOAD_EXECUTOR, partial(func, *args, **kwargs)
+    )
@@ -0,0 +1,27 @@
+ADD_KWARGS = {
+    "prompt_id": "summary_events",
+}
+SUMMARY_PROMPT = """You are given a list of events that happened to the user during one {period}, in time order.
+Each event starts with its date, followed by what happened and the event tags.
+Write a digest of the {period} that will replace these events in the user's memory.
+
+## Requirement
+- Keep the facts that matter for the user: decisions, plans, preferences, important people and places.
+- Merge repeated or similar events into one sentence.
+- Keep the dates of the important events.
+- Not more than 8 sentences, no markdown headings or lists.
+
+The result should use the same language as the input.
+"""
+
+
+def get_prompt(period: str) -> str:
+    return SUMMARY_PROMPT.format(period=period)
+
+
+def get_kwargs() -> dict:
+    return ADD_KWARGS
+
+
+if __name__ == "__main__":
+    print(get_prompt("week"))
@@ -1,7 +1,22 @@
+import asyncio
 from datetime import datetime, timedelta
+from ..env import CONFIG, LOG
 from ..connectors import get_redis_client, PROJECT_ID
 from ..models.database import DEFAULT_PROJECT_ID
 
+# INCRBY every key, and set its expiry only when the increment created it
+INCR_WITH_EXPIRE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    local value = tonumber(ARGV[2 * i - 1])
+    if redis.call('INCRBY', key, value) == value then
+        redis.call('EXPIRE', key, ARGV[2 * i])
+    end
+end
+"""
+
+# (name, project_id) -> count not written yet, for counters bumped on every request
+PENDING_INT_KEYS: dict[tuple[str, str], int] = {}
+
 
 def date_key():
     return datetime.now().strftime("%Y-%m-%d")
@@ -19,19 +34,80 @@ def head_key(project_id: str):
     return f"memobase_telemetry::{PROJECT_ID}::{project_id}"
 
 
+def int_key(
+    name: str,
+    project_id: str = DEFAULT_PROJECT_ID,
+    in_month: bool = False,
+    use_date: str = None,
+) -> str:
+    if in_month:
+        return f"{head_key(project_id)}::{name}::{month_key()}"
+    using_date = use_date or date_key()
+    return f"{head_key(project_id)}::{name}::{using_date}"
+
+
 async def capture_int_key(
     name: str,
     value: int = 1,
     expire_days: int = 14,
     project_id: str = DEFAULT_PROJECT_ID,
 ):
-    key = f"{head_key(project_id)}::{name}::{date_key()}"
-    key_month = f"{head_key(project_id)}::{name}::{month_key()}"
+    await capture_int_keys([(name, project_id, value)], expire_days=expire_days)
+
+
+async def capture_int_keys(
+    counts: list[tuple[str, str, int]],
+    expire_days: int = 14,
+):
+    """capture_int_key for many (name, project_id, value) at once, in one round trip"""
+    keys, args = [], []
+    for name, project_id, value in counts:
+        keys.append(int_key(name, project_id))
+        args.extend([value, expire_days * 24 * 60 * 60])
+        keys.append(int_key(name, project_id, in_month=True))
+        args.extend([value, 30 * expire_days * 24 * 60 * 60])
+    if not keys:
+        return
     async with get_redis_client() as r_c:
-        await r_c.incrby(key, value)
-        await r_c.incrby(key_month, value)
-        await r_c.expire(key, expire_days * 24 * 60 * 60)
-        await r_c.expire(key_month, 30 * expire_days * 24 * 60 * 60)
+        await r_c.eval(INCR_WITH_EXPIRE_SCRIPT, len(keys), *keys, *args)
+
+
+async def buffer_int_key(
+    name: str,
+    value: int = 1,
+    project_id: str = DEFAULT_PROJECT_ID,
+):
+    """capture_int_key for the counters of hot requests, summed in memory and
+    written by flush_int_keys"""
+    if CONFIG.telemetry_counter_flush_interval <= 0:
+        await capture_int_key(name, value, project_id=project_id)
+        return
+    key = (name, project_id)
+    PENDING_INT_KEYS[key] = PENDING_INT_KEYS.get(key, 0) + value
+
+
+async def flush_int_keys():
+    counts = [
+        (name, project_id, value)
+        for (name, project_id), value in PENDING_INT_KEYS.items()
+    ]
+    PENDING_INT_KEYS.clear()
+    try:
+        await capture_int_keys(counts)
+    except BaseException as e:
+        # Keep them for the next flush, also when cancelled at shutdown
+        for name, project_id, value in counts:
+            key = (name, project_id)
+            PENDING_INT_KEYS[key] = PENDING_INT_KEYS.get(key, 0) + value
+        if not isinstance(e, Exception):
+            raise
+        LOG.error(f"Failed to flush telemetry counters: {e}")
+
+
+async def int_keys_flush_loop():
+    while True:
+        await asyncio.sleep(CONFIG.telemetry_counter_flush_interval)
+        await flush_int_keys()
 
 
 async def get_int_key(
@@ -40,16 +116,18 @@ async def get_int_key(
     in_month: bool = False,
     use_date: str = None,
 ) -> int:
-    if in_month:
-        key = f"{head_key(project_id)}::{name}::{month_key()}"
-    else:
-        using_date = use_date or date_key()
-        key = f"{head_key(project_id)}::{name}::{using_date}"
+    key = int_key(name, project_id, in_month=in_month, use_date=use_date)
     async with get_redis_client() as r_c:
         return int((await r_c.get(key)) or 0)
 
 
-if __name__ == "__main__":
-    import asyncio
+async def get_int_keys(keys: list[str]) -> list[int]:
+    """Values of many int_key keys in one MGET"""
+    if not keys:
+        return []
+    async with get_redis_client() as r_c:
+        return [int(v or 0) for v in await r_c.mget(keys)]
+
 
+if __name__ == "__main__":
     print(asyncio.run(capture_int_key("test_key")))
@@ -36,6 +36,7 @@ class CounterMetricName(Enum):
     LLM_TOKENS_INPUT = "llm_input_tokens_total"
     LLM_TOKENS_OUTPUT = "llm_output_tokens_total"
     EMBEDDING_TOKENS = "embedding_tokens_total"
+    CONTEXT_DEGRADED = "context_degraded_total"
 
     def get_description(self) -> str:
         """Get the description for this metric."""
@@ -46,6 +47,7 @@ class CounterMetricName(Enum):
             CounterMetricName.LLM_TOKENS_INPUT: "Total number of input tokens",
             CounterMetricName.LLM_TOKENS_OUTPUT: "Total number of output tokens",
             CounterMetricName.EMBEDDING_TOKENS: "Total number of embedding tokens",
+            CounterMetricName.CONTEXT_DEGRADED: "Total number of context stages skipped for the deadline",
         }
         return descriptions[self]
 
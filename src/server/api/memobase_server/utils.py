@@ -11,12 +11,16 @@ from .models.database import GeneralBlob
 from .models.response import UserEventData, EventData
 from .models.utils import Promise, CODE
 from .connectors import get_redis_client, PROJECT_ID
+from .offload import run_cpu_bound
 
 LIST_INT_REGEX = re.compile(r"\[\s*(?:\d+(?:\s*,\s*\d+)*\s*)?\]")
 
 
 def event_str_repr(event: UserEventData) -> str:
-    event_data = event.event_data
+    return event_data_str_repr(event.event_data)
+
+
+def event_data_str_repr(event_data: EventData) -> str:
     if event_data.event_tip is None:
         profile_deltas = [
             f"- {ed.attributes['topic']}::{ed.attributes['sub_topic']}: {ed.content}"
@@ -81,6 +85,20 @@ def get_encoded_tokens(content: str) -> list[int]:
     return ENCODER.encode(content)
 
 
+def count_tokens(content: str) -> int:
+    return len(get_encoded_tokens(content))
+
+
+def count_tokens_batch(contents: list[str]) -> list[int]:
+    # Not encode_batch, it starts a thread pool on every call. Large inputs are
+    # already moved off the event loop by run_cpu_bound
+    return [len(ENCODER.encode(content)) for content in contents]
+
+
+def profile_str_repr(content: str, attributes: dict) -> str:
+    return f"{attributes.get('topic')}::{attributes.get('sub_topic')}: {content}"
+
+
 def get_decoded_tokens(tokens: list[int]) -> str:
     return ENCODER.decode(tokens)
 
@@ -137,8 +155,9 @@ def get_blob_str(blob: Blob):
             raise ValueError(f"Unsupported Blob Type: {blob.type}")
 
 
-def get_blob_token_size(blob: Blob):
-    return len(get_encoded_tokens(get_blob_str(blob)))
+async def get_blob_token_size(blob: Blob) -> int:
+    blob_str = get_blob_str(blob)
+    return await run_cpu_bound(len(blob_str), count_tokens, blob_str)
 
 
 def seconds_from_now(dt: datetime):
@@ -0,0 +1,14 @@
+import dotenv
+
+dotenv.load_dotenv()
+import sys
+from memobase_server.connectors import migrate_schema
+
+# Add the columns and indexes newer versions introduced to an existing database.
+# `--dry-run` only lists them
+dry_run = "--dry-run" in sys.argv
+missing = migrate_schema(dry_run=dry_run)
+if not missing:
+    print("Database schema is up to date")
+for name in missing:
+    print(f"{'Missing' if dry_run else 'Added'}: {name}")
@@ -34,6 +34,14 @@ def test_health_check(client, db_env):
     assert d["errno"] == 0
 
 
+def test_auth_middleware_rejects_missing_token():
+    response = TestClient(app).get(f"{PREFIX}/users/profile/some-user")
+    d = response.json()
+    assert response.status_code == 401
+    assert d["errno"] == 401
+    assert d["errmsg"].startswith(f"Unauthorized access to {PREFIX}/users/profile/")
+
+
 @pytest.fixture
 def mock_llm_complete():
     with patch(
@@ -478,6 +486,24 @@ async def test_api_user_event(
     ]
     print(d)
 
+    response = client.get(f"{PREFIX}/users/event/{u_id}?tags=emotion")
+    d = response.json()
+    assert d["errno"] == 0
+    assert len(d["data"]["events"]) == 1
+
+    response = client.get(
+        f"{PREFIX}/users/event/{u_id}",
+        params={"tag_values_json": '{"emotion": "sad"}'},
+    )
+    d = response.json()
+    assert d["errno"] == 0
+    assert len(d["data"]["events"]) == 0
+
+    response = client.get(f"{PREFIX}/users/event/{u_id}?tags=goal")
+    d = response.json()
+    assert d["errno"] == 0
+    assert len(d["data"]["events"]) == 0
+
     response = client.delete(f"{PREFIX}/users/{u_id}")
     d = response.json()
     assert response.status_code == 200
@@ -598,6 +624,30 @@ async def test_api_event_search(
     assert np.allclose(d["data"]["events"][0]["similarity"], 1)
     print(d["data"])
 
+    response = client.get(
+        f"{PREFIX}/users/event/search/{u_id}?query=happy&search_mode=lexical"
+    )
+    d = response.json()
+    assert response.status_code == 200
+    assert d["errno"] == 0
+    assert len(d["data"]["events"]) == 1
+
+    response = client.get(
+        f"{PREFIX}/users/event/search/{u_id}?query=unrelated&search_mode=lexical"
+    )
+    d = response.json()
+    assert d["errno"] == 0
+    assert len(d["data"]["events"]) == 0
+
+    response = client.get(
+        f"{PREFIX}/users/event/search/{u_id}?query=happy&search_mode=hybrid"
+    )
+    d = response.json()
+    assert response.status_code == 200
+    assert d["errno"] == 0
+    assert len(d["data"]["events"]) == 1
+    assert np.allclose(d["data"]["events"][0]["similarity"], 2 / 61)
+
     response = client.delete(f"{PREFIX}/users/{u_id}")
     d = response.json()
     assert response.status_code == 200
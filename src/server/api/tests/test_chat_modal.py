@@ -376,3 +376,29 @@ async def test_chat_organize_modal(
     assert mock_extract_llm_complete.await_count == 1
     assert mock_merge_llm_complete.await_count == 4
     assert mock_organize_llm_complete.await_count == 1
+
+
+def test_compiled_profile_config():
+    from memobase_server.env import ProfileConfig
+    from memobase_server.controllers.modal.chat.compiled import (
+        get_compiled_profile_config,
+    )
+
+    config = ProfileConfig()
+    compiled = get_compiled_profile_config(config)
+    assert get_compiled_profile_config(ProfileConfig()) is compiled
+    # The content hash is kept on the shared config, not redone per lookup
+    assert "content_hash" in vars(config)
+    assert (
+        "content_preferences",
+        "protagonist_archetype",
+    ) in compiled.allowed_topic_subtopics
+    assert compiled.event_tag_names == {"emotion", "goal"}
+
+    other = get_compiled_profile_config(
+        ProfileConfig(
+            overwrite_user_profiles=[{"topic": "work", "sub_topics": ["title"]}]
+        )
+    )
+    assert other is not compiled
+    assert other.allowed_topic_subtopics == {("work", "title")}
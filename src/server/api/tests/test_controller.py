@@ -1,8 +1,74 @@
 import pytest
+import asyncio
+import threading
+from contextlib import contextmanager
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, Mock, patch
+from sqlalchemy import create_engine, select, text, update
+from memobase_server.connectors import (
+    DB_ENGINE,
+    ReadReplica,
+    ReadSession,
+    Session,
+    get_redis_client,
+    migrate_schema,
+    recent_write_key,
+    request_unit_of_work,
+    use_read_replica,
+)
+from memobase_server.env import CONFIG, TelemetryKeyName
 from memobase_server.controllers import full as controllers
+from memobase_server.controllers.post_process.profile import rank_profiles_with_chats
 from memobase_server.models import response as res
 from memobase_server.models.blob import BlobType
-from memobase_server.models.database import DEFAULT_PROJECT_ID
+from memobase_server.models.utils import Promise
+from memobase_server.utils import (
+    count_tokens,
+    count_tokens_batch,
+    event_str_repr,
+    profile_str_repr,
+)
+from memobase_server.offload import run_cpu_bound
+from memobase_server.models.database import (
+    DEFAULT_PROJECT_ID,
+    DEFAULT_PROJECT_SECRET,
+    UserEvent,
+    UserProfile,
+    Billing,
+    ProjectBilling,
+)
+from memobase_server.telemetry.capture_key import (
+    get_int_key,
+    get_int_keys,
+    int_key,
+    capture_int_keys,
+    buffer_int_key,
+    flush_int_keys,
+    PENDING_INT_KEYS,
+)
+from memobase_server.auth import token
+from memobase_server.cache import LISTENER_STATE
+
+
+def fake_embedding(project_id, texts, phase="document", model=None):
+    # One axis per sub_topic, texts about the age on the second one
+    embeddings = np.zeros((len(texts), CONFIG.embedding_dim))
+    for i, t in enumerate(texts):
+        embeddings[i, 1 if "age" in t else 0] = 1
+    return Promise.resolve(embeddings)
+
+
+@contextmanager
+def fake_profile_embedding():
+    with patch.object(CONFIG, "enable_profile_embedding", True), patch(
+        "memobase_server.controllers.profile.get_embedding",
+        side_effect=fake_embedding,
+    ), patch(
+        "memobase_server.controllers.post_process.profile.get_embedding",
+        side_effect=fake_embedding,
+    ):
+        yield
 
 
 @pytest.mark.asyncio
@@ -48,12 +114,25 @@ async def test_user_state_clean(db_env):
         u_id, DEFAULT_PROJECT_ID, ["test"], [{"topic": "test", "sub_topic": "test"}]
     )
     assert p.ok()
+    async with get_redis_client() as redis_client:
+        cached = await redis_client.get(
+            controllers.profile.user_profiles_cache_key(u_id, DEFAULT_PROJECT_ID)
+        )
+    # written through on update, not evicted
+    assert cached is not None
     p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
     assert p.ok()
     d = p.data()
     assert len(d.profiles) == 1
     assert d.profiles[0].attributes == {"topic": "test", "sub_topic": "test"}
 
+    p = await controllers.profile.update_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, [d.profiles[0].id], ["test2"], [None]
+    )
+    assert p.ok()
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok() and p.data().profiles[0].content == "test2"
+
     p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
     assert p.ok()
     p = await controllers.user.get_user(u_id, DEFAULT_PROJECT_ID)
@@ -165,3 +244,923 @@ async def test_user_blob_curd(db_env):
         u_id, DEFAULT_PROJECT_ID, BlobType.chat
     )
     assert len(p.data().ids) == 0
+
+
+@pytest.mark.asyncio
+async def test_event_compaction(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    embedding = AsyncMock()
+    embedding.ok = Mock(return_value=True)
+    embedding.data = Mock(
+        return_value=np.array([[0.1 for _ in range(CONFIG.embedding_dim)]])
+    )
+    digest = AsyncMock()
+    digest.ok = Mock(return_value=True)
+    digest.data = Mock(return_value="The user went hiking twice this week")
+    with patch(
+        "memobase_server.controllers.event.get_embedding", return_value=embedding
+    ), patch(
+        "memobase_server.controllers.event_compaction.llm_complete",
+        return_value=digest,
+    ):
+        for value in ["happy", "tired", "happy"]:
+            p = await controllers.event.append_user_event(
+                u_id,
+                DEFAULT_PROJECT_ID,
+                {
+                    "event_tip": "went hiking",
+                    "event_tags": [{"tag": "emotion", "value": value}],
+                },
+            )
+            assert p.ok()
+        with Session() as session:
+            session.execute(
+                update(UserEvent)
+                .where(UserEvent.user_id == u_id)
+                .values(created_at=datetime(2024, 1, 3, 12, tzinfo=timezone.utc))
+            )
+            session.commit()
+
+        p = await controllers.event.get_user_events(u_id, DEFAULT_PROJECT_ID)
+        assert p.ok()
+        stale_events = p.data().events
+        p = await controllers.event_compaction.compact_user_events(
+            u_id, DEFAULT_PROJECT_ID, datetime.now(timezone.utc) - timedelta(days=1)
+        )
+        assert p.ok() and p.data() == 1
+        # A pass that read the events before they were digested adds no digest
+        period_start, period_end = controllers.event_compaction.period_bounds(
+            stale_events[0].created_at, CONFIG.event_compaction_period
+        )
+        p = await controllers.event_compaction.compact_period(
+            u_id, DEFAULT_PROJECT_ID, stale_events, period_start, period_end
+        )
+        assert p.ok()
+
+    p = await controllers.event.get_user_events(u_id, DEFAULT_PROJECT_ID, topk=10)
+    assert p.ok()
+    events = p.data().events
+    assert len(events) == 1
+    event_data = events[0].event_data
+    assert event_data.event_tip == "The user went hiking twice this week"
+    assert event_data.event_digest.source_event_count == 3
+    assert [(t.tag, t.value) for t in event_data.event_tags] == [
+        ("emotion", "happy"),
+        ("emotion", "tired"),
+    ]
+    p = await controllers.event.get_user_events(
+        u_id, DEFAULT_PROJECT_ID, tag_values={"emotion": "tired"}
+    )
+    assert p.ok() and len(p.data().events) == 1
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_user_events_recency_listing(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    with patch.object(CONFIG, "enable_event_embedding", False):
+        event_ids = []
+        for i in range(4):
+            event_data = {"profile_delta": []}
+            if i % 2 == 0:
+                event_data["event_tip"] = f"tip {i}"
+            p = await controllers.event.append_user_event(
+                u_id, DEFAULT_PROJECT_ID, event_data
+            )
+            assert p.ok()
+            event_ids.append(p.data())
+    with Session() as session:
+        for i, event_id in enumerate(event_ids):
+            session.execute(
+                update(UserEvent)
+                .where(UserEvent.id == event_id)
+                .values(created_at=datetime(2024, 1, 1 + i, tzinfo=timezone.utc))
+            )
+        session.commit()
+        has_event_tip = dict(
+            session.execute(
+                select(UserEvent.id, UserEvent.has_event_tip).where(
+                    UserEvent.user_id == u_id
+                )
+            ).all()
+        )
+        indexes = set(
+            session.scalars(
+                text("SELECT indexname FROM pg_indexes WHERE tablename = 'user_events'")
+            )
+        )
+    # Generated from event_data, backs the partial index of need_summary
+    assert [has_event_tip[event_id] for event_id in event_ids] == [
+        True,
+        False,
+        True,
+        False,
+    ]
+    assert {
+        "idx_user_events_user_id_project_id_created_at",
+        "idx_user_events_user_id_project_id_created_at_event_tip",
+    } <= indexes
+
+    p = await controllers.event.get_user_events(u_id, DEFAULT_PROJECT_ID, topk=3)
+    assert p.ok()
+    assert [e.id for e in p.data().events] == event_ids[::-1][:3]
+    p = await controllers.event.get_user_events(
+        u_id, DEFAULT_PROJECT_ID, topk=3, need_summary=True
+    )
+    assert p.ok()
+    assert [e.event_data.event_tip for e in p.data().events] == ["tip 2", "tip 0"]
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_user_profiles_single_flight(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, ["test"], [{"topic": "test", "sub_topic": "test"}]
+    )
+    assert p.ok()
+    async with get_redis_client() as redis_client:
+        await redis_client.delete(
+            controllers.profile.user_profiles_cache_key(u_id, DEFAULT_PROJECT_ID)
+        )
+
+    with patch(
+        "memobase_server.controllers.profile.load_user_profiles",
+        wraps=controllers.profile.load_user_profiles,
+    ) as mock_load:
+        ps = await asyncio.gather(
+            *[
+                controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+                for _ in range(5)
+            ]
+        )
+    assert all(p.ok() and len(p.data().profiles) == 1 for p in ps)
+    assert mock_load.call_count == 1
+
+    # Waiters of one load get their own profiles, a caller updating the
+    # attributes in place, like the merge step of a flush, affects no other
+    async with get_redis_client() as redis_client:
+        await redis_client.delete(
+            controllers.profile.user_profiles_cache_key(u_id, DEFAULT_PROJECT_ID)
+        )
+
+    async def mutate_profiles():
+        p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+        p.data().profiles[0].attributes["update_hits"] = 100
+        return p
+
+    first, second = await asyncio.gather(
+        mutate_profiles(),
+        controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID),
+    )
+    assert first.data().profiles[0].attributes["update_hits"] == 100
+    assert "update_hits" not in second.data().profiles[0].attributes
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert "update_hits" not in p.data().profiles[0].attributes
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_project_profile_config_cache(db_env):
+    p = await controllers.project.update_project_profile_config(
+        DEFAULT_PROJECT_ID, "language: zh"
+    )
+    assert p.ok()
+    p = await controllers.project.get_project_profile_config(DEFAULT_PROJECT_ID)
+    assert p.ok() and p.data().language == "zh"
+
+    p = await controllers.project.update_project_profile_config(
+        DEFAULT_PROJECT_ID, None
+    )
+    assert p.ok()
+    p = await controllers.project.get_project_profile_config(DEFAULT_PROJECT_ID)
+    assert p.ok() and p.data().language is None
+
+
+@pytest.mark.asyncio
+async def test_user_context_cache(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Gus"],
+        [{"topic": "basic_info", "sub_topic": "name"}],
+    )
+    assert p.ok()
+
+    params = controllers.context.DEFAULT_CONTEXT_PARAMS
+    p = await controllers.context.get_user_context(u_id, DEFAULT_PROJECT_ID, **params)
+    assert p.ok() and "Gus" in p.data().context
+    p = await controllers.context.get_user_context(u_id, DEFAULT_PROJECT_ID, **params)
+    assert p.ok() and "Gus" in p.data().context
+
+    # a profile update changes the cache key
+    p = await controllers.profile.add_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, ["23"], [{"topic": "basic_info", "sub_topic": "age"}]
+    )
+    assert p.ok()
+    p = await controllers.context.get_user_context(u_id, DEFAULT_PROJECT_ID, **params)
+    assert p.ok() and "23" in p.data().context
+    en_context = p.data().context
+
+    # so does a project profile config update, the language picks the prompt
+    p = await controllers.project.get_project_profile_config_string(DEFAULT_PROJECT_ID)
+    assert p.ok()
+    original_config = p.data().profile_config
+    p = await controllers.project.update_project_profile_config(
+        DEFAULT_PROJECT_ID, "language: zh"
+    )
+    assert p.ok()
+    try:
+        p = await controllers.context.get_user_context(
+            u_id, DEFAULT_PROJECT_ID, **params
+        )
+        assert p.ok() and p.data().context != en_context
+    finally:
+        p = await controllers.project.update_project_profile_config(
+            DEFAULT_PROJECT_ID, original_config or None
+        )
+        assert p.ok()
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_user_context_fast_event_query(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Gus"],
+        [{"topic": "basic_info", "sub_topic": "name"}],
+    )
+    assert p.ok()
+
+    search = AsyncMock(return_value=Promise.resolve(res.UserEventsData(events=[])))
+    searched_before_filter = []
+
+    async def filter_profiles(user_id, project_id, profiles, chats, **kwargs):
+        await asyncio.sleep(0.1)
+        searched_before_filter.append(search.await_count > 0)
+        return Promise.reject(res.CODE.SERVICE_UNAVAILABLE, "LLM is down")
+
+    params = dict(
+        controllers.context.DEFAULT_CONTEXT_PARAMS,
+        chats=[res.OpenAICompatibleMessage(role="user", content="Who am I?")],
+    )
+    with patch.object(CONFIG, "enable_event_embedding", True), patch(
+        "memobase_server.controllers.context.filter_profiles_with_chats",
+        side_effect=filter_profiles,
+    ), patch("memobase_server.controllers.context.search_user_events", search):
+        for fast_event_query in [False, True]:
+            p = await controllers.context.build_user_context(
+                u_id,
+                DEFAULT_PROJECT_ID,
+                **dict(params, fast_event_query=fast_event_query),
+            )
+            assert p.ok() and "Gus" in p.data().context
+            # without the filtered profiles, the query is the last message
+            assert search.await_args.kwargs["query"] == "Who am I?"
+    assert searched_before_filter == [False, True]
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_user_context_deadline(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Gus"],
+        [{"topic": "basic_info", "sub_topic": "name"}],
+    )
+    assert p.ok()
+
+    async def slow_filter(*args, **kwargs):
+        await asyncio.sleep(5)
+
+    async def slow_search(*args, **kwargs):
+        await asyncio.sleep(5)
+
+    params = dict(
+        controllers.context.DEFAULT_CONTEXT_PARAMS,
+        chats=[res.OpenAICompatibleMessage(role="user", content="Who am I?")],
+    )
+    with patch.object(CONFIG, "enable_event_embedding", True), patch(
+        "memobase_server.controllers.context.filter_profiles_with_chats",
+        side_effect=slow_filter,
+    ), patch(
+        "memobase_server.controllers.context.search_user_events",
+        side_effect=slow_search,
+    ):
+        start = asyncio.get_running_loop().time()
+        p = await controllers.context.get_user_context(
+            u_id, DEFAULT_PROJECT_ID, timeout_ms=200, **params
+        )
+        assert asyncio.get_running_loop().time() - start < 2
+    assert p.ok() and "Gus" in p.data().context
+    assert p.data().degraded_stages == ["profile_filter", "event_search"]
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_rank_profiles_with_chats(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    # The query is about the name
+    with fake_profile_embedding(), patch.object(
+        CONFIG, "enable_event_embedding", False
+    ):
+        p = await controllers.profile.add_user_profiles(
+            u_id,
+            DEFAULT_PROJECT_ID,
+            ["Gus", "23"],
+            [
+                {"topic": "basic_info", "sub_topic": "name"},
+                {"topic": "basic_info", "sub_topic": "age"},
+            ],
+        )
+        assert p.ok()
+        p = await controllers.context.get_user_context(
+            u_id,
+            DEFAULT_PROJECT_ID,
+            **dict(
+                controllers.context.DEFAULT_CONTEXT_PARAMS,
+                chats=[res.OpenAICompatibleMessage(role="user", content="Hi")],
+                profile_filter_mode="embedding",
+            ),
+        )
+    assert p.ok()
+    assert "Gus" in p.data().context and "23" not in p.data().context
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_rank_unembedded_profiles(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    # Written before profile embedding was enabled
+    p = await controllers.profile.add_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, ["23"], [{"topic": "basic_info", "sub_topic": "age"}]
+    )
+    assert p.ok()
+    old_id = p.data().ids[0]
+
+    def embedded_ids() -> set:
+        with Session() as session:
+            return {
+                str(profile_id)
+                for profile_id in session.scalars(
+                    select(UserProfile.id).where(
+                        UserProfile.user_id == u_id,
+                        UserProfile.embedding.is_not(None),
+                    )
+                )
+            }
+
+    chats = [res.OpenAICompatibleMessage(role="user", content="Hi")]
+    with fake_profile_embedding():
+        profiles = (
+            await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+        ).data()
+        p = await rank_profiles_with_chats(u_id, DEFAULT_PROJECT_ID, profiles, chats)
+        assert p.ok()
+        # Kept after the ranked profiles, not dropped
+        assert [str(pf.id) for pf in p.data()["profiles"]] == [str(old_id)]
+
+        p = await controllers.profile.add_user_profiles(
+            u_id,
+            DEFAULT_PROJECT_ID,
+            ["Gus"],
+            [{"topic": "basic_info", "sub_topic": "name"}],
+        )
+        assert p.ok()
+        # Backfilled along with the new profile
+        assert embedded_ids() == {str(old_id), str(p.data().ids[0])}
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_stored_token_counts(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Gus", "23"],
+        [
+            {"topic": "basic_info", "sub_topic": "name"},
+            {"topic": "basic_info", "sub_topic": "age"},
+        ],
+    )
+    assert p.ok()
+    p = await controllers.event.append_user_event(
+        u_id, DEFAULT_PROJECT_ID, {"event_tip": "went hiking"}
+    )
+    assert p.ok()
+
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+    profiles = p.data()
+    for profile in profiles.profiles:
+        assert profile.token_count == count_tokens(
+            profile_str_repr(profile.content, profile.attributes)
+        )
+    p = await controllers.profile.truncate_profiles(
+        profiles, max_token_size=profiles.profiles[0].token_count
+    )
+    assert p.ok() and len(p.data().profiles) == 1
+
+    p = await controllers.event.get_user_events(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+    events = p.data()
+    assert events.events[0].token_count == count_tokens(
+        event_str_repr(events.events[0])
+    )
+    p = await controllers.event.truncate_events(
+        events, events.events[0].token_count - 1
+    )
+    assert p.ok() and len(p.data().events) == 0
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_run_cpu_bound():
+    loop_thread = threading.get_ident()
+
+    def current_thread():
+        return threading.get_ident()
+
+    assert await run_cpu_bound(1, current_thread) == loop_thread
+    offloaded = await run_cpu_bound(CONFIG.cpu_offload_min_size, current_thread)
+    assert offloaded != loop_thread
+
+    content = "hello world " * 4096
+    assert await run_cpu_bound(len(content), count_tokens_batch, [content, "hi"]) == [
+        count_tokens(content),
+        count_tokens("hi"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_project_auth_cache(db_env):
+    secret = DEFAULT_PROJECT_SECRET
+    with patch.dict(LISTENER_STATE, {"subscribed": True}):
+        token.PROJECT_AUTH_LOCAL_CACHE.clear()
+        p = await token.check_project_secret(DEFAULT_PROJECT_ID, secret)
+        assert p.ok() and p.data()
+
+        # Served from memory, Redis is not touched
+        with patch(
+            "memobase_server.auth.token.get_redis_client",
+            side_effect=RuntimeError("no redis"),
+        ):
+            p = await token.check_project_secret(DEFAULT_PROJECT_ID, secret + "x")
+            assert p.ok() and not p.data()
+            p = await token.get_project_status(DEFAULT_PROJECT_ID)
+            assert p.ok()
+
+        # Once the TTL passes, the project is read from Redis again
+        token.PROJECT_AUTH_LOCAL_CACHE.clear()
+        with patch.object(token.PROJECT_AUTH_LOCAL_CACHE, "ttl", -1):
+            p = await token.check_project_secret(DEFAULT_PROJECT_ID, secret)
+            assert p.ok() and p.data()
+        assert token.PROJECT_AUTH_LOCAL_CACHE.get(DEFAULT_PROJECT_ID) is None
+        token.PROJECT_AUTH_LOCAL_CACHE.clear()
+
+
+@pytest.mark.asyncio
+async def test_token_billing_write_behind(db_env):
+    billing = controllers.billing
+
+    def usage_left():
+        with Session() as session:
+            return (
+                session.query(Billing.usage_left)
+                .join(ProjectBilling, ProjectBilling.billing_id == Billing.id)
+                .filter(ProjectBilling.project_id == DEFAULT_PROJECT_ID)
+                .scalar()
+            )
+
+    async def month_tokens():
+        return [
+            await get_int_key(name, DEFAULT_PROJECT_ID, in_month=True)
+            for name in (
+                TelemetryKeyName.llm_input_tokens,
+                TelemetryKeyName.llm_output_tokens,
+            )
+        ]
+
+    await billing.flush_token_billing()
+    before_left = usage_left()
+    before_tokens = await month_tokens()
+
+    with patch.object(CONFIG, "billing_flush_interval", 5):
+        for _ in range(3):
+            p = await billing.project_cost_token_billing(DEFAULT_PROJECT_ID, 10, 5)
+            assert p.ok()
+    # Only accumulated in memory until the flush
+    assert billing.PENDING_BILLING[DEFAULT_PROJECT_ID] == [30, 15]
+    assert usage_left() == before_left
+    assert await month_tokens() == before_tokens
+
+    p = await billing.flush_token_billing()
+    assert p.ok()
+    assert not billing.PENDING_BILLING and not billing.PENDING_USAGE_COUNTERS
+    assert await month_tokens() == [before_tokens[0] + 30, before_tokens[1] + 15]
+    if before_left is not None:
+        assert usage_left() == before_left - 45
+
+    # A failed billing write is kept for the next flush, counters aren't rewritten
+    with patch.object(CONFIG, "billing_flush_interval", 5):
+        await billing.project_cost_token_billing(DEFAULT_PROJECT_ID, 1, 1)
+    with patch(
+        "memobase_server.controllers.billing.cost_billings",
+        side_effect=RuntimeError("db down"),
+    ):
+        p = await billing.flush_token_billing()
+        assert not p.ok()
+    assert billing.PENDING_BILLING[DEFAULT_PROJECT_ID] == [1, 1]
+    assert not billing.PENDING_USAGE_COUNTERS
+    assert (await billing.flush_token_billing()).ok()
+
+    # A flush cancelled midway, as at shutdown, keeps the usage it took
+    with patch.object(CONFIG, "billing_flush_interval", 5):
+        await billing.project_cost_token_billing(DEFAULT_PROJECT_ID, 2, 3)
+    with patch(
+        "memobase_server.controllers.billing.capture_int_keys",
+        side_effect=lambda counts: asyncio.sleep(10),
+    ):
+        flush = asyncio.create_task(billing.flush_token_billing())
+        await asyncio.sleep(0.01)
+        flush.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await flush
+    assert billing.PENDING_USAGE_COUNTERS[DEFAULT_PROJECT_ID] == [2, 3]
+    assert billing.PENDING_BILLING[DEFAULT_PROJECT_ID] == [2, 3]
+    assert (await billing.flush_token_billing()).ok()
+
+
+@pytest.mark.asyncio
+async def test_project_quota_cache(db_env):
+    billing = controllers.billing
+    billing.PROJECT_QUOTAS.pop(DEFAULT_PROJECT_ID, None)
+    with patch.object(CONFIG, "billing_quota_ttl", 30), patch.object(
+        CONFIG, "billing_quota_near_limit_tokens", -(10**12)
+    ), patch.object(CONFIG, "billing_flush_interval", 5):
+        p = await billing.get_project_quota(DEFAULT_PROJECT_ID)
+        assert p.ok()
+        loaded = p.data().model_copy()
+
+        # Served from memory and charged with this worker's usage
+        with patch(
+            "memobase_server.controllers.billing.get_project_billing",
+            side_effect=RuntimeError("no billing reads"),
+        ):
+            await billing.project_cost_token_billing(DEFAULT_PROJECT_ID, 10, 5)
+            p = await billing.get_project_quota(DEFAULT_PROJECT_ID)
+            assert p.ok()
+            assert (
+                p.data().project_token_cost_month
+                == loaded.project_token_cost_month + 15
+            )
+            if loaded.token_left is not None:
+                assert p.data().token_left == loaded.token_left - 15
+
+        # A stale state is returned at once and reloaded in the background
+        billing.PROJECT_QUOTAS[DEFAULT_PROJECT_ID].loaded_at -= 60
+        reload = AsyncMock(return_value=Promise.resolve(loaded.model_copy()))
+        with patch("memobase_server.controllers.billing.get_project_billing", reload):
+            p = await billing.get_project_quota(DEFAULT_PROJECT_ID)
+            assert p.ok()
+            await asyncio.sleep(0.1)
+            reload.assert_awaited_once()
+        # The unflushed usage is kept on top of the reloaded billing
+        assert (
+            billing.PROJECT_QUOTAS[DEFAULT_PROJECT_ID].billing.project_token_cost_month
+            == loaded.project_token_cost_month + 15
+        )
+    assert (await billing.flush_token_billing()).ok()
+    billing.PROJECT_QUOTAS.pop(DEFAULT_PROJECT_ID, None)
+
+
+@pytest.mark.asyncio
+async def test_project_quota_during_flush(db_env):
+    billing = controllers.billing
+    assert (await billing.flush_token_billing()).ok()
+    p = await billing.load_project_quota(DEFAULT_PROJECT_ID)
+    assert p.ok()
+    before = p.data().model_copy()
+
+    with patch.object(CONFIG, "billing_flush_interval", 5):
+        await billing.project_cost_token_billing(DEFAULT_PROJECT_ID, 10, 5)
+    capture = billing.capture_int_keys
+
+    async def slow_capture(counts):
+        await asyncio.sleep(0.1)
+        await capture(counts)
+
+    # Read while the flush has taken the pending usage but not written it yet
+    with patch(
+        "memobase_server.controllers.billing.capture_int_keys",
+        side_effect=slow_capture,
+    ):
+        flush = asyncio.create_task(billing.flush_token_billing())
+        await asyncio.sleep(0.01)
+        assert not billing.PENDING_USAGE_COUNTERS
+        p = await billing.load_project_quota(DEFAULT_PROJECT_ID)
+        assert p.ok()
+        assert (await flush).ok()
+    # The usage is counted once
+    assert p.data().project_token_cost_month == before.project_token_cost_month + 15
+    if before.token_left is not None:
+        assert p.data().token_left == before.token_left - 15
+    billing.PROJECT_QUOTAS.pop(DEFAULT_PROJECT_ID, None)
+
+
+@pytest.mark.asyncio
+async def test_pipelined_int_keys(db_env):
+    name = "test_pipelined_int_keys"
+    key = int_key(name, DEFAULT_PROJECT_ID)
+    async with get_redis_client() as redis_client:
+        await redis_client.delete(key, int_key(name, DEFAULT_PROJECT_ID, in_month=True))
+
+        await capture_int_keys([(name, DEFAULT_PROJECT_ID, 2)], expire_days=1)
+        assert 0 < await redis_client.ttl(key) <= 24 * 60 * 60
+        # The expiry is only set when the key is created
+        await redis_client.expire(key, 100)
+        await capture_int_keys([(name, DEFAULT_PROJECT_ID, 3)], expire_days=1)
+        assert await redis_client.ttl(key) <= 100
+    assert await get_int_keys(
+        [key, int_key(name, DEFAULT_PROJECT_ID, in_month=True), key + "::missing"]
+    ) == [5, 5, 0]
+
+    with patch.object(CONFIG, "telemetry_counter_flush_interval", 1):
+        for _ in range(4):
+            await buffer_int_key(name, project_id=DEFAULT_PROJECT_ID)
+    assert PENDING_INT_KEYS[(name, DEFAULT_PROJECT_ID)] == 4
+    assert await get_int_key(name, DEFAULT_PROJECT_ID) == 5
+    await flush_int_keys()
+    assert not PENDING_INT_KEYS
+    assert await get_int_key(name, DEFAULT_PROJECT_ID) == 9
+
+
+@pytest.mark.asyncio
+async def test_bulk_update_user_profiles(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Gus", "23", "Tokyo"],
+        [
+            {"topic": "basic_info", "sub_topic": "name"},
+            {"topic": "basic_info", "sub_topic": "age"},
+            {"topic": "basic_info", "sub_topic": "city"},
+        ],
+    )
+    assert p.ok()
+    name_id, age_id, city_id = p.data().ids
+
+    missing_id = "00000000-0000-0000-0000-000000000000"
+    p = await controllers.profile.add_update_delete_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["likes tea"],
+        [{"topic": "interest", "sub_topic": "drink"}],
+        [name_id, age_id, missing_id, age_id],
+        ["Gustavo", "24", "nobody", "25"],
+        [{"topic": "basic_info", "sub_topic": "full_name"}, None, None, None],
+        [city_id],
+    )
+    assert p.ok()
+
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+    profiles = {str(pf.id): pf for pf in p.data().profiles}
+    assert len(profiles) == 3 and str(city_id) not in profiles
+    assert "likes tea" in [pf.content for pf in profiles.values()]
+    assert profiles[str(name_id)].content == "Gustavo"
+    assert profiles[str(name_id)].attributes["sub_topic"] == "full_name"
+    # The last update wins and a None attribute keeps the stored one
+    assert profiles[str(age_id)].content == "25"
+    assert profiles[str(age_id)].attributes["sub_topic"] == "age"
+    for profile in profiles.values():
+        assert profile.token_count == count_tokens(
+            profile_str_repr(profile.content, profile.attributes)
+        )
+
+    p = await controllers.profile.update_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, [age_id, missing_id], ["26", "nobody"], [None, None]
+    )
+    assert p.ok()
+    assert [str(i) for i in p.data().ids] == [str(age_id)]
+
+
+@pytest.mark.asyncio
+async def test_get_user_profiles_topic_filters(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Gus", "23", "Tokyo", "tea", "hiking", "chess"],
+        [
+            {"topic": "basic_info", "sub_topic": "name"},
+            {"topic": "basic_info", "sub_topic": "age"},
+            {"topic": "basic_info", "sub_topic": "city"},
+            {"topic": "interest", "sub_topic": "drink"},
+            {"topic": "interest", "sub_topic": "sport"},
+            {"topic": "work", "sub_topic": "hobby"},
+        ],
+    )
+    assert p.ok()
+
+    cases = [
+        dict(only_topics=["interest", " work "]),
+        dict(max_subtopic_size=2),
+        dict(topic_limits={"basic_info": 1, "work": 0}),
+        dict(prefer_topics=["work", "interest"], topk=3),
+        dict(only_topics=["basic_info"], topic_limits={"basic_info": 2}, topk=1),
+        # Topic names are normalized the same way on both paths
+        dict(topic_limits={" basic_info ": 1, "work ": 0}),
+        dict(prefer_topics=[" work", "interest "], topk=3),
+    ]
+    async with get_redis_client() as redis_client:
+        await redis_client.delete(
+            controllers.profile.user_profiles_cache_key(u_id, DEFAULT_PROJECT_ID)
+        )
+    for topic_filters in cases:
+        # Pushed down to SQL, the local cache is off in tests
+        p = await controllers.profile.get_user_profiles(
+            u_id, DEFAULT_PROJECT_ID, **topic_filters
+        )
+        assert p.ok()
+        pushed = [pf.id for pf in p.data().profiles]
+
+        p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+        assert p.ok()
+        p = await controllers.profile.truncate_profiles(p.data(), **topic_filters)
+        assert p.ok()
+        assert pushed == [pf.id for pf in p.data().profiles], topic_filters
+
+        # Filtered from the cached profiles once they are cached
+        with patch(
+            "memobase_server.controllers.profile.load_user_profiles",
+            side_effect=RuntimeError("no SQL"),
+        ):
+            p = await controllers.profile.get_user_profiles(
+                u_id, DEFAULT_PROJECT_ID, **topic_filters
+            )
+        assert p.ok()
+        assert pushed == [pf.id for pf in p.data().profiles], topic_filters
+        async with get_redis_client() as redis_client:
+            await redis_client.delete(
+                controllers.profile.user_profiles_cache_key(u_id, DEFAULT_PROJECT_ID)
+            )
+
+
+@pytest.mark.asyncio
+async def test_core_read_paths(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["Gus"],
+        [{"topic": "basic_info", "sub_topic": "name"}],
+    )
+    assert p.ok()
+    p = await controllers.event.append_user_event(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        {"event_tip": "went hiking", "event_tags": [{"tag": "mood", "value": "happy"}]},
+    )
+    assert p.ok()
+
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+    profile = p.data().profiles[0]
+    assert isinstance(profile, res.ProfileData) and profile.content == "Gus"
+
+    p = await controllers.event.get_user_events(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+    event = p.data().events[0]
+    # The nested event data is still a model
+    assert isinstance(event.event_data, res.EventData)
+    assert event.event_data.event_tags[0].value == "happy"
+    assert event_str_repr(event)
+    # Serialized like a validated model
+    assert res.UserEventsDataResponse(data=p.data()).model_dump(mode="json")
+
+
+@pytest.mark.asyncio
+async def test_request_unit_of_work(db_env):
+    async def request():
+        units = request_unit_of_work()
+        unit = await units.__anext__()
+        with Session() as session:
+            first = session.connection().connection.dbapi_connection
+        # Committed on the shared connection, seen by the next session
+        p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+        assert p.ok()
+        with Session() as session:
+            assert session.connection().connection.dbapi_connection is first
+        p = await controllers.user.get_user(p.data().id, DEFAULT_PROJECT_ID)
+        assert p.ok()
+        await units.aclose()
+        assert unit.closed and unit.connection is None
+        # Tasks outliving the request check out their own connection
+        p = await controllers.user.get_user(p.data().id, DEFAULT_PROJECT_ID)
+        assert p.ok()
+
+    await asyncio.create_task(request())
+
+
+@pytest.mark.asyncio
+async def test_read_replica_routing(db_env):
+    # The primary stands in for a healthy replica, next to one that is down
+    down = ReadReplica(create_engine(DB_ENGINE.url.set(port=1)))
+    healthy = ReadReplica(DB_ENGINE)
+    with patch("memobase_server.connectors.READ_REPLICAS", [down, healthy]):
+        p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+        assert p.ok()
+        u_id = p.data().id
+        p = await controllers.blob.insert_blob(
+            u_id,
+            DEFAULT_PROJECT_ID,
+            res.BlobData(
+                blob_type=BlobType.chat,
+                blob_data={"messages": [{"role": "user", "content": "hello"}]},
+            ),
+        )
+        assert p.ok()
+        b_id = p.data().id
+        # Read your writes: the user reads from the primary for a while
+        assert not await use_read_replica(u_id, DEFAULT_PROJECT_ID)
+        assert await use_read_replica()
+        async with get_redis_client() as redis_client:
+            await redis_client.delete(recent_write_key(u_id, DEFAULT_PROJECT_ID))
+        assert await use_read_replica(u_id, DEFAULT_PROJECT_ID)
+
+        for _ in range(2):
+            with ReadSession() as session:
+                assert session.connection().engine is DB_ENGINE
+        assert down.ejected_until > 0
+        p = await controllers.blob.get_blob(u_id, DEFAULT_PROJECT_ID, b_id)
+        assert p.ok()
+        # The shared profile cache is only filled from the primary
+        with patch(
+            "memobase_server.controllers.profile.ReadSession", wraps=ReadSession
+        ) as read_session:
+            p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+            assert p.ok()
+        read_session.assert_called_once_with(False)
+
+        p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+        assert p.ok()
+    down.engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_migrate_schema(db_env):
+    # create_all() built the current schema, so there is nothing to add
+    assert migrate_schema(dry_run=True) == []
+    assert migrate_schema() == []
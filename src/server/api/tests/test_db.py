@@ -1,6 +1,15 @@
+import re
 import pytest
+from datetime import datetime, timezone
+from unittest.mock import Mock, patch
 from sqlalchemy.inspection import inspect
-from memobase_server.models.database import User, GeneralBlob, UserProfile
+from memobase_server.models.database import (
+    User,
+    GeneralBlob,
+    UserProfile,
+    UserEvent,
+    shift_month_first_day,
+)
 from memobase_server.models.blob import BlobType
 from memobase_server.connectors import (
     Session,
@@ -49,3 +58,119 @@ def test_general_blob_model(db_env):
         user = session.query(User).filter_by(id=test_user_id).first()
         session.delete(user)
         session.commit()
+
+
+class FakePartitionSession:
+    """Answers the catalog queries of the partition helpers from a list of
+    partition names and applies their DDL to it"""
+
+    def __init__(self, partitions: list[str], partitioned: bool = True):
+        self.partitions = list(partitions)
+        self.partitioned = partitioned
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        statement = " ".join(str(sql).split())
+        self.statements.append(statement)
+        if "pg_partitioned_table" in statement:
+            return Mock(scalar=Mock(return_value=self.partitioned))
+        if "pg_inherits" in statement:
+            return Mock(scalars=Mock(return_value=list(self.partitions)))
+        m = re.match(r"CREATE TABLE IF NOT EXISTS (\w+) PARTITION OF", statement)
+        if m is not None and m.group(1) not in self.partitions:
+            self.partitions.append(m.group(1))
+        m = re.match(r"ALTER TABLE \w+ DETACH PARTITION (\w+)", statement)
+        if m is not None:
+            self.partitions.remove(m.group(1))
+        return Mock()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def frozen_now(now: datetime):
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    return patch("memobase_server.models.database.datetime", FrozenDatetime)
+
+
+def month_partitions(*months: str) -> list[str]:
+    return [f"user_events_p{month}" for month in months]
+
+
+def test_shift_month_first_day():
+    dt = datetime(2024, 12, 15, 10, 30, tzinfo=timezone.utc)
+    assert shift_month_first_day(dt, 0) == datetime(2024, 12, 1, tzinfo=timezone.utc)
+    # Year rollover in both directions
+    assert shift_month_first_day(dt, 1) == datetime(2025, 1, 1, tzinfo=timezone.utc)
+    assert shift_month_first_day(dt, 13) == datetime(2026, 1, 1, tzinfo=timezone.utc)
+    jan = datetime(2025, 1, 31)
+    assert shift_month_first_day(jan, -1) == datetime(2024, 12, 1)
+    assert shift_month_first_day(jan, -12) == datetime(2024, 1, 1)
+    assert shift_month_first_day(jan, -13) == datetime(2023, 12, 1)
+
+
+def test_is_partitioned():
+    assert UserEvent.is_partitioned(FakePartitionSession([]))
+    assert not UserEvent.is_partitioned(FakePartitionSession([], partitioned=False))
+
+
+def test_list_monthly_partitions():
+    session = FakePartitionSession(
+        month_partitions("202412", "202501")
+        + ["user_events_default", "user_events_p2025", "other_p202501"]
+    )
+    assert UserEvent.list_monthly_partitions(session) == {
+        "user_events_p202412": datetime(2024, 12, 1, tzinfo=timezone.utc),
+        "user_events_p202501": datetime(2025, 1, 1, tzinfo=timezone.utc),
+    }
+
+
+def test_create_monthly_partitions_year_rollover():
+    session = FakePartitionSession(month_partitions("202411"))
+    with frozen_now(datetime(2024, 11, 20, tzinfo=timezone.utc)):
+        created = UserEvent.create_monthly_partitions(session, 2)
+    assert created == month_partitions("202412", "202501")
+    assert any("user_events_default" in s for s in session.statements)
+    assert any(
+        "user_events_p202412 PARTITION OF user_events "
+        "FOR VALUES FROM ('2024-12-01T00:00:00+00:00') "
+        "TO ('2025-01-01T00:00:00+00:00')" in s
+        for s in session.statements
+    )
+    # Existing partitions are not created again
+    with frozen_now(datetime(2024, 12, 2, tzinfo=timezone.utc)):
+        assert UserEvent.create_monthly_partitions(session, 1) == []
+        assert UserEvent.create_monthly_partitions(session, 0) == []
+
+
+def test_expire_monthly_partitions():
+    months = ["202410", "202411", "202412", "202501", "202502"]
+    now = datetime(2025, 1, 10, tzinfo=timezone.utc)
+    for retention, expired in [
+        (0, ["202410", "202411", "202412"]),
+        (1, ["202410", "202411"]),
+        (3, []),
+    ]:
+        session = FakePartitionSession(month_partitions(*months))
+        with frozen_now(now):
+            assert UserEvent.expire_monthly_partitions(
+                session, retention
+            ) == month_partitions(*expired)
+        # The current and next month are always kept
+        assert set(month_partitions("202501", "202502")) <= set(session.partitions)
+        assert not any(s.startswith("DROP TABLE") for s in session.statements)
+
+    session = FakePartitionSession(month_partitions(*months))
+    with frozen_now(now):
+        UserEvent.expire_monthly_partitions(session, 1, drop=True)
+    assert [s for s in session.statements if s.startswith("DROP TABLE")] == [
+        "DROP TABLE user_events_p202410",
+        "DROP TABLE user_events_p202411",
+    ]